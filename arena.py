@@ -0,0 +1,369 @@
+from array import array
+from tokens import *
+from model import *
+import marshal
+
+###############################################################################
+# Flat AST storage
+#
+# An Arena keeps a whole tree in a few typed arrays instead of one object per
+# node. Node i has a kind, a line, an operator token type and up to four
+# integer fields a, b, c and d, whose meaning depends on the kind:
+#
+#      Integer, Float, Bool, String, Identifier   a: literal index
+#      UnOp                                       op, a: operand
+#      BinOp, LogicalOp                           op, a: left, b: right
+#      Grouping, RetStmt, FuncCallStmt, Param     a: child
+#      Stmts                                      a: first item, b: item count
+#      PrintStmt                                  a: value, b: 1 for println
+#      IfStmt                                     a: cond, b: then, c: else
+#      WhileStmt, Assignment, LocalAssignment     a, b: children
+#      ForStmt                                    a: assign, b: cond, c: step, d: do
+#      FuncDecl                                   a: name, b: first param, c: param count, d: body
+#      FuncCall                                   a: name, b: first arg, c: arg count
+#
+# Missing children are -1. Variable-length child lists are stored back to
+# back in the items array, and literal values (numbers, strings, names) are
+# deduplicated in the literals list.
+#
+# The Arena has one builder method per node type, named after the model
+# class, so Parser(tokens, arena) builds into it and returns node indexes.
+# arena.node(i) returns a light view of node i that is an instance of the
+# model class, so the compiler, the interpreter and the pretty printer walk
+# an arena the same way as a tree of objects.
+###############################################################################
+NODE_INTEGER           = 0
+NODE_FLOAT             = 1
+NODE_BOOL              = 2
+NODE_STRING            = 3
+NODE_UNOP              = 4
+NODE_BINOP             = 5
+NODE_LOGICALOP         = 6
+NODE_GROUPING          = 7
+NODE_IDENTIFIER        = 8
+NODE_STMTS             = 9
+NODE_PRINTSTMT         = 10
+NODE_IFSTMT            = 11
+NODE_WHILESTMT         = 12
+NODE_ASSIGNMENT        = 13
+NODE_LOCALASSIGNMENT   = 14
+NODE_FORSTMT           = 15
+NODE_PARAM             = 16
+NODE_FUNCDECL          = 17
+NODE_FUNCCALL          = 18
+NODE_FUNCCALLSTMT      = 19
+NODE_RETSTMT           = 20
+
+ARENA_VERSION = 1
+
+# Lexemes of the operator tokens, to rebuild the op Token of a node
+op_lexemes = {token_type: lexeme for lexeme, token_type in symbols.items()}
+op_lexemes[TOK_AND] = 'and'
+op_lexemes[TOK_OR] = 'or'
+
+class Arena:
+    def __init__(self):
+        self.kinds = array('B')
+        self.lines = array('I')
+        self.ops = array('B')
+        self.a = array('i')
+        self.b = array('i')
+        self.c = array('i')
+        self.d = array('i')
+        self.items = array('i')
+        self.literals = []
+        self.literal_index = {}
+        pass
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def add(self, kind, line, op = 0, a = -1, b = -1, c = -1, d = -1):
+        self.kinds.append(kind)
+        self.lines.append(line)
+        self.ops.append(op)
+        self.a.append(a)
+        self.b.append(b)
+        self.c.append(c)
+        self.d.append(d)
+        return len(self.kinds) - 1
+
+    def add_literal(self, value):
+        # 1, 1.0 and true are equal as dict keys, so key on the type too
+        key = (type(value), value)
+        idx = self.literal_index.get(key)
+        if idx == None:
+            idx = len(self.literals)
+            self.literals.append(value)
+            self.literal_index[key] = idx
+        return idx
+
+    def add_items(self, nodes):
+        start = len(self.items)
+        self.items.extend(nodes)
+        return start
+
+    def literal(self, idx):
+        return self.literals[self.a[idx]]
+
+    def child_items(self, start, count):
+        return self.items[start:start + count]
+
+    def op_token(self, idx):
+        op = self.ops[idx]
+        return Token(op, op_lexemes[op], self.lines[idx])
+
+    def node(self, idx):
+        if idx == -1: return None
+        return view_types[self.kinds[idx]](self, idx)
+
+    ###########################################################################
+    # Builder interface used by the parser
+    ###########################################################################
+    def Integer(self, value, line):
+        return self.add(NODE_INTEGER, line, a=self.add_literal(value))
+
+    def Float(self, value, line):
+        return self.add(NODE_FLOAT, line, a=self.add_literal(value))
+
+    def Bool(self, value, line):
+        return self.add(NODE_BOOL, line, a=self.add_literal(value))
+
+    def String(self, value, line):
+        return self.add(NODE_STRING, line, a=self.add_literal(value))
+
+    def Identifier(self, name, line):
+        return self.add(NODE_IDENTIFIER, line, a=self.add_literal(name))
+
+    def UnOp(self, op, operand, line):
+        return self.add(NODE_UNOP, line, op.token_type, operand)
+
+    def BinOp(self, op, left, right, line):
+        return self.add(NODE_BINOP, line, op.token_type, left, right)
+
+    def LogicalOp(self, op, left, right, line):
+        return self.add(NODE_LOGICALOP, line, op.token_type, left, right)
+
+    def Grouping(self, value, line):
+        return self.add(NODE_GROUPING, line, a=value)
+
+    def Stmts(self, stmts, line):
+        return self.add(NODE_STMTS, line, a=self.add_items(stmts), b=len(stmts))
+
+    def PrintStmt(self, value, end, line):
+        return self.add(NODE_PRINTSTMT, line, a=value, b=1 if end == '\n' else 0)
+
+    def IfStmt(self, condition, then_stmts, else_stmts, line):
+        return self.add(NODE_IFSTMT, line, a=condition, b=then_stmts, c=-1 if else_stmts == None else else_stmts)
+
+    def WhileStmt(self, condition, do_stmts, line):
+        return self.add(NODE_WHILESTMT, line, a=condition, b=do_stmts)
+
+    def Assignment(self, left, right, line):
+        return self.add(NODE_ASSIGNMENT, line, a=left, b=right)
+
+    def LocalAssignment(self, left, right, line):
+        return self.add(NODE_LOCALASSIGNMENT, line, a=left, b=right)
+
+    def ForStmt(self, assignment, condition_val, step_val, do_stmts, line):
+        return self.add(NODE_FORSTMT, line, a=assignment, b=condition_val, c=-1 if step_val == None else step_val, d=do_stmts)
+
+    def Param(self, identifier, line):
+        return self.add(NODE_PARAM, line, a=identifier)
+
+    def FuncDecl(self, identifier, params, body_stmts, line):
+        return self.add(NODE_FUNCDECL, line, a=identifier, b=self.add_items(params), c=len(params), d=body_stmts)
+
+    def FuncCall(self, identifier, args, line):
+        return self.add(NODE_FUNCCALL, line, a=identifier, b=self.add_items(args), c=len(args))
+
+    def FuncCallStmt(self, func_call):
+        return self.add(NODE_FUNCCALLSTMT, self.lines[func_call], a=func_call)
+
+    def RetStmt(self, value, line):
+        return self.add(NODE_RETSTMT, line, a=value)
+
+    ###########################################################################
+    # Serialization
+    ###########################################################################
+    def to_bytes(self):
+        columns = [self.kinds, self.lines, self.ops, self.a, self.b, self.c, self.d, self.items]
+        return marshal.dumps((ARENA_VERSION, [column.tobytes() for column in columns], self.literals))
+
+    @staticmethod
+    def from_bytes(data):
+        version, columns, literals = marshal.loads(data)
+        if version != ARENA_VERSION:
+            raise ValueError(f'Unsupported arena version {version}')
+        arena = Arena()
+        for column, raw in zip([arena.kinds, arena.lines, arena.ops, arena.a, arena.b, arena.c, arena.d, arena.items], columns):
+            column.frombytes(raw)
+        for literal in literals:
+            arena.add_literal(literal)
+        return arena
+
+###############################################################################
+# Views of arena nodes as model nodes
+###############################################################################
+class ArenaView:
+    __slots__ = ()
+
+    def __init__(self, arena, idx):
+        self.arena = arena
+        self.idx = idx
+
+    @property
+    def line(self):
+        return self.arena.lines[self.idx]
+
+    def children(self):
+        return [child for child in self.child_nodes() if child != None]
+
+    # Every access builds a new view, views of the same node are equal so
+    # they can key a dict like node objects do
+    def __eq__(self, other):
+        if isinstance(other, ArenaView):
+            return self.arena is other.arena and self.idx == other.idx
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self.arena), self.idx))
+
+def view_child(column):
+    return property(lambda self: self.arena.node(getattr(self.arena, column)[self.idx]))
+
+def view_items(start, count):
+    return property(lambda self: [self.arena.node(item) for item in self.arena.child_items(getattr(self.arena, start)[self.idx], getattr(self.arena, count)[self.idx])])
+
+view_literal = property(lambda self: self.arena.literal(self.idx))
+view_op = property(lambda self: self.arena.op_token(self.idx))
+
+class ArenaInteger(ArenaView, Integer):
+    __slots__ = ('arena', 'idx')
+    value = view_literal
+    def child_nodes(self): return []
+
+class ArenaFloat(ArenaView, Float):
+    __slots__ = ('arena', 'idx')
+    value = view_literal
+    def child_nodes(self): return []
+
+class ArenaBool(ArenaView, Bool):
+    __slots__ = ('arena', 'idx')
+    value = view_literal
+    def child_nodes(self): return []
+
+class ArenaString(ArenaView, String):
+    __slots__ = ('arena', 'idx')
+    value = view_literal
+    def child_nodes(self): return []
+
+class ArenaIdentifier(ArenaView, Identifier):
+    __slots__ = ('arena', 'idx')
+    name = view_literal
+    def child_nodes(self): return []
+
+class ArenaUnOp(ArenaView, UnOp):
+    __slots__ = ('arena', 'idx')
+    op = view_op
+    operand = view_child('a')
+    def child_nodes(self): return [self.operand]
+
+class ArenaBinOp(ArenaView, BinOp):
+    __slots__ = ('arena', 'idx')
+    op = view_op
+    left = view_child('a')
+    right = view_child('b')
+    def child_nodes(self): return [self.left, self.right]
+
+class ArenaLogicalOp(ArenaView, LogicalOp):
+    __slots__ = ('arena', 'idx')
+    op = view_op
+    left = view_child('a')
+    right = view_child('b')
+    def child_nodes(self): return [self.left, self.right]
+
+class ArenaGrouping(ArenaView, Grouping):
+    __slots__ = ('arena', 'idx')
+    value = view_child('a')
+    def child_nodes(self): return [self.value]
+
+class ArenaStmts(ArenaView, Stmts):
+    __slots__ = ('arena', 'idx')
+    stmts = view_items('a', 'b')
+    def child_nodes(self): return self.stmts
+
+class ArenaPrintStmt(ArenaView, PrintStmt):
+    __slots__ = ('arena', 'idx')
+    value = view_child('a')
+    end = property(lambda self: '\n' if self.arena.b[self.idx] else '')
+    def child_nodes(self): return [self.value]
+
+class ArenaIfStmt(ArenaView, IfStmt):
+    __slots__ = ('arena', 'idx')
+    condition = view_child('a')
+    then_stmts = view_child('b')
+    else_stmts = view_child('c')
+    def child_nodes(self): return [self.condition, self.then_stmts, self.else_stmts]
+
+class ArenaWhileStmt(ArenaView, WhileStmt):
+    __slots__ = ('arena', 'idx')
+    condition = view_child('a')
+    do_stmts = view_child('b')
+    def child_nodes(self): return [self.condition, self.do_stmts]
+
+class ArenaAssignment(ArenaView, Assignment):
+    __slots__ = ('arena', 'idx')
+    left = view_child('a')
+    right = view_child('b')
+    def child_nodes(self): return [self.left, self.right]
+
+class ArenaLocalAssignment(ArenaView, LocalAssignment):
+    __slots__ = ('arena', 'idx')
+    left = view_child('a')
+    right = view_child('b')
+    def child_nodes(self): return [self.left, self.right]
+
+class ArenaForStmt(ArenaView, ForStmt):
+    __slots__ = ('arena', 'idx')
+    assignment = view_child('a')
+    condition_val = view_child('b')
+    step_val = view_child('c')
+    do_stmts = view_child('d')
+    def child_nodes(self): return [self.assignment, self.condition_val, self.step_val, self.do_stmts]
+
+class ArenaParam(ArenaView, Param):
+    __slots__ = ('arena', 'idx')
+    identifier = view_child('a')
+    def child_nodes(self): return [self.identifier]
+
+class ArenaFuncDecl(ArenaView, FuncDecl):
+    __slots__ = ('arena', 'idx')
+    identifier = view_child('a')
+    params = view_items('b', 'c')
+    body_stmts = view_child('d')
+    def child_nodes(self): return [self.identifier] + self.params + [self.body_stmts]
+
+class ArenaFuncCall(ArenaView, FuncCall):
+    __slots__ = ('arena', 'idx')
+    identifier = view_child('a')
+    args = view_items('b', 'c')
+    def child_nodes(self): return [self.identifier] + self.args
+
+class ArenaFuncCallStmt(ArenaView, FuncCallStmt):
+    __slots__ = ('arena', 'idx')
+    func_call = view_child('a')
+    def child_nodes(self): return [self.func_call]
+
+class ArenaRetStmt(ArenaView, RetStmt):
+    __slots__ = ('arena', 'idx')
+    value = view_child('a')
+    def child_nodes(self): return [self.value]
+
+view_types = [
+    ArenaInteger, ArenaFloat, ArenaBool, ArenaString, ArenaUnOp, ArenaBinOp,
+    ArenaLogicalOp, ArenaGrouping, ArenaIdentifier, ArenaStmts, ArenaPrintStmt,
+    ArenaIfStmt, ArenaWhileStmt, ArenaAssignment, ArenaLocalAssignment,
+    ArenaForStmt, ArenaParam, ArenaFuncDecl, ArenaFuncCall, ArenaFuncCallStmt,
+    ArenaRetStmt
+]
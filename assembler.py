@@ -0,0 +1,89 @@
+from utils import *
+
+# The assembler links the instruction list built by the compiler into the
+# program run by the VM:
+#
+#      ('LABEL', name)             # Removed, the label is kept in the side table
+#      ('SET_SLOT', slot)          # Removed, the (idx, name) slot is kept in the side table
+#      ('JMP', name)               # Becomes ('JMP', pc)
+#      ('JMPZ', name)              # Becomes ('JMPZ', pc), also JMPZ_KEEP and JMPNZ_KEEP
+#      ('JSR', name)               # Becomes ('JSR', pc)
+#      ('TAILJSR', name)           # Becomes ('TAILJSR', pc)
+#      ('JMP_IF_NOT_LT', name)     # Becomes ('JMP_IF_NOT_LT', pc), and so on
+#      ('FOR_LOOP', name, idx)     # Becomes ('FOR_LOOP', pc, idx), also FOR_PREP
+#      ('PUSH', value)             # Becomes ('PUSH_CONST', idx) of the value in the constant pool
+#
+# The constant pool holds each distinct value pushed by the program once, in
+# order of first use. Every other instruction is copied as it is. Operands after the label of a
+# jump are kept, and another backend passes its own set of jump opcodes
+# (see regcompiler.py).
+
+pseudo_opcodes = {'LABEL', 'SET_SLOT'}
+
+# Sets of stack VM opcodes, also used by the passes over the instruction list
+# (peephole.py, cfg.py), so a new opcode is only added here:
+#
+#      jump_opcodes      take a label as their first operand
+#      call_opcodes      jump into a function body
+#      branch_opcodes    jump or fall through to the next instruction
+#      exit_opcodes      never fall through to the next instruction
+#      compare_opcodes   push whether two values compare, as a bool
+jump_opcodes = {
+    'JMP', 'JMPZ', 'JMPZ_KEEP', 'JMPNZ_KEEP', 'JSR', 'TAILJSR', 'JMP_IF_NOT_LT', 'JMP_IF_NOT_LE', 'JMP_IF_NOT_GT', 'JMP_IF_NOT_GE',
+    'JMP_IF_NOT_LT_NUM', 'JMP_IF_NOT_LE_NUM', 'JMP_IF_NOT_GT_NUM', 'JMP_IF_NOT_GE_NUM', 'FOR_PREP', 'FOR_LOOP'}
+
+call_opcodes = {'JSR', 'TAILJSR'}
+
+branch_opcodes = jump_opcodes - call_opcodes - {'JMP'}
+
+exit_opcodes = {'JMP', 'TAILJSR', 'RTS', 'HALT'}
+
+compare_opcodes = {'LT', 'LE', 'GT', 'GE', 'EQ', 'NE', 'LT_NUM', 'LE_NUM', 'GT_NUM', 'GE_NUM', 'EQ_NUM', 'NE_NUM'}
+
+class Program:
+    def __init__(self, code, labels, slots, consts):
+        self.code = code
+        self.labels = labels  # label name -> pc
+        self.slots = slots    # pc -> [(idx, name)] of the locals declared there
+        self.consts = consts  # constant pool, indexed by PUSH_CONST
+
+    def label_names(self):
+        names = {}
+        for name, pc in self.labels.items():
+            names.setdefault(pc, []).append(name)
+        return names
+
+def assemble(instructions, jumps = jump_opcodes):
+    labels = {}
+    slots = {}
+    pc = 0
+    for instruction in instructions:
+        if instruction[0] == 'LABEL':
+            labels[instruction[1]] = pc
+        elif instruction[0] == 'SET_SLOT':
+            slots.setdefault(pc, []).append(instruction[1])
+        else:
+            pc += 1
+
+    code = []
+    consts = []
+    const_idx = {}
+    for idx, instruction in enumerate(instructions):
+        opcode = instruction[0]
+        if opcode in pseudo_opcodes:
+            continue
+        elif opcode == 'PUSH':
+            value = instruction[1]
+            # Numbers keep their Python type, so 1 and 1.0 are pooled apart
+            key = (value[0], value[1].__class__, value[1])
+            if key not in const_idx:
+                const_idx[key] = len(consts)
+                consts.append(value)
+            instruction = ('PUSH_CONST', const_idx[key])
+        elif opcode in jumps:
+            if instruction[1] not in labels:
+                assemble_error(f'Undefined label {instruction[1]}', idx)
+            instruction = (opcode, labels[instruction[1]]) + instruction[2:]
+        code.append(instruction)
+
+    return Program(code, labels, slots, consts)
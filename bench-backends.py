@@ -0,0 +1,80 @@
+import sys
+import io
+import time
+import contextlib
+from collections import Counter
+from lexer import *
+from parser import *
+from optimizer import *
+from compiler import *
+from peephole import *
+from assembler import *
+from vm import *
+from regcompiler import *
+from regvm import *
+
+# Usage: python3 bench-backends.py [script ...]
+#
+# Compiles each script for the stack VM (inlining and peephole optimizer on,
+# as pinky.py runs it) and for the register machine, and compares the program
+# size, the number of instructions dispatched and the best wall time of three
+# runs of each backend. Checks that both print the same output.
+
+SCRIPTS = [
+    'scripts/mandel-while.pinky', 'scripts/mandel.pinky', 'scripts/calls.pinky', 'scripts/loops.pinky', 'scripts/nested-for.pinky',
+    'scripts/guards.pinky']
+
+class CountingVM(VM):
+    def run(self, program):
+        instructions = program.code
+        self.consts = program.consts
+        self.count = 0
+        self.is_running = True
+        while self.is_running:
+            opcode, *args = instructions[self.pc]
+            self.count += 1
+            self.pc += 1
+            getattr(self, opcode)(*args)
+
+class CountingRegisterVM(RegisterVM):
+    def run(self, program):
+        instructions = program.code
+        self.templates = program.templates
+        self.pc = program.labels['START']
+        self.regs = list(self.templates[self.pc])
+        self.count = 0
+        self.is_running = True
+        while self.is_running:
+            opcode, *args = instructions[self.pc]
+            self.count += 1
+            self.pc += 1
+            getattr(self, opcode)(*args)
+
+def parse(source):
+    return optimize(Parser(Lexer(source).tokenize()).parse())
+
+def run(vm, program):
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        vm.run(program)
+    return time.perf_counter() - start, output.getvalue()
+
+if __name__ == '__main__':
+    for filename in sys.argv[1:] or SCRIPTS:
+        with open(filename) as file:
+            source = file.read()
+        stack = assemble(PeepholeOptimizer().optimize(Compiler(inline_limit = INLINE_LIMIT, hoist_invariants = True).generate_code(parse(source))))
+        compiler = RegisterCompiler()
+        register = assemble_registers(compiler.generate_code(parse(source)), compiler.templates)
+
+        print(f'{filename}:')
+        outputs = []
+        for name, vm_type, counting_type, program in [('stack', VM, CountingVM, stack), ('register', RegisterVM, CountingRegisterVM, register)]:
+            vm = counting_type()
+            _, output = run(vm, program)
+            outputs.append(output)
+            elapsed = min(run(vm_type(), program)[0] for _ in range(3))
+            print(f'  {name:>8}: {len(program.code):4} instructions, {vm.count:>11,} dispatched, {elapsed:.3f}s')
+        if outputs[0] != outputs[1]:
+            print('  outputs differ')
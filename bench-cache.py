@@ -0,0 +1,50 @@
+import sys
+import io
+import os
+import time
+import tempfile
+import contextlib
+import pinky
+from cache import *
+
+# Usage: python3 bench-cache.py [script ...]
+#
+# Compares the cold start of each script, lexing, parsing, compiling and
+# assembling it and writing the .pkc file as pinky.py does on a cache miss,
+# with the warm start, loading the program from the .pkc file. Reports the
+# best time of ten runs of each for both backends and the size of the file.
+# Programs are not run.
+
+SCRIPTS = ['scripts/mandel-while.pinky', 'scripts/calls.pinky', 'scripts/loops.pinky', 'scripts/guards.pinky', 'scripts/myscript.pinky']
+RUNS = 10
+
+def cold_start(source, path, key, backend):
+    with contextlib.redirect_stdout(io.StringIO()):
+        program = pinky.compile_source(source, 2, backend)
+    store_program(path, key, program)
+    return program
+
+def best_time(function, *args):
+    best = None
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+if __name__ == '__main__':
+    pinky.DEBUG = False
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for filename in sys.argv[1:] or SCRIPTS:
+            with open(filename) as file:
+                source = file.read()
+            print(f'{filename}:')
+            for backend in pinky.BACKENDS:
+                path = cache_path(filename, cache_dir)
+                key = source_key(source, 2, backend)
+                cold = best_time(cold_start, source, path, key, backend)
+                warm = best_time(load_program, path, key)
+                size = os.path.getsize(path)
+                print(f'  {backend:>8}: cold {cold * 1000:7.2f}ms, warm {warm * 1000:6.3f}ms, {cold / warm:6.1f}x, {size:6,} bytes')
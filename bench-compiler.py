@@ -0,0 +1,96 @@
+import sys
+import time
+import marshal
+from lexer import *
+from parser import *
+from optimizer import *
+from compiler import *
+from assembler import *
+
+# Usage: python3 bench-compiler.py [count ...]
+#
+# Compiles generated scripts with count globals, each one read by the next
+# assignment, and with count locals in one function, and reports the compile
+# time and the time per variable. With constant time symbol lookups the time
+# per variable stays flat as count grows.
+#
+# Then compiles a library of 100 functions of which the main program uses
+# only four, without and with dead code elimination, and reports the program
+# size and the number of labels left after assembly.
+#
+# Last compiles a generated script with count lines of number and string
+# literals and compares the pushed values with the constant pool of the
+# assembled program against one value per PUSH, as the compiler emitted them
+# before literals were pooled: the memory the values take and the size of
+# the program marshalled as in a .pkc file.
+
+def make_globals(count):
+    lines = ['v0 := 0']
+    lines += [f'v{i} := v{i - 1} + 1' for i in range(1, count)]
+    return '\n'.join(lines)
+
+def make_locals(count):
+    lines = ['func f()', 'local v0 := 0']
+    lines += [f'local v{i} := v{i - 1} + 1' for i in range(1, count)]
+    lines += [f'ret v{count - 1}', 'end', 'println f()']
+    return '\n'.join(lines)
+
+def make_library(count):
+    funcs = ['func lib0(n) ret n end']
+    for i in range(1, count):
+        funcs.append(f'''func lib{i}(n)
+  local total := 0
+  for i := 1, 10 do
+    total := total + n * i
+  end
+  if total > 100 then ret lib{i - 1}(n - 1) end
+  ret total
+end''')
+    return '\n'.join(funcs) + '\nfunc main() ret lib3(3) end\nprintln main()'
+
+def make_constants(count):
+    lines = ['total := 0', 'name := ""']
+    for i in range(count):
+        lines.append(f'total := total * 0.5 + {i % 16} - 1.5')
+        lines.append(f'if total > 100 then name := "big" + {i % 8} else name := "small" end')
+    lines.append('println name + total')
+    return '\n'.join(lines)
+
+def value_size(value):
+    return sys.getsizeof(value) + sys.getsizeof(value[1])
+
+def bench_constants(count):
+    program = assemble(Compiler().generate_code(Parser(Lexer(make_constants(count)).tokenize()).parse()))
+    pushes = [instruction for instruction in program.code if instruction[0] == 'PUSH_CONST']
+    # A copy of each value per PUSH, like the compiler built them
+    inline = [('PUSH', marshal.loads(marshal.dumps(program.consts[instruction[1]]))) if instruction[0] == 'PUSH_CONST' else instruction for instruction in program.code]
+    memory = sum(value_size(instruction[1]) for instruction in inline if instruction[0] == 'PUSH')
+    pooled = sum(value_size(value) for value in program.consts) + sum(sys.getsizeof(instruction[1]) for instruction in pushes if instruction[1] > 256)
+    inline_size = len(marshal.dumps(inline))
+    pooled_size = len(marshal.dumps((program.code, program.consts)))
+    print(f'constants {count:>6}: {len(pushes)} pushes, {len(program.consts)} pooled, '
+          f'values {memory / 1024:.0f}K -> {pooled / 1024:.1f}K, marshalled {inline_size / 1024:.0f}K -> {pooled_size / 1024:.0f}K')
+
+def bench_compile(source):
+    ast = Parser(Lexer(source).tokenize()).parse()
+    start = time.perf_counter()
+    Compiler().generate_code(ast)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 20000, 50000, 100000]
+    for name, make_source in [('globals', make_globals), ('locals', make_locals)]:
+        for count in counts:
+            elapsed = bench_compile(make_source(count))
+            print(f'{name:>7} {count:>7}: {elapsed:.3f}s, {elapsed / count * 1e6:.2f}us per variable')
+
+    source = make_library(100)
+    for name, passes in [('library', lambda ast: ast), ('optimized', optimize)]:
+        start = time.perf_counter()
+        instructions = Compiler().generate_code(passes(Parser(Lexer(source).tokenize()).parse()))
+        elapsed = time.perf_counter() - start
+        program = assemble(instructions)
+        print(f'{name:>9}: {len(instructions)} instructions, {len(program.code)} assembled, {len(program.labels)} labels, {elapsed:.3f}s')
+
+    for count in counts[:2]:
+        bench_constants(count)
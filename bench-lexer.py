@@ -0,0 +1,58 @@
+import sys
+import time
+import tracemalloc
+from lexer import *
+
+# Usage: python3 bench-lexer.py [copies]
+#
+# Lexes a large source built from copies of the sample scripts with each
+# lexer engine and reports the throughput in tokens per second, compares
+# the memory held per token by a Token list and a TokenStore, and times the
+# chunked lexer with 1, 2, 4 and 8 worker processes.
+
+def make_source(copies):
+    parts = []
+    for filename in ['scripts/myscript.pinky', 'scripts/mandel.pinky']:
+        with open(filename) as file:
+            parts.append(file.read())
+    return '\n'.join(parts) * copies
+
+def bench(source, engine, repeat = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tokens = Lexer(source, engine).tokenize()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best: best = elapsed
+    return len(tokens), best
+
+def bench_memory(source, tokenize):
+    tracemalloc.start()
+    tokens = tokenize(source)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(tokens), size
+
+if __name__ == '__main__':
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    source = make_source(copies)
+    print(f'source: {len(source)} chars, {source.count(chr(10))} lines')
+    for engine in [LEXER_SCAN, LEXER_REGEX]:
+        count, elapsed = bench(source, engine)
+        print(f'{engine:>6}: {count} tokens in {elapsed:.3f}s, {count / elapsed:,.0f} tokens/s')
+
+    start = time.perf_counter()
+    count = len(Lexer(source).tokenize_compact())
+    elapsed = time.perf_counter() - start
+    print(f'{"store":>6}: {count} tokens in {elapsed:.3f}s, {count / elapsed:,.0f} tokens/s')
+
+    for name, tokenize in [('list', lambda source: Lexer(source).tokenize()),
+                           ('store', lambda source: Lexer(source).tokenize_compact())]:
+        count, size = bench_memory(source, tokenize)
+        print(f'{name:>6}: {size / count:.1f} bytes/token')
+
+    for workers in [1, 2, 4, 8]:
+        start = time.perf_counter()
+        count = len(Lexer(source).tokenize_compact(workers))
+        elapsed = time.perf_counter() - start
+        print(f'{workers:>2} workers: {count} tokens in {elapsed:.3f}s, {count / elapsed:,.0f} tokens/s')
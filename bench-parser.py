@@ -0,0 +1,87 @@
+import sys
+import time
+import tracemalloc
+from lexer import *
+from parser import *
+from arena import *
+from compiler import *
+
+# Usage: python3 bench-parser.py [copies]
+#
+# Parses a large expression-heavy source, built from copies of
+# scripts/mandel.pinky, with the precedence climbing Parser and with the
+# reference ChainParser and reports the throughput in tokens per second.
+# Then reports parse time and AST memory with node validation on and off,
+# and when building a flat Arena. Finally compares eager and lazy parsing of
+# a prelude of functions of which only one is called.
+
+def make_source(copies):
+    with open('scripts/mandel.pinky') as file:
+        return file.read() * copies
+
+prelude_body = '''
+    local i := 0
+    local total := 0
+    while i < n do
+        if i % 3 == 0 or i % 5 == 0 then
+            total := total + i * i - (i / 2) ^ 2
+        else
+            total := total - 1
+        end
+        i := i + 1
+    end
+    ret total
+'''
+
+def make_prelude(copies):
+    body = prelude_body * 8
+    funcs = [f'func lib{i}(n)\n{body}\nend\n' for i in range(copies)]
+    return ''.join(funcs) + 'println lib0(10)\n'
+
+def bench_parse(parser_type, tokens, repeat = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        parser_type(tokens).parse()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best: best = elapsed
+    return best
+
+def ast_memory(tokens, ast = model):
+    tracemalloc.start()
+    root = Parser(tokens, ast).parse()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size
+
+if __name__ == '__main__':
+    copies = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    source = make_source(copies)
+    tokens = Lexer(source).tokenize()
+    print(f'source: {len(source)} chars, {len(tokens)} tokens')
+    for parser_type in [ChainParser, Parser]:
+        elapsed = bench_parse(parser_type, tokens)
+        print(f'{parser_type.__name__:>11}: {elapsed:.3f}s, {len(tokens) / elapsed:,.0f} tokens/s')
+
+    tokens = Lexer(source).tokenize_compact()
+    for validate in [True, False]:
+        set_validation(validate)
+        elapsed = bench_parse(Parser, tokens)
+        size = ast_memory(tokens)
+        print(f'validation {"on" if validate else "off":>3}: parse {elapsed:.3f}s, AST {size / 1024 / 1024:.2f} MiB')
+
+    start = time.perf_counter()
+    arena = Arena()
+    Parser(tokens, arena).parse()
+    elapsed = time.perf_counter() - start
+    size = ast_memory(tokens, Arena())
+    print(f'arena:          parse {elapsed:.3f}s, AST {size / 1024 / 1024:.2f} MiB, {len(arena)} nodes, {len(arena.to_bytes()) / 1024 / 1024:.2f} MiB serialized')
+
+
+    source = make_prelude(copies)
+    tokens = Lexer(source).tokenize_compact()
+    for lazy in [False, True]:
+        start = time.perf_counter()
+        Compiler().generate_code(Parser(tokens, lazy = lazy).parse())
+        elapsed = time.perf_counter() - start
+        print(f'{"lazy" if lazy else "eager":>5} prelude: parse and compile {elapsed:.3f}s')
@@ -0,0 +1,142 @@
+import sys
+import io
+import time
+import contextlib
+from collections import Counter
+from lexer import *
+from parser import *
+from optimizer import *
+from compiler import *
+from peephole import *
+from assembler import *
+from vm import *
+from cfg import *
+
+# Usage: python3 bench-vm.py [script]
+#
+# Compiles a script (scripts/mandel-while.pinky by default) and runs it on
+# the VM, counting the instructions dispatched per run. The run is repeated
+# on the unassembled compiler output, which still dispatches LABEL and
+# SET_SLOT and looks jump targets up by label name, to compare against, and
+# on the program compiled from the optimized AST, after the peephole
+# optimizer without and with superinstructions, and with small functions
+# inlined as well (scripts/calls.pinky is call heavy, scripts/guards.pinky
+# has guard heavy and/or conditions). Prints the per-pass
+# statistics of the peephole optimizer and the most frequent opcode pairs
+# dispatched before superinstructions, which they are chosen from.
+#
+# Last compares the optimization levels of pinky.py: the time from source to
+# assembled program against the best time of three runs.
+
+class CountingVM(VM):
+    def run(self, program):
+        if not isinstance(program, Program):
+            program = assemble(program)
+        instructions = program.code
+        self.consts = program.consts
+
+        self.counts = Counter()
+        self.pairs = Counter()
+        previous = None
+        self.is_running = True
+        while self.is_running:
+            opcode, *args = instructions[self.pc]
+            self.counts[opcode] += 1
+            self.pairs[(previous, opcode)] += 1
+            previous = opcode
+            self.pc += 1
+            getattr(self, opcode)(*args)
+
+class UnassembledVM(CountingVM):
+    def run(self, instructions):
+        self.labels = {}
+        for idx, instruction in enumerate(instructions):
+            if instruction[0] == 'LABEL':
+                self.labels[instruction[1]] = idx
+        super().run(Program(instructions, {}, {}, []))
+
+    def LABEL(self, _):
+        pass
+
+    def SET_SLOT(self, _):
+        pass
+
+    def JMP(self, name):
+        super().JMP(self.labels[name])
+
+    def JMPZ(self, name):
+        super().JMPZ(self.labels[name])
+
+    def JMPZ_KEEP(self, name):
+        super().JMPZ_KEEP(self.labels[name])
+
+    def JMPNZ_KEEP(self, name):
+        super().JMPNZ_KEEP(self.labels[name])
+
+    def JSR(self, name):
+        super().JSR(self.labels[name])
+
+    def TAILJSR(self, name):
+        super().TAILJSR(self.labels[name])
+
+    def FOR_PREP(self, name, idx, default_step):
+        super().FOR_PREP(self.labels[name], idx, default_step)
+
+    def FOR_LOOP(self, name, idx):
+        super().FOR_LOOP(self.labels[name], idx)
+
+def compile_level(source, level):
+    ast = Parser(Lexer(source).tokenize()).parse()
+    if level >= 1:
+        ast = optimize(ast)
+    instructions = make_compiler(level).generate_code(ast)
+    return assemble(make_pass_manager(level).run(instructions))
+
+def run(vm, program):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        vm.run(program)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'scripts/mandel-while.pinky'
+    with open(filename) as file:
+        source = file.read()
+    instructions = Compiler().generate_code(Parser(Lexer(source).tokenize()).parse())
+    optimized = Compiler(hoist_invariants = True).generate_code(optimize(Parser(Lexer(source).tokenize()).parse()))
+    inlined = Compiler(inline_limit = INLINE_LIMIT, hoist_invariants = True).generate_code(optimize(Parser(Lexer(source).tokenize()).parse()))
+    peephole = PeepholeOptimizer(superinstructions = False)
+    superinstructions = PeepholeOptimizer()
+    stages = [
+        ('unassembled', UnassembledVM, instructions),
+        ('assembled', CountingVM, assemble(instructions)),
+        ('optimized', CountingVM, assemble(optimized)),
+        ('peephole', CountingVM, assemble(peephole.optimize(optimized))),
+        ('super', CountingVM, assemble(superinstructions.optimize(optimized))),
+        ('inlined', CountingVM, assemble(PeepholeOptimizer().optimize(inlined)))]
+
+    print(f'{filename}: {len(instructions)} instructions')
+    for name, count in superinstructions.stats.items():
+        print(f'  {name:>17}: {count}')
+
+    for name, vm_type, code in stages:
+        size = len(code) if name == 'unassembled' else len(code.code)
+        vm = vm_type()
+        counted = run(vm, code)
+        total = sum(vm.counts.values())
+        pseudo = vm.counts['LABEL'] + vm.counts['SET_SLOT']
+        elapsed = f'{run(VM(), code):.3f}s' if vm_type == CountingVM else '-'
+        print(f'{name:>11}: {size:4} instructions, {total:>11,} dispatched ({pseudo:,} LABEL/SET_SLOT), {counted:.3f}s counting, {elapsed} VM')
+        if name == 'peephole':
+            pairs = vm.pairs
+
+    print('most frequent pairs after peephole:')
+    for (first, second), count in pairs.most_common(10):
+        print(f'  {first:>12} {second:<12} {count:>9,} {count / sum(pairs.values()):6.1%}')
+
+    print('optimization levels:')
+    for level in OPT_LEVELS:
+        start = time.perf_counter()
+        program = compile_level(source, level)
+        compiled = time.perf_counter() - start
+        print(f'  -O{level}: {len(program.code):4} instructions, {compiled * 1000:7.2f}ms compile, {min(run(VM(), program) for _ in range(3)):.3f}s VM')
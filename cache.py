@@ -0,0 +1,109 @@
+import os
+import marshal
+import hashlib
+import tempfile
+from assembler import *
+
+# Compiled programs are cached on disk in .pkc files, so a script that did
+# not change is loaded instead of lexed, parsed and compiled again. A file
+# holds one assembled program:
+#
+#      magic        b'PKC' and the format version, one byte
+#      payload      marshal of (key, code, labels, slots, consts, templates)
+#
+# The key hashes the source, the options it was compiled with and the
+# source files of the compiler and the VMs, so editing either makes the cached
+# program stale. A file that is stale, of another format or unreadable is
+# compiled again and replaced. Files are written to a temporary file in the
+# same directory and renamed over the old one, so a process that reads the
+# cache while another one writes it sees either file whole.
+
+PKC_FORMAT = 2
+PKC_MAGIC = b'PKC' + bytes([PKC_FORMAT])
+
+# The VMs are hashed with the compiler: they define the opcodes and operands
+# a cached program is made of
+COMPILER_SOURCES = [
+    'tokens.py', 'lexer.py', 'model.py', 'parser.py', 'optimizer.py', 'state.py', 'compiler.py',
+    'peephole.py', 'cfg.py', 'assembler.py', 'regcompiler.py', 'vm.py', 'regvm.py', 'defs.py',
+    'utils.py']
+
+_compiler_version = None
+
+def compiler_version():
+    # Hash of the compiler's source files, read once per process
+    global _compiler_version
+    if _compiler_version == None:
+        digest = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in COMPILER_SOURCES:
+            with open(os.path.join(directory, name), 'rb') as file:
+                digest.update(file.read())
+        _compiler_version = digest.hexdigest()
+    return _compiler_version
+
+def source_key(source, *options):
+    digest = hashlib.sha256(source.encode('utf-8'))
+    digest.update(repr(options).encode('utf-8'))
+    digest.update(compiler_version().encode('utf-8'))
+    return digest.hexdigest()
+
+def cache_path(filename, cache_dir = None):
+    # script.pinky caches to script.pkc next to it. In a cache directory the
+    # name also hashes the script's path, so scripts with the same name in
+    # different directories do not share a file.
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    if cache_dir == None:
+        return os.path.join(os.path.dirname(filename), stem + '.pkc')
+    path_hash = hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{stem}-{path_hash}.pkc')
+
+def load_program(path, key):
+    # The program cached at path under key, or None
+    try:
+        with open(path, 'rb') as file:
+            data = file.read()
+    except OSError:
+        return None
+    if not data.startswith(PKC_MAGIC):
+        return None
+    try:
+        cached_key, code, labels, slots, consts, templates = marshal.loads(data[len(PKC_MAGIC):])
+    except (EOFError, ValueError, TypeError):
+        return None
+    if cached_key != key:
+        return None
+    program = Program(code, labels, slots, consts)
+    if templates != None:
+        program.templates = templates
+    return program
+
+def file_mode():
+    # Mode of a new file created with open(). mkstemp makes files that only
+    # their owner can read, which would keep a shared cache directory from
+    # being shared.
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+def store_program(path, key, program):
+    # Writes the program atomically, returns False if it could not be written
+    payload = marshal.dumps((key, program.code, program.labels, program.slots, program.consts, getattr(program, 'templates', None)))
+    directory = os.path.dirname(path) or '.'
+    try:
+        os.makedirs(directory, exist_ok = True)
+        fd, temp_path = tempfile.mkstemp(dir = directory, prefix = '.pkc-', suffix = '.tmp')
+    except OSError:
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(PKC_MAGIC + payload)
+        os.chmod(temp_path, file_mode())
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        return False
+    return True
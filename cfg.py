@@ -0,0 +1,503 @@
+import time
+from defs import *
+from assembler import *
+from peephole import *
+from compiler import NO_TYPE, join_types, Compiler, INLINE_LIMIT
+
+# Control-flow graph over the instruction list of the compiler, the layer
+# where the optimization passes of -O2 run. The instructions are split into
+# basic blocks: a block starts at a LABEL (a run of labels starts one block)
+# or after an instruction that jumps or leaves the function, and ends at the
+# next one. Its successors are the blocks it jumps to and the block it falls
+# through to. JSR is not an edge: a function body is a graph of its own,
+# entered at its label.
+#
+# Each block keeps what it reads and writes before anything else in the
+# block does:
+#
+#      global_uses, global_defs    global slots (LOAD_GLOBAL, STORE_GLOBAL)
+#      uses, defs                  stack slots of the frame, which hold the
+#                                  locals as well as the temporaries
+#
+# Passes are functions that rewrite the graph and return how many
+# instructions they changed, run in order by a PassManager. linearize()
+# puts the blocks back in order as an instruction list.
+
+binary_effect_opcodes = {
+    'ADD', 'SUB', 'MUL', 'DIV', 'MOD', 'EXP', 'XOR', 'LT', 'LE', 'GT', 'GE', 'EQ', 'NE',
+    'ADD_NUM', 'SUB_NUM', 'MUL_NUM', 'DIV_NUM', 'MOD_NUM', 'LT_NUM', 'LE_NUM', 'GT_NUM', 'GE_NUM', 'EQ_NUM', 'NE_NUM', 'CONCAT_STR'}
+
+class Block:
+    def __init__(self):
+        self.labels = []
+        self.instructions = []
+        self.succs = []
+        self.preds = []
+        self.global_uses = set()
+        self.global_defs = set()
+        self.uses = set()
+        self.defs = set()
+        # Stack height of the frame when the block starts, None if unknown
+        self.depth = None
+
+    def falls_through(self):
+        return not self.instructions or self.instructions[-1][0] not in exit_opcodes
+
+class CFG:
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.link()
+
+    def size(self):
+        return sum(len(block.instructions) for block in self.blocks)
+
+    def link(self):
+        # Recomputes the edges after the blocks changed
+        by_label = {label: block for block in self.blocks for label in block.labels}
+        self.entries = {'START'}
+        for block in self.blocks:
+            block.succs = []
+            block.preds = []
+        for idx, block in enumerate(self.blocks):
+            for instruction in block.instructions:
+                if instruction[0] in call_opcodes:
+                    self.entries.add(instruction[1])
+            if block.instructions and (block.instructions[-1][0] == 'JMP' or block.instructions[-1][0] in branch_opcodes):
+                block.succs.append(by_label[block.instructions[-1][1]])
+            if block.falls_through() and idx + 1 < len(self.blocks) and self.blocks[idx + 1] not in block.succs:
+                block.succs.append(self.blocks[idx + 1])
+            for succ in block.succs:
+                succ.preds.append(block)
+
+    def entry_blocks(self):
+        return [block for block in self.blocks if self.entries.intersection(block.labels)]
+
+def build_cfg(instructions):
+    blocks = []
+    block = None
+    for instruction in instructions:
+        if instruction[0] == 'LABEL':
+            if block == None or block.instructions:
+                block = Block()
+                blocks.append(block)
+            block.labels.append(instruction[1])
+            continue
+        if block == None:
+            block = Block()
+            blocks.append(block)
+        block.instructions.append(instruction)
+        if instruction[0] in exit_opcodes or instruction[0] in branch_opcodes:
+            block = None
+    return CFG(blocks)
+
+def linearize(cfg):
+    code = []
+    for block in cfg.blocks:
+        code += [('LABEL', label) for label in block.labels]
+        code += block.instructions
+    return code
+
+def arg_count(block, idx):
+    # Arguments of the call at idx, which the compiler pushes the count of
+    # right before it
+    previous = block.instructions[idx - 1] if idx > 0 else None
+    if previous != None and previous[0] == 'PUSH' and previous[1][0] == TYPE_NUMBER:
+        return int(previous[1][1])
+    return None
+
+def slot_effects(block, idx, depth):
+    # The stack slots of the frame that the instruction at idx reads and
+    # writes, and the stack height after it. None when it is not known.
+    instruction = block.instructions[idx]
+    opcode = instruction[0]
+    if opcode in ('PUSH', 'LOAD_GLOBAL'):
+        return (), (depth,), depth + 1
+    elif opcode == 'LOAD_LOCAL':
+        return (instruction[1],), (depth,), depth + 1
+    elif opcode == 'LOAD_LOCAL2':
+        return (instruction[1], instruction[2]), (depth, depth + 1), depth + 2
+    elif opcode in binary_effect_opcodes:
+        return (depth - 2, depth - 1), (depth - 2,), depth - 1
+    elif opcode in ('NEG', 'LOAD_CONST_ADD', 'LOAD_CONST_DIV'):
+        return (depth - 1,), (depth - 1,), depth
+    elif opcode == 'POP':
+        return (), (), depth - 1
+    elif opcode == 'POPN':
+        return (), (), depth - instruction[1]
+    elif opcode in ('STORE_GLOBAL', 'PRINT', 'PRINTLN', 'JMPZ', 'JMPZ_KEEP', 'JMPNZ_KEEP', 'RTS'):
+        return (depth - 1,), (), depth - 1
+    elif opcode == 'STORE_LOCAL':
+        return (depth - 1,), (instruction[1],), depth - 1
+    elif opcode == 'INC_LOCAL':
+        return (instruction[1],), (instruction[1],), depth
+    elif opcode.startswith('JMP_IF_NOT_'):
+        return (depth - 2, depth - 1), (), depth - 2
+    elif opcode == 'FOR_PREP':
+        # The variable, bound and step of the loop, and its direction
+        idx = instruction[2]
+        return (idx, idx + 1, idx + 2), (idx + 2, idx + 3) if instruction[3] else (idx + 3,), depth
+    elif opcode == 'FOR_LOOP':
+        idx = instruction[2]
+        return (idx, idx + 1, idx + 2, idx + 3), (idx,), depth
+    elif opcode in call_opcodes:
+        count = arg_count(block, idx)
+        if count == None:
+            return None
+        base = depth - count - 1
+        return tuple(range(base, depth)), (base,), base + 1
+    else:
+        # JMP, HALT and SET_SLOT, which names the slot pushed last
+        return (), (), depth
+
+def compute_depths(cfg):
+    # Stack height at the start of every block reachable from an entry.
+    # Functions start with their arguments. Returns False if a call or a
+    # block does not fit.
+    arities = {}
+    for block in cfg.blocks:
+        block.depth = None
+        for idx, instruction in enumerate(block.instructions):
+            if instruction[0] in call_opcodes:
+                arities[instruction[1]] = arg_count(block, idx)
+
+    pending = []
+    for block in cfg.entry_blocks():
+        label = next(label for label in block.labels if label in cfg.entries)
+        arity = 0 if label == 'START' else arities.get(label)
+        if arity == None:
+            return False
+        block.depth = arity
+        pending.append(block)
+
+    while pending:
+        block = pending.pop()
+        depth = block.depth
+        for idx in range(len(block.instructions)):
+            effects = slot_effects(block, idx, depth)
+            if effects == None:
+                return False
+            depth = effects[2]
+        for succ in block.succs:
+            # A kept value is still on the stack where the jump goes to
+            keeps = block.instructions and block.instructions[-1][0] in ('JMPZ_KEEP', 'JMPNZ_KEEP') and succ.labels and block.instructions[-1][1] in succ.labels
+            succ_depth = depth + 1 if keeps else depth
+            if succ.depth == None:
+                succ.depth = succ_depth
+                pending.append(succ)
+            elif succ.depth != succ_depth:
+                return False
+    return True
+
+def compute_def_use(cfg):
+    # Fills in the global and stack slot uses and defs of every block whose
+    # stack height is known
+    for block in cfg.blocks:
+        block.global_uses, block.global_defs = set(), set()
+        block.uses, block.defs = set(), set()
+        for instruction in block.instructions:
+            if instruction[0] == 'LOAD_GLOBAL' and instruction[1] not in block.global_defs:
+                block.global_uses.add(instruction[1])
+            elif instruction[0] == 'STORE_GLOBAL':
+                block.global_defs.add(instruction[1])
+        if block.depth == None:
+            continue
+        depth = block.depth
+        for idx in range(len(block.instructions)):
+            uses, defs, depth = slot_effects(block, idx, depth)
+            block.uses.update(slot for slot in uses if slot not in block.defs)
+            block.defs.update(defs)
+
+def compute_liveness(cfg):
+    # Stack slots that are read later on some path from the end of each
+    # block, iterated until nothing changes
+    live_in = {block: set(block.uses) for block in cfg.blocks}
+    live_out = {block: set() for block in cfg.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(cfg.blocks):
+            out = set()
+            for succ in block.succs:
+                out |= live_in[succ]
+            if out != live_out[block]:
+                live_out[block] = out
+                live_in[block] = block.uses | (out - block.defs)
+                changed = True
+    return live_out
+
+def remove_unreachable_blocks(cfg):
+    # Blocks that no path from START or a called function reaches. Nothing
+    # that is reached jumps to their labels, so they go as well.
+    by_label = {label: block for block in cfg.blocks for label in block.labels}
+    reached = set()
+    pending = cfg.entry_blocks()
+    while pending:
+        block = pending.pop()
+        if block in reached:
+            continue
+        reached.add(block)
+        pending += block.succs
+        pending += [by_label[instruction[1]] for instruction in block.instructions if instruction[0] in call_opcodes]
+
+    count = sum(len(block.instructions) for block in cfg.blocks if block not in reached)
+    if len(reached) != len(cfg.blocks):
+        cfg.blocks = [block for block in cfg.blocks if block in reached]
+        cfg.link()
+    return count
+
+def remove_dead_globals(cfg):
+    # Stores to globals that nothing ever loads become pops
+    loaded = set()
+    for block in cfg.blocks:
+        loaded |= {instruction[1] for instruction in block.instructions if instruction[0] == 'LOAD_GLOBAL'}
+    count = 0
+    for block in cfg.blocks:
+        for idx, instruction in enumerate(block.instructions):
+            if instruction[0] == 'STORE_GLOBAL' and instruction[1] not in loaded:
+                block.instructions[idx] = ('POP',)
+                count += 1
+    return count
+
+def remove_dead_stores(cfg):
+    # Stores to locals that are not read again before the slot is written
+    # or popped become pops
+    if not compute_depths(cfg):
+        return 0
+    compute_def_use(cfg)
+    live_out = compute_liveness(cfg)
+    count = 0
+    for block in cfg.blocks:
+        if block.depth == None:
+            continue
+        depths = [block.depth]
+        for idx in range(len(block.instructions)):
+            depths.append(slot_effects(block, idx, depths[-1])[2])
+        live = set(live_out[block])
+        for idx in reversed(range(len(block.instructions))):
+            uses, defs, _ = slot_effects(block, idx, depths[idx])
+            if block.instructions[idx][0] == 'STORE_LOCAL' and block.instructions[idx][1] not in live:
+                block.instructions[idx] = ('POP',)
+                count += 1
+                uses, defs = (), ()
+            live -= set(defs)
+            live |= set(uses)
+    return count
+
+# Types of the values in stack slots and globals. None is a value of any
+# type, NO_TYPE is the type of a value that never exists (nothing reached
+# the slot yet), which the inference starts from. NO_TYPE and join_types
+# are shared with the hoisting of loop invariants (see compiler.py).
+
+number_opcodes = {'SUB', 'MUL', 'DIV', 'MOD', 'EXP', 'NEG', 'LOAD_CONST_DIV', 'ADD_NUM', 'SUB_NUM', 'MUL_NUM', 'DIV_NUM', 'MOD_NUM'}
+
+# Opcodes whose operands are both numbers, and their specialized version
+# that skips the type checks
+number_specializations = {
+    'ADD' : 'ADD_NUM',
+    'SUB' : 'SUB_NUM',
+    'MUL' : 'MUL_NUM',
+    'DIV' : 'DIV_NUM',
+    'MOD' : 'MOD_NUM',
+    'LT'  : 'LT_NUM',
+    'LE'  : 'LE_NUM',
+    'GT'  : 'GT_NUM',
+    'GE'  : 'GE_NUM',
+    'EQ'  : 'EQ_NUM',
+    'NE'  : 'NE_NUM'
+}
+
+def add_type(type1, type2):
+    # ADD concatenates as soon as one side is a string
+    if type1 == TYPE_STRING or type2 == TYPE_STRING:
+        return TYPE_STRING
+    elif type1 == NO_TYPE or type2 == NO_TYPE:
+        return NO_TYPE
+    elif type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+        return TYPE_NUMBER
+    return None
+
+def xor_type(type1, type2):
+    if type1 == NO_TYPE or type2 == NO_TYPE:
+        return NO_TYPE
+    elif type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+        return TYPE_NUMBER
+    elif type1 == TYPE_BOOL or type2 == TYPE_BOOL:
+        return TYPE_BOOL
+    return None
+
+def transfer_types(block, idx, types, global_types):
+    # Updates types, the types of the stack slots, to what they are after
+    # the instruction at idx. An instruction that fails in the VM does not
+    # continue, so a result has its type whatever the operands were.
+    instruction = block.instructions[idx]
+    opcode = instruction[0]
+    if opcode == 'PUSH':
+        types.append(instruction[1][0])
+    elif opcode == 'LOAD_GLOBAL':
+        types.append(global_types.get(instruction[1], NO_TYPE))
+    elif opcode == 'LOAD_LOCAL':
+        types.append(types[instruction[1]])
+    elif opcode == 'LOAD_LOCAL2':
+        types += [types[instruction[1]], types[instruction[2]]]
+    elif opcode in ('ADD', 'CONCAT_STR'):
+        type2 = types.pop()
+        types[-1] = add_type(types[-1], type2)
+    elif opcode == 'LOAD_CONST_ADD':
+        types[-1] = add_type(types[-1], instruction[1][0])
+    elif opcode == 'XOR':
+        type2 = types.pop()
+        types[-1] = xor_type(types[-1], type2)
+    elif opcode in number_opcodes or opcode in compare_opcodes:
+        if opcode not in ('NEG', 'LOAD_CONST_DIV'):
+            types.pop()
+        types[-1] = TYPE_BOOL if opcode in compare_opcodes else TYPE_NUMBER
+    elif opcode == 'STORE_LOCAL':
+        types[instruction[1]] = types.pop()
+    elif opcode == 'INC_LOCAL':
+        types[instruction[1]] = add_type(types[instruction[1]], TYPE_NUMBER)
+    elif opcode == 'POPN':
+        del types[len(types) - instruction[1]:]
+    elif opcode in ('POP', 'STORE_GLOBAL', 'PRINT', 'PRINTLN', 'JMPZ', 'JMPZ_KEEP', 'JMPNZ_KEEP', 'RTS'):
+        types.pop()
+    elif opcode.startswith('JMP_IF_NOT_'):
+        del types[-2:]
+    elif opcode == 'FOR_PREP':
+        # Fails unless the variable, bound and step are numbers
+        idx = instruction[2]
+        types[idx:idx + 4] = [TYPE_NUMBER, TYPE_NUMBER, TYPE_NUMBER, TYPE_BOOL]
+    elif opcode == 'FOR_LOOP':
+        types[instruction[2]] = TYPE_NUMBER
+    elif opcode in call_opcodes:
+        # The callee's result can be anything
+        del types[len(types) - arg_count(block, idx) - 1:]
+        types.append(None)
+
+def infer_types(cfg):
+    # The types of the stack slots at the start of every block reached from
+    # an entry, and the types of the globals, or None when the stack heights
+    # are not known. Flow-sensitive within a function: a slot has a type at a
+    # point if every path there leaves a value of that type in it. Arguments
+    # and call results can be anything. A global has the joined type of
+    # everything stored to it anywhere, and the blocks that load it are
+    # looked at again when that type changes.
+    if not compute_depths(cfg):
+        return None, None
+    loaders = {}
+    for block in cfg.blocks:
+        for instruction in block.instructions:
+            if instruction[0] == 'LOAD_GLOBAL':
+                loaders.setdefault(instruction[1], set()).add(block)
+
+    global_types = {}
+    entry_types = {}
+    pending = []
+    queued = set()
+
+    def queue(block):
+        if block not in queued:
+            queued.add(block)
+            pending.append(block)
+
+    for block in cfg.entry_blocks():
+        entry_types[block] = [None] * block.depth
+        queue(block)
+    while pending:
+        block = pending.pop()
+        queued.discard(block)
+        types = list(entry_types[block])
+        kept = types
+        for idx, instruction in enumerate(block.instructions):
+            if instruction[0] == 'STORE_GLOBAL':
+                old = global_types.get(instruction[1], NO_TYPE)
+                new = join_types(old, types[-1])
+                if new != old:
+                    global_types[instruction[1]] = new
+                    for loader in loaders.get(instruction[1], ()):
+                        if loader in entry_types: queue(loader)
+            if idx == len(block.instructions) - 1:
+                kept = list(types)
+            transfer_types(block, idx, types, global_types)
+        for succ in block.succs:
+            # A kept value is still on the stack where the jump goes to
+            keeps = block.instructions and block.instructions[-1][0] in ('JMPZ_KEEP', 'JMPNZ_KEEP') and block.instructions[-1][1] in succ.labels
+            succ_types = kept if keeps else types
+            if succ not in entry_types:
+                entry_types[succ] = list(succ_types)
+                queue(succ)
+            else:
+                joined = [join_types(old, new) for old, new in zip(entry_types[succ], succ_types)]
+                if joined != entry_types[succ]:
+                    entry_types[succ] = joined
+                    queue(succ)
+    return entry_types, global_types
+
+def specialize_types(cfg):
+    # Arithmetic and comparisons on values that are numbers on every path
+    # become the opcodes that skip the type checks, as does ADD with a
+    # string operand (CONCAT_STR)
+    entry_types, global_types = infer_types(cfg)
+    if entry_types == None:
+        return 0
+    count = 0
+    for block, types in entry_types.items():
+        types = list(types)
+        for idx, instruction in enumerate(block.instructions):
+            opcode = instruction[0]
+            if opcode in number_specializations:
+                type1, type2 = types[-2:]
+                if type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+                    block.instructions[idx] = (number_specializations[opcode],)
+                    count += 1
+                elif opcode == 'ADD' and TYPE_STRING in (type1, type2):
+                    block.instructions[idx] = ('CONCAT_STR',)
+                    count += 1
+            transfer_types(block, idx, types, global_types)
+    return count
+
+def run_peephole(cfg):
+    # The peephole optimizer over the linearized graph
+    size = cfg.size()
+    code = PeepholeOptimizer().optimize(linearize(cfg))
+    cfg.blocks = build_cfg(code).blocks
+    cfg.link()
+    return size - cfg.size()
+
+class PassManager:
+    def __init__(self):
+        self.passes = []
+        # (name, seconds, instructions before, instructions after, changes) of each pass run
+        self.stats = []
+
+    def register(self, name, run_pass):
+        self.passes.append((name, run_pass))
+
+    def run(self, instructions):
+        cfg = build_cfg(instructions)
+        for name, run_pass in self.passes:
+            before = cfg.size()
+            start = time.perf_counter()
+            count = run_pass(cfg)
+            self.stats.append((name, time.perf_counter() - start, before, cfg.size(), count))
+        return linearize(cfg)
+
+# Compiler options of each optimization level. -O0 compiles the tree as it
+# is parsed, -O1 folds constants, removes dead code and runs the peephole
+# optimizer, -O2 also inlines small functions and runs the passes over the
+# control-flow graph.
+OPT_LEVELS = (0, 1, 2)
+
+def make_pass_manager(level):
+    manager = PassManager()
+    if level >= 2:
+        manager.register('unreachable blocks', remove_unreachable_blocks)
+        manager.register('dead globals', remove_dead_globals)
+        manager.register('dead stores', remove_dead_stores)
+        manager.register('specialize types', specialize_types)
+    if level >= 1:
+        manager.register('peephole', run_peephole)
+    return manager
+
+def make_compiler(level):
+    # The compiler whose output make_pass_manager(level) runs on: -O1 hoists
+    # loop invariants and -O2 also inlines small functions
+    return Compiler(inline_limit = INLINE_LIMIT if level >= 2 else 0, hoist_invariants = level >= 1)
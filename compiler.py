@@ -14,47 +14,411 @@ class Symbol:
         self.depth = depth
         self.arg_cnt = arg_cnt
 
+binary_opcodes = {
+    TOK_PLUS  : 'ADD',
+    TOK_MINUS : 'SUB',
+    TOK_STAR  : 'MUL',
+    TOK_SLASH : 'DIV',
+    TOK_MOD   : 'MOD',
+    TOK_CARET : 'EXP',
+    TOK_LT    : 'LT',
+    TOK_GT    : 'GT',
+    TOK_LE    : 'LE',
+    TOK_GE    : 'GE',
+    TOK_EQEQ  : 'EQ',
+    TOK_NE    : 'NE'
+}
+
+# How many values each instruction leaves on the stack minus the ones it
+# takes. JSR, TAILJSR and POPN depend on their argument and are handled in
+# emit.
+stack_effects = {opcode: -1 for opcode in binary_opcodes.values()}
+stack_effects.update({
+    'PUSH'         : 1,
+    'LOAD_GLOBAL'  : 1,
+    'LOAD_LOCAL'   : 1,
+    'POP'          : -1,
+    'STORE_GLOBAL' : -1,
+    'STORE_LOCAL'  : -1,
+    'JMPZ'         : -1,
+    'JMPZ_KEEP'    : -1,
+    'JMPNZ_KEEP'   : -1,
+    'PRINT'        : -1,
+    'PRINTLN'      : -1,
+    'RTS'          : -1,
+    'XOR'          : -1
+})
+
+# Default size limit, in AST nodes, of the functions the compiler inlines
+INLINE_LIMIT = 30
+
+def inline_size(body):
+    # Number of nodes in a function body, or None when the body calls or
+    # declares a function and can not be inlined
+    size = 0
+    pending = [body]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, (FuncCall, FuncDecl)):
+            return None
+        size += 1
+        pending.extend(node.children())
+    return size
+
+# Size limit, in AST nodes, of the loops the compiler hoists invariants out
+# of. Finding them walks the whole loop, so without a limit the time for
+# deeply nested loops would grow with the square of their depth.
+HOIST_LIMIT = 1000
+
+def loop_sizes(root):
+    # Number of nodes of every loop under root. Nodes are counted in the
+    # order they are visited, and a marker left under the children of a loop
+    # takes the count again once they are all visited.
+    sizes = {}
+    count = 0
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, tuple):
+            loop, start = node
+            sizes[loop] = count - start
+            continue
+        count += 1
+        if isinstance(node, (WhileStmt, ForStmt)):
+            pending.append((node, count - 1))
+        elif isinstance(node, LazyStmts) and not node.is_parsed():
+            node.stmts  # parses the body
+        pending.extend(node.children())
+    return sizes
+
+pure_exprs = (Integer, Float, Bool, String, Identifier, Grouping, BinOp, UnOp, LogicalOp)
+
+def assigned_names(root, functions):
+    # Names assigned under root and in the bodies of the functions it calls,
+    # directly or not
+    names = set()
+    called = set()
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, (Assignment, LocalAssignment)):
+            names.add(node.left.name)
+        elif isinstance(node, FuncCall) and node.identifier.name not in called:
+            called.add(node.identifier.name)
+            if node.identifier.name in functions:
+                pending.append(functions[node.identifier.name].body_stmts)
+        elif isinstance(node, LazyStmts) and not node.is_parsed():
+            node.stmts  # parses the body
+        pending.extend(node.children())
+    return names
+
+def unconditional_exprs(stmts):
+    # Expressions of a loop body that run on every pass through it: those of
+    # its top-level statements up to the first one that may return
+    exprs = []
+    for stmt in stmts.stmts:
+        pending = [stmt]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, RetStmt):
+                return exprs
+            elif not isinstance(node, FuncDecl):
+                pending.extend(node.children())
+
+        if isinstance(stmt, (Assignment, LocalAssignment)):
+            exprs.append(stmt.right)
+        elif isinstance(stmt, PrintStmt):
+            exprs.append(stmt.value)
+        elif isinstance(stmt, FuncCallStmt):
+            exprs.extend(stmt.func_call.args)
+        elif isinstance(stmt, (IfStmt, WhileStmt)):
+            exprs.append(stmt.condition)
+        elif isinstance(stmt, ForStmt):
+            exprs.append(stmt.assignment.right)
+    return exprs
+
+# Types of values for hoisting: an invariant is only computed ahead of the
+# loop body when it can not fail in the VM, which depends on the types of
+# its operands. None is a value of any type, NO_TYPE the type of a name that
+# is never assigned.
+NO_TYPE = 'NO_TYPE'
+
+def join_types(type1, type2):
+    if type1 == NO_TYPE:
+        return type2
+    elif type2 == NO_TYPE or type1 == type2:
+        return type1
+    return None
+
+def expr_type(node, types, name_types):
+    # Type of the value of node if it computes one, with the types of its
+    # children in types
+    if isinstance(node, (Integer, Float)):
+        return TYPE_NUMBER
+    elif isinstance(node, String):
+        return TYPE_STRING
+    elif isinstance(node, Bool):
+        return TYPE_BOOL
+    elif isinstance(node, Identifier):
+        return name_types.get(node.name, NO_TYPE)
+    elif isinstance(node, Grouping):
+        return types[node.value]
+    elif isinstance(node, UnOp):
+        operand = types[node.operand]
+        if node.op.token_type == TOK_PLUS:
+            return operand
+        elif node.op.token_type == TOK_NOT:
+            return operand if operand in (NO_TYPE, TYPE_BOOL, TYPE_NUMBER) else None
+        return TYPE_NUMBER
+    elif isinstance(node, BinOp):
+        left, right = types[node.left], types[node.right]
+        if node.op.token_type == TOK_PLUS:
+            # Concatenates as soon as one side is a string
+            if left == TYPE_STRING or right == TYPE_STRING:
+                return TYPE_STRING
+            elif left == NO_TYPE or right == NO_TYPE:
+                return NO_TYPE
+            elif left == TYPE_NUMBER and right == TYPE_NUMBER:
+                return TYPE_NUMBER
+            return None
+        elif node.op.token_type in (TOK_LT, TOK_LE, TOK_GT, TOK_GE, TOK_EQEQ, TOK_NE):
+            return TYPE_BOOL
+        return TYPE_NUMBER
+    elif isinstance(node, LogicalOp):
+        return join_types(types[node.left], types[node.right])
+    return None
+
+def may_fail(node, types):
+    # Whether the VM may stop with an error computing node from the values
+    # of its children, which have the types in types
+    if isinstance(node, UnOp):
+        operand = types[node.operand]
+        if node.op.token_type == TOK_MINUS:
+            return operand != TYPE_NUMBER
+        elif node.op.token_type == TOK_NOT:
+            return operand != TYPE_BOOL
+        return False
+    elif isinstance(node, BinOp):
+        op = node.op.token_type
+        left, right = types[node.left], types[node.right]
+        numbers = left == TYPE_NUMBER and right == TYPE_NUMBER
+        if op == TOK_PLUS:
+            return not (numbers or left == TYPE_STRING or right == TYPE_STRING)
+        elif op in (TOK_MINUS, TOK_STAR):
+            return not numbers
+        elif op in (TOK_SLASH, TOK_MOD):
+            divisor = node.right
+            while isinstance(divisor, Grouping):
+                divisor = divisor.value
+            return not (numbers and isinstance(divisor, (Integer, Float)) and float(divisor.value) != 0)
+        elif op in (TOK_LT, TOK_LE, TOK_GT, TOK_GE):
+            return not (left == right and left in (TYPE_NUMBER, TYPE_STRING))
+        elif op in (TOK_EQEQ, TOK_NE):
+            return not (left == right and left in (TYPE_NUMBER, TYPE_STRING, TYPE_BOOL))
+        # ^ can overflow
+        return True
+    return not isinstance(node, pure_exprs)
+
+def subexprs(exprs):
+    # The nodes of exprs, each one after its children
+    order = []
+    pending = list(exprs)
+    while pending:
+        node = pending.pop()
+        order.append(node)
+        pending.extend(node.children())
+    order.reverse()
+    return order
+
+def infer_name_types(root):
+    # The types of the values each name holds anywhere in the program, the
+    # join of the values assigned to it. Names of parameters hold anything,
+    # loop variables also hold numbers.
+    name_types = {}
+    assignments = []
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, (Assignment, LocalAssignment)):
+            assignments.append((node.left.name, subexprs([node.right])))
+        elif isinstance(node, Param):
+            name_types[node.identifier.name] = None
+        elif isinstance(node, ForStmt):
+            name = node.assignment.left.name
+            name_types[name] = join_types(name_types.get(name, NO_TYPE), TYPE_NUMBER)
+        elif isinstance(node, LazyStmts) and not node.is_parsed():
+            node.stmts  # parses the body
+        pending.extend(node.children())
+
+    readers = {}
+    for idx, (_, order) in enumerate(assignments):
+        for node in order:
+            if isinstance(node, Identifier):
+                readers.setdefault(node.name, set()).add(idx)
+
+    # Worklist over the assignments, one is computed again when the type of
+    # a name it reads widens
+    work = list(range(len(assignments)))
+    queued = set(work)
+    while work:
+        idx = work.pop()
+        queued.discard(idx)
+        name, order = assignments[idx]
+        types = {}
+        for node in order:
+            types[node] = expr_type(node, types, name_types)
+        old = name_types.get(name, NO_TYPE)
+        new = join_types(old, types[order[-1]])
+        if new != old:
+            name_types[name] = new
+            for reader in readers.get(name, ()):
+                if reader not in queued:
+                    queued.add(reader)
+                    work.append(reader)
+    return name_types
+
+def invariant_exprs(exprs, assigned, hoisted, name_types):
+    # The largest subexpressions of exprs that compute something without side
+    # effects, can not fail in the VM and read no name in assigned. name_types
+    # are the types of the names (see infer_name_types). Nodes in hoisted are
+    # loads of hidden locals already. The right operand of and/or does not
+    # always run, so only a whole invariant and/or is taken from it.
+    types = {}
+    variant = set()
+    for node in subexprs(exprs):
+        types[node] = expr_type(node, types, name_types)
+        if may_fail(node, types) or (isinstance(node, Identifier) and node.name in assigned):
+            variant.add(node)
+        elif any(child in variant for child in node.children()):
+            variant.add(node)
+
+    invariants = []
+    pending = list(exprs)
+    while pending:
+        node = pending.pop()
+        if node in hoisted:
+            continue
+        elif node not in variant and isinstance(node, (BinOp, UnOp, LogicalOp, Grouping)):
+            if not isinstance(node, Grouping) or isinstance(node.value, (BinOp, UnOp, LogicalOp)):
+                invariants.append(node)
+                continue
+        if isinstance(node, LogicalOp):
+            pending.append(node.left)
+        else:
+            pending.extend(node.children())
+    return invariants
+
 class Compiler:
-    def __init__(self):
+    def __init__(self, inline_limit = 0, hoist_invariants = False):
         self.code = []
+        self.work = []
+        # Symbols are kept in slot order with a name index next to them. Each
+        # open block that declares locals has a (depth, names) entry,
+        # innermost last, so looking a name up skips the blocks without any.
         self.locals = []
+        self.scopes = []
         self.globals = []
+        self.global_slots = {}
         self.functions = []
+        self.function_slots = {}
+        # Symbols declared after the deferred function that is being compiled
+        self.hidden_globals = range(0)
+        self.hidden_functions = range(0)
+        self.deferred = {}
+        self.pending = []
         self.scope_depth = 0
         self.label_counter = 0
+        # Height of the stack in the current frame, locals included
+        self.depth = 0
+        # Calls to top-level leaf functions of at most inline_limit nodes are
+        # replaced with the function body, 0 turns inlining off
+        self.inline_limit = inline_limit
+        self.inline_bodies = {}
+        self.inlining = []
+        # Number of function bodies being compiled, ret only makes tail
+        # calls inside one
+        self.function_depth = 0
+        # Declarations by function name, and the hidden local slots of the
+        # loop-invariant expressions currently hoisted, by node. Invariants
+        # are only hoisted out of loops when hoist_invariants is set.
+        self.func_decls = {}
+        self.hoist_invariants = hoist_invariants
+        self.hoisted = {}
+        # The program being compiled, and the types of its names and the
+        # sizes of its loops, found once a loop is compiled
+        self.root = None
+        self.name_types = None
+        self.loop_sizes = None
+        # Literal values by type and value, so every use of a literal pushes
+        # the same tuple (the assembler pools them, see assembler.py)
+        self.constants = {}
 
     def emit(self, instruction):
         self.code.append(instruction)
+        opcode = instruction[0]
+        if opcode == 'JSR':
+            self.depth -= self.get_func_symbol(instruction[1]).arg_cnt
+        elif opcode == 'TAILJSR':
+            # Leaves the function like JSR followed by RTS
+            self.depth -= self.get_func_symbol(instruction[1]).arg_cnt + 1
+        elif opcode == 'POPN':
+            self.depth -= instruction[1]
+        else:
+            self.depth += stack_effects.get(opcode, 0)
+
+    def constant(self, type, value):
+        key = (type, value.__class__, value)
+        const = self.constants.get(key)
+        if const == None:
+            const = self.constants[key] = (type, value)
+        return const
 
     def make_label(self):
         self.label_counter += 1
         return f"LBL{self.label_counter}"
     
     def get_func_symbol(self, name):
-        for symbol in reversed(self.functions):
-            if(symbol.name == name):
-                return symbol
-            
+        idx = self.function_slots.get(name)
+        if idx != None and idx not in self.hidden_functions:
+            return self.functions[idx]
+
         return None
     
     def get_scope_var_symbol(self, name):
-        for idx, symbol in reversed(list(enumerate(self.locals))):
-            if symbol.depth != self.scope_depth: break
-            if symbol.name == name:
-                return (symbol, idx)
+        if self.scopes and self.scopes[-1][0] == self.scope_depth:
+            idx = self.scopes[-1][1].get(name)
+            if idx != None:
+                return (self.locals[idx], idx)
         
         return (None, None)
 
     def get_var_symbol(self, name):
-        for idx, symbol in reversed(list(enumerate(self.locals))):
-            if symbol.name == name:
-                return (symbol, idx)
+        for _, names in reversed(self.scopes):
+            idx = names.get(name)
+            if idx != None:
+                return (self.locals[idx], idx)
 
-        for idx, symbol in reversed(list(enumerate(self.globals))):
-            if symbol.name == name:
-                return (symbol, idx)
+        idx = self.global_slots.get(name)
+        if idx != None and idx not in self.hidden_globals:
+            return (self.globals[idx], idx)
             
         return (None, None)
+
+    def add_func_symbol(self, symbol):
+        self.function_slots[symbol.name] = len(self.functions)
+        self.functions.append(symbol)
+
+    def add_global_symbol(self, symbol):
+        self.global_slots[symbol.name] = len(self.globals)
+        self.globals.append(symbol)
+        return len(self.globals) - 1
+
+    def add_local_symbol(self, symbol):
+        if not self.scopes or self.scopes[-1][0] != self.scope_depth:
+            self.scopes.append((self.scope_depth, {}))
+        self.scopes[-1][1][symbol.name] = len(self.locals)
+        self.locals.append(symbol)
+        return len(self.locals) - 1
     
     def begin_block(self):
         self.scope_depth += 1
@@ -66,92 +430,65 @@ class Compiler:
             self.emit(('POP',))
             i -= 1
 
+        if self.scopes and self.scopes[-1][0] == self.scope_depth:
+            self.scopes.pop()
         self.scope_depth -= 1
 
+    def schedule(self, *items):
+        # Queues work for the compile loop, to run in the given order and
+        # before anything queued earlier. An item is a node to compile, an
+        # instruction tuple to emit, or a callable.
+        self.work.extend(reversed(items))
+
     def compile(self, node):
-        if isinstance(node, Integer):
-            value = (TYPE_NUMBER, float(node.value))
-            self.emit(('PUSH', value))
-        elif isinstance(node, Float):
-            value = (TYPE_NUMBER, float(node.value))
-            self.emit(('PUSH', value))
+        # Walks the tree with an explicit work stack instead of recursion, so
+        # the nesting depth of a program is only limited by memory
+        work = self.work
+        base = len(work)
+        work.append(node)
+        while len(work) > base:
+            item = work.pop()
+            if isinstance(item, tuple):
+                self.emit(item)
+            elif isinstance(item, Node):
+                self.compile_node(item)
+            else:
+                item()
+
+    def compile_node(self, node):
+        if self.hoisted and node in self.hoisted:
+            self.emit(('LOAD_LOCAL', self.hoisted[node]))
+        elif isinstance(node, (Integer, Float)):
+            self.emit(('PUSH', self.constant(TYPE_NUMBER, float(node.value))))
         elif isinstance(node, Bool):
-            value = (TYPE_BOOL, node.value)
-            self.emit(('PUSH', value))
+            self.emit(('PUSH', self.constant(TYPE_BOOL, node.value)))
         elif isinstance(node, String):
-            value = (TYPE_STRING, stringify(node.value))
-            self.emit(('PUSH', value))
+            self.emit(('PUSH', self.constant(TYPE_STRING, node.value)))
         elif isinstance(node, Grouping):
-            self.compile(node.value)
+            self.schedule(node.value)
         elif isinstance(node, BinOp):
-            self.compile(node.left)
-            self.compile(node.right)
-            if node.op.token_type == TOK_PLUS:
-                self.emit(('ADD',))
-            elif node.op.token_type == TOK_MINUS:
-                self.emit(('SUB',))
-            elif node.op.token_type == TOK_STAR:
-                self.emit(('MUL',))
-            elif node.op.token_type == TOK_SLASH:
-                self.emit(('DIV',))
-            elif node.op.token_type == TOK_MOD:
-                self.emit(('MOD',))
-            elif node.op.token_type == TOK_CARET:
-                self.emit(('EXP',))
-            elif node.op.token_type == TOK_LT:
-                self.emit(('LT',))
-            elif node.op.token_type == TOK_GT:
-                self.emit(('GT',))
-            elif node.op.token_type == TOK_LE:
-                self.emit(('LE',))
-            elif node.op.token_type == TOK_GE:
-                self.emit(('GE',))
-            elif node.op.token_type == TOK_EQEQ:
-                self.emit(('EQ',))
-            elif node.op.token_type == TOK_NE:
-                self.emit(('NE',))
+            self.schedule(node.left, node.right, (binary_opcodes[node.op.token_type],))
         elif isinstance(node, UnOp):
-            self.compile(node.operand)
             if node.op.token_type == TOK_MINUS:
-                self.emit(('NEG',))
+                self.schedule(node.operand, ('NEG',))
             elif node.op.token_type == TOK_NOT:
-                self.emit(('PUSH', (TYPE_NUMBER, 1)))
-                self.emit(('XOR',))
+                self.schedule(node.operand, ('PUSH', self.constant(TYPE_NUMBER, 1)), ('XOR',))
+            else:
+                self.schedule(node.operand)
         elif isinstance(node, LogicalOp):
-            self.compile(node.left)
-            self.compile(node.right)
+            # The right operand only runs when the left one does not decide
+            # the result, which is then the left operand itself
+            end_label = self.make_label()
             if node.op.token_type == TOK_AND:
-                self.emit(('AND',))
+                self.schedule(node.left, ('JMPZ_KEEP', end_label), node.right, ('LABEL', end_label))
             elif node.op.token_type == TOK_OR:
-                self.emit(('OR',))
+                self.schedule(node.left, ('JMPNZ_KEEP', end_label), node.right, ('LABEL', end_label))
         elif isinstance(node, Stmts):
-            for stmt in node.stmts:
-                self.compile(stmt)
+            self.schedule(*node.stmts)
         elif isinstance(node, Assignment):
-            self.compile(node.right)
-            symbol, idx = self.get_var_symbol(node.left.name)
-            if not symbol:
-                new_symbol = Symbol(node.left.name, SYM_VAR, self.scope_depth)
-                if self.scope_depth == 0:
-                    self.globals.append(new_symbol)
-                    self.emit(('STORE_GLOBAL', len(self.globals) - 1))
-                else:
-                    self.locals.append(new_symbol)
-                    self.emit(('SET_SLOT', (len(self.locals) - 1, node.left.name)))
-            else:
-                if symbol.depth == 0:
-                    self.emit(('STORE_GLOBAL', idx))
-                else:
-                    self.emit(('STORE_LOCAL', idx))
+            self.schedule(node.right, lambda: self.store_assignment(node))
         elif isinstance(node, LocalAssignment):
-            self.compile(node.right)
-            symbol, idx = self.get_scope_var_symbol(node.left.name)
-            if not symbol:
-                new_symbol = Symbol(node.left.name, SYM_VAR, self.scope_depth)
-                self.locals.append(new_symbol)
-                self.emit(('SET_SLOT', (len(self.locals) - 1, node.left.name)))
-            else:
-                self.emit(('STORE_LOCAL', idx))
+            self.schedule(node.right, lambda: self.store_local_assignment(node))
         elif isinstance(node, Identifier):
             symbol, idx = self.get_var_symbol(node.name)
             if not symbol:
@@ -162,72 +499,58 @@ class Compiler:
                 else:
                     self.emit(('LOAD_LOCAL', idx))
         elif isinstance(node, PrintStmt):
-            self.compile(node.value)
             if node.end == '\n':
-                self.emit(('PRINTLN',))
+                self.schedule(node.value, ('PRINTLN',))
             else:
-                self.emit(('PRINT',))
+                self.schedule(node.value, ('PRINT',))
         elif isinstance(node, IfStmt):
-            self.compile(node.condition)
             then_label = self.make_label()
             else_label = self.make_label()
             exit_label = self.make_label()
-            self.emit(('JMPZ', else_label))
-            self.emit(('LABEL', then_label))
-            self.begin_block()
-            self.compile(node.then_stmts)
-            self.end_block()
-            self.emit(('JMP', exit_label))
-            self.emit(('LABEL', else_label))
+            items = [
+                node.condition,
+                ('JMPZ', else_label),
+                ('LABEL', then_label),
+                self.begin_block,
+                node.then_stmts,
+                self.end_block,
+                ('JMP', exit_label),
+                ('LABEL', else_label)]
             if node.else_stmts != None:
-                self.begin_block()
-                self.compile(node.else_stmts)
-                self.end_block()
-            self.emit(('LABEL', exit_label))
+                items += [self.begin_block, node.else_stmts, self.end_block]
+            items.append(('LABEL', exit_label))
+            self.schedule(*items)
         elif isinstance(node, WhileStmt):
             cond_label = self.make_label()
             do_label = self.make_label()
             end_label = self.make_label()
-            self.emit(('LABEL', cond_label))
-            self.compile(node.condition)
-            self.emit(('JMPZ', end_label))
-            self.emit(('LABEL', do_label))
-            self.begin_block()
-            self.compile(node.do_stmts)
-            self.end_block()
-            self.emit(('JMP', cond_label))
-            self.emit(('LABEL', end_label))
+            invariants = self.loop_invariants(node, node.condition)
+            loop = [
+                ('LABEL', cond_label),
+                node.condition,
+                ('JMPZ', end_label),
+                ('LABEL', do_label),
+                self.begin_block,
+                node.do_stmts,
+                self.end_block,
+                ('JMP', cond_label),
+                ('LABEL', end_label)]
+            if invariants:
+                skip_label = self.make_label()
+                self.schedule(
+                    node.condition,
+                    ('JMPZ', skip_label),
+                    *self.hoist(invariants, do_label),
+                    *loop,
+                    *self.unhoist(invariants),
+                    ('LABEL', skip_label))
+            else:
+                self.schedule(*loop)
         elif isinstance(node, ForStmt):
             assign_label = self.make_label()
-            cond_label = self.make_label()
-            do_label = self.make_label()
-            end_label = self.make_label()
             self.emit(('LABEL', assign_label))
             self.begin_block()
-            self.compile(node.assignment.right)
-            new_symbol = Symbol(node.assignment.left.name, SYM_VAR, self.scope_depth)
-            self.locals.append(new_symbol)
-            self.emit(('LABEL', cond_label))
-
-            symbol, idx = self.get_var_symbol(node.assignment.left.name)
-            cond_val = node.condition_val.value
-            if node.step_val != None:
-                step_val = node.step_val.value
-            else:
-                step_val = 1
-
-            self.emit(('LOAD_LOCAL', idx))
-            self.emit(('PUSH', (TYPE_NUMBER, cond_val)))
-            self.emit(('LE',))
-            self.emit(('JMPZ', end_label))
-            self.compile(node.do_stmts)
-            self.emit(('LOAD_LOCAL', idx))
-            self.emit(('PUSH', (TYPE_NUMBER, step_val)))
-            self.emit(('ADD',))
-            self.emit(('STORE_LOCAL', idx))
-            self.emit(('JMP', cond_label))
-            self.emit(('LABEL', end_label))
-            self.end_block()
+            self.schedule(node.assignment.right, lambda: self.compile_for_loop(node))
         elif isinstance(node, FuncDecl):
             func_symbol = self.get_func_symbol(node.identifier.name)
             if func_symbol:
@@ -238,45 +561,245 @@ class Compiler:
                 compile_error(f'A function with the name {node.identifier.name} was already defined in this scope', node.line)
 
             new_symbol = Symbol(node.identifier.name, SYM_FUNC, self.scope_depth, len(node.params))
-            self.functions.append(new_symbol)
-            exit_label = self.make_label()
-            self.emit(('JMP', exit_label))
-            self.emit(('LABEL', new_symbol.name))
+            self.add_func_symbol(new_symbol)
+            self.func_decls[new_symbol.name] = node
 
-            self.begin_block()
-            for parm in node.params:
-                new_symbol = Symbol(parm.identifier.name, SYM_VAR, self.scope_depth)
-                self.locals.append(new_symbol)
-                self.emit(('SET_SLOT', (len(self.locals) - 1, parm.identifier.name)))
+            if self.scope_depth == 0 and self.inline_limit > 0 and not (isinstance(node.body_stmts, LazyStmts) and not node.body_stmts.is_parsed()):
+                size = inline_size(node.body_stmts)
+                if size != None and size <= self.inline_limit:
+                    self.inline_bodies[new_symbol.name] = (node, len(self.globals))
 
-            self.compile(node.body_stmts)
-            self.end_block()
-
-            self.emit(('PUSH', (TYPE_NUMBER, 0)))
-            self.emit(('RTS',))
-            self.emit(('LABEL', exit_label))
+            if self.scope_depth == 0 and isinstance(node.body_stmts, LazyStmts) and not node.body_stmts.is_parsed():
+                # A body that was not parsed yet is only compiled once the
+                # function is called, after the main program
+                self.deferred[new_symbol.name] = (node, len(self.globals), len(self.functions))
+            else:
+                exit_label = self.make_label()
+                self.emit(('JMP', exit_label))
+                self.schedule(lambda: self.compile_function(node), ('LABEL', exit_label))
         elif isinstance(node, FuncCallStmt):
-            self.compile(node.func_call)
-            self.emit(('POP',))
+            self.schedule(node.func_call, ('POP',))
         elif isinstance(node, FuncCall):
-            func_symbol = self.get_func_symbol(node.identifier.name)
-            if not func_symbol:
-                compile_error(f'A function with the name {node.identifier.name} was not declared', node.line)
+            self.compile_call(node)
+        elif isinstance(node, RetStmt):
+            if self.inlining:
+                depth = self.depth
+                self.schedule(node.value, lambda: self.inline_return(depth))
+            elif isinstance(node.value, FuncCall) and self.function_depth > 0:
+                self.compile_call(node.value, tail = True)
+            else:
+                self.schedule(node.value, ('RTS',))
 
-            if len(node.args) != func_symbol.arg_cnt:
-                compile_error(f'A function with the name {node.identifier.name} expected {func_symbol.arg_cnt} params', node.line)
+    def compile_call(self, node, tail = False):
+        # A call in tail position returns the callee's value itself
+        func_symbol = self.get_func_symbol(node.identifier.name)
+        if not func_symbol:
+            compile_error(f'A function with the name {node.identifier.name} was not declared', node.line)
 
-            for arg in node.args:
-                self.compile(arg)
+        if len(node.args) != func_symbol.arg_cnt:
+            compile_error(f'A function with the name {node.identifier.name} expected {func_symbol.arg_cnt} params', node.line)
 
-            self.emit(('PUSH', (TYPE_NUMBER, len(node.args))))
-            self.emit(('JSR', node.identifier.name))
-        elif isinstance(node, RetStmt):
-            self.compile(node.value)
-            self.emit(('RTS',))
+        if node.identifier.name in self.deferred:
+            self.pending.append(self.deferred.pop(node.identifier.name))
+
+        if node.identifier.name in self.inline_bodies:
+            func, globals_cnt = self.inline_bodies[node.identifier.name]
+            items = [
+                *node.args,
+                lambda: self.begin_inline(func, globals_cnt),
+                func.body_stmts,
+                self.end_inline]
+            if tail:
+                items.append(('RTS',))
+            self.schedule(*items)
+        else:
+            self.schedule(
+                *node.args,
+                ('PUSH', self.constant(TYPE_NUMBER, len(node.args))),
+                ('TAILJSR' if tail else 'JSR', node.identifier.name))
+
+    def compile_function(self, node):
+        self.emit(('LABEL', node.identifier.name))
+        self.begin_block()
+        depth = self.depth
+        for parm in node.params:
+            idx = self.add_local_symbol(Symbol(parm.identifier.name, SYM_VAR, self.scope_depth))
+            self.emit(('SET_SLOT', (idx, parm.identifier.name)))
+        self.depth = len(self.locals)
+        self.function_depth += 1
+
+        def restore_depth():
+            self.depth = depth
+            self.function_depth -= 1
+
+        self.schedule(
+            node.body_stmts,
+            self.end_block,
+            ('PUSH', self.constant(TYPE_NUMBER, 0)),
+            ('RTS',),
+            restore_depth)
+
+    def begin_inline(self, func, globals_cnt):
+        # Runs once the arguments of an inlined call are on the stack. They
+        # become the parameter slots of the body, which is compiled in a
+        # scope of its own that sees the globals the function itself sees.
+        base = self.depth - len(func.params)
+        self.inlining.append((base, self.make_label(), len(self.locals), self.scopes, self.hidden_globals))
+        self.scope_depth += 1
+        # Temporaries of the enclosing expression sit below the arguments,
+        # placeholders keep the slots of the body in line with the stack
+        while len(self.locals) < base:
+            self.locals.append(Symbol(None, SYM_VAR, self.scope_depth))
+        self.scopes = []
+        self.hidden_globals = range(globals_cnt, len(self.globals))
+        for parm in func.params:
+            idx = self.add_local_symbol(Symbol(parm.identifier.name, SYM_VAR, self.scope_depth))
+            self.emit(('SET_SLOT', (idx, parm.identifier.name)))
+
+    def inline_return(self, depth):
+        # Leaves the value on top of the stack in the slot of the first
+        # argument, pops everything above it and jumps past the body. The
+        # code that follows is unreachable and compiled as if the ret had
+        # not run.
+        base, exit_label = self.inlining[-1][:2]
+        above = self.depth - 1 - base
+        if above > 0:
+            self.emit(('STORE_LOCAL', base))
+            for _ in range(above - 1):
+                self.emit(('POP',))
+        self.emit(('JMP', exit_label))
+        self.depth = depth
+
+    def end_inline(self):
+        # A body that ends without ret returns 0, like a called function
+        self.emit(('PUSH', self.constant(TYPE_NUMBER, 0)))
+        self.inline_return(self.depth - 1)
+        base, exit_label, locals_cnt, self.scopes, self.hidden_globals = self.inlining.pop()
+        self.emit(('LABEL', exit_label))
+        del self.locals[locals_cnt:]
+        self.scope_depth -= 1
+        self.depth = base + 1
+
+    def compile_deferred(self, node, globals_cnt, functions_cnt):
+        # Compiles a deferred function body seeing only the globals and
+        # functions that were declared before the function itself
+        self.hidden_globals = range(globals_cnt, len(self.globals))
+        self.hidden_functions = range(functions_cnt, len(self.functions))
+        self.compile(lambda: self.compile_function(node))
+        self.hidden_globals = range(0)
+        self.hidden_functions = range(0)
+
+    def store_assignment(self, node):
+        symbol, idx = self.get_var_symbol(node.left.name)
+        if not symbol:
+            new_symbol = Symbol(node.left.name, SYM_VAR, self.scope_depth)
+            if self.scope_depth == 0:
+                self.emit(('STORE_GLOBAL', self.add_global_symbol(new_symbol)))
+            else:
+                self.emit(('SET_SLOT', (self.add_local_symbol(new_symbol), node.left.name)))
+        else:
+            if symbol.depth == 0:
+                self.emit(('STORE_GLOBAL', idx))
+            else:
+                self.emit(('STORE_LOCAL', idx))
+
+    def store_local_assignment(self, node):
+        if self.scope_depth == 0:
+            # A local outside of any block is a global, as in the interpreter
+            self.store_assignment(node)
+            return
+        symbol, idx = self.get_scope_var_symbol(node.left.name)
+        if not symbol:
+            new_symbol = Symbol(node.left.name, SYM_VAR, self.scope_depth)
+            self.emit(('SET_SLOT', (self.add_local_symbol(new_symbol), node.left.name)))
+        else:
+            self.emit(('STORE_LOCAL', idx))
+
+    def compile_for_loop(self, node):
+        # Runs once the start value of the loop variable is on the stack. The
+        # bound and the step are evaluated once, into hidden locals after the
+        # variable, and a fourth one keeps the direction of the loop for
+        # FOR_PREP and FOR_LOOP (see vm.py).
+        do_label = self.make_label()
+        end_label = self.make_label()
+        name = node.assignment.left.name
+        idx = self.add_local_symbol(Symbol(name, SYM_VAR, self.scope_depth))
+        self.emit(('SET_SLOT', (idx, name)))
+
+        if node.step_val != None:
+            step = node.step_val
+        else:
+            # FOR_PREP sets the step to 1 or -1
+            step = ('PUSH', self.constant(TYPE_NUMBER, 0))
+
+        loop = [
+            ('LABEL', do_label),
+            self.begin_block,
+            node.do_stmts,
+            self.end_block,
+            ('FOR_LOOP', do_label, idx)]
+        items = [
+            node.condition_val,
+            lambda: self.add_hidden_local('(for bound)'),
+            step,
+            lambda: self.add_hidden_local('(for step)'),
+            ('PUSH', self.constant(TYPE_BOOL, True)),
+            lambda: self.add_hidden_local('(for up)'),
+            ('FOR_PREP', end_label, idx, node.step_val == None)]
+        invariants = self.loop_invariants(node)
+        if invariants:
+            # FOR_PREP jumps past the hoisted values if the body never runs
+            items += [*self.hoist(invariants, do_label), *loop, *self.unhoist(invariants)]
+        else:
+            items += loop
+        self.schedule(*items, ('LABEL', end_label), self.end_block)
+
+    def loop_invariants(self, loop, *exprs):
+        # Expressions of exprs and of the loop body that compute the same
+        # value on every pass through the loop
+        if not self.hoist_invariants:
+            return []
+        if self.name_types == None:
+            self.name_types = infer_name_types(self.root)
+            self.loop_sizes = loop_sizes(self.root)
+        if self.loop_sizes.get(loop, 0) > HOIST_LIMIT:
+            return []
+        exprs = [*exprs, *unconditional_exprs(loop.do_stmts)]
+        return invariant_exprs(exprs, assigned_names(loop, self.func_decls), self.hoisted, self.name_types)
+
+    def hoist(self, invariants, do_label):
+        # Work items that keep the values of invariants in hidden locals of a
+        # new block. They run after the loop condition held once and then
+        # enter the body without evaluating it again. Invariants can not fail
+        # or print, so computing them ahead of the body is not observable.
+        items = [self.begin_block]
+        for expr in invariants:
+            items += [expr, lambda expr = expr: self.add_hoisted(expr)]
+        items.append(('JMP', do_label))
+        return items
+
+    def add_hidden_local(self, name):
+        # Takes the value on top of the stack as a local of the current block
+        # that no name in the source refers to
+        idx = len(self.locals)
+        self.locals.append(Symbol(name, SYM_VAR, self.scope_depth))
+        self.emit(('SET_SLOT', (idx, name)))
+        return idx
+
+    def add_hoisted(self, expr):
+        self.hoisted[expr] = self.add_hidden_local('(invariant)')
+
+    def unhoist(self, invariants):
+        def remove():
+            for expr in invariants:
+                del self.hoisted[expr]
+        return [self.end_block, remove]
 
     def generate_code(self, root):
+        self.root = root
         self.emit(('LABEL', 'START'))
         self.compile(root)
         self.emit(('HALT',))
-        return self.code
\ No newline at end of file
+        while self.pending:
+            self.compile_deferred(*self.pending.pop())
+        return self.code
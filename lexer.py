@@ -1,9 +1,34 @@
 from tokens import *
 from utils import *
+import re
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+
+LEXER_SCAN  = 'scan'   # character-by-character reference scanner
+LEXER_REGEX = 'regex'  # single master regex, one match per token
+
+# Horizontal whitespace is folded into the match of the token that follows it.
+# Alternatives are tried in order, so comments must come before '-' and the
+# two-char operators before their one-char prefixes. Anything left over is
+# reported by the MISMATCH group.
+master_pattern = re.compile(r'''[ \t\r]*(?:
+    (?P<NEWLINE>\n[ \t\r\n]*)
+  | (?P<COMMENT>--[^\n]*)
+  | (?P<NUMBER>\d[\d.]*)
+  | (?P<STRING>"[^"]*"|'[^']*')
+  | (?P<NAME>[^\W\d]\w*)
+  | (?P<SYMBOL>:=|==|~=|<=|>=|<<|>>|[(){}\[\].,+\-*^/;?%=:<>~])
+  | (?P<MISMATCH>.)
+)''', re.VERBOSE)
+
+# Sources that are not a str are read in chunks of about this many characters,
+# always extended to the end of a line.
+CHUNK_SIZE = 64 * 1024
 
 class Lexer:
-    def __init__(self, source):
+    def __init__(self, source, engine = LEXER_REGEX):
         self.source = source
+        self.engine = engine
         self.start = 0
         self.curr = 0
         self.line = 1
@@ -34,6 +59,92 @@ class Lexer:
         self.tokens.append(Token(token_type, self.source[self.start:self.curr], self.line))
 
     def tokenize(self):
+        if self.engine == LEXER_REGEX or not isinstance(self.source, str):
+            return self.tokenize_regex()
+        return self.tokenize_scan()
+
+    def tokenize_regex(self):
+        self.tokens.extend(self.stream())
+        return self.tokens
+
+    def tokenize_compact(self, workers = 1):
+        # Same tokens as tokenize(), stored column-wise in a TokenStore.
+        # With workers > 1 the source is lexed in line-aligned chunks by a
+        # process pool.
+        source = self.source
+        if not isinstance(source, str):
+            source = ''.join(self.chunks())
+        store = TokenStore(source)
+        if workers > 1:
+            self.line = lex_parallel(store, source, self.line, workers)
+        else:
+            columns = lex_columns(source, 0, len(source), self.line)
+            store.extend(*columns[:4])
+            self.line = columns[4]
+            if columns[5] != -1:
+                lex_stop_error(source, columns[5], self.line)
+        return store
+
+    def chunks(self):
+        source = self.source
+        if isinstance(source, str):
+            yield source
+        elif isinstance(source, mmap.mmap):
+            pos = 0
+            while pos < len(source):
+                end = source.find(b'\n', pos + CHUNK_SIZE)
+                end = len(source) if end == -1 else end + 1
+                yield source[pos:end].decode('utf-8')
+                pos = end
+        else:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk: break
+                chunk += source.readline()
+                if isinstance(chunk, bytes): chunk = chunk.decode('utf-8')
+                yield chunk
+
+    def stream(self):
+        # Yields tokens as the source is read. Chunks always end at a newline,
+        # so only a string literal can be cut by a chunk boundary; its start is
+        # carried over and lexed again together with the next chunk.
+        #
+        # Streaming is an option of the API for eager parses. pinky.py reads
+        # the whole script instead: the cache key hashes the source, and lazy
+        # parsing goes back to the tokens of a function body on first use.
+        line = self.line
+        pending = ''
+        for chunk in self.chunks():
+            if pending:
+                chunk = pending + chunk
+                pending = ''
+            for m in master_pattern.finditer(chunk):
+                kind = m.lastgroup
+                lexeme = m[kind]
+                if kind == 'NAME':
+                    yield Token(keywords.get(lexeme, TOK_IDENTIFIER), lexeme, line)
+                elif kind == 'SYMBOL':
+                    yield Token(symbols[lexeme], lexeme, line)
+                elif kind == 'NEWLINE':
+                    line += lexeme.count('\n')
+                elif kind == 'NUMBER':
+                    dot_cnt = lexeme.count('.')
+                    if dot_cnt == 0: yield Token(TOK_INTEGER, lexeme, line)
+                    elif dot_cnt == 1: yield Token(TOK_FLOAT, lexeme, line)
+                elif kind == 'STRING':
+                    # Newlines inside strings are not counted, same as the scanner
+                    yield Token(TOK_STRING, lexeme[1:-1], line)
+                elif kind == 'MISMATCH':
+                    if lexeme == '"' or lexeme == "'":
+                        pending = chunk[m.start(kind):]
+                        break
+                    lexeing_error(f"Error at {lexeme!r}: Unexpected character", line)
+
+        if pending:
+            lexeing_error(f"Error at {pending[0]!r}: Unterminated string", line)
+        self.line = line
+
+    def tokenize_scan(self):
         while self.curr < len(self.source):
             self.start = self.curr
             ch = self.advance()
@@ -109,3 +220,114 @@ class Lexer:
             
         
         
+
+
+def lex_columns(source, start, end, line):
+    # Lexes source[start:end] into (types, starts, ends, lines) columns.
+    # Stops at the first character that starts no token, e.g. the quote of a
+    # string that is not closed before end, and returns its position, or -1.
+    types = array('B')
+    starts = array('I')
+    ends = array('I')
+    lines = array('I')
+    add_type = types.append
+    add_start = starts.append
+    add_end = ends.append
+    add_line = lines.append
+    for m in master_pattern.finditer(source, start, end):
+        kind = m.lastgroup
+        if kind == 'NEWLINE':
+            line += m[kind].count('\n')
+            continue
+        elif kind == 'NAME':
+            add_type(keywords.get(m[kind], TOK_IDENTIFIER))
+            add_start(m.start(kind))
+            add_end(m.end())
+        elif kind == 'SYMBOL':
+            add_type(symbols[m[kind]])
+            add_start(m.start(kind))
+            add_end(m.end())
+        elif kind == 'NUMBER':
+            dot_cnt = m[kind].count('.')
+            if dot_cnt > 1: continue
+            add_type(TOK_INTEGER if dot_cnt == 0 else TOK_FLOAT)
+            add_start(m.start(kind))
+            add_end(m.end())
+        elif kind == 'STRING':
+            add_type(TOK_STRING)
+            add_start(m.start(kind) + 1)
+            add_end(m.end() - 1)
+        elif kind == 'MISMATCH':
+            return (types, starts, ends, lines, line, m.start(kind))
+        else:
+            continue
+        add_line(line)
+    return (types, starts, ends, lines, line, -1)
+
+def lex_stop_error(source, pos, line):
+    ch = source[pos]
+    if ch == '"' or ch == "'":
+        lexeing_error(f"Error at {ch!r}: Unterminated string", line)
+    lexeing_error(f"Error at {ch!r}: Unexpected character", line)
+
+def split_lines(source, count):
+    size = len(source) // count + 1
+    bounds = []
+    start = 0
+    while start < len(source):
+        end = source.find('\n', start + size)
+        end = len(source) if end == -1 else end + 1
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+worker_source = None
+
+def init_lex_worker(source):
+    global worker_source
+    worker_source = source
+
+def lex_worker(start, end, line):
+    return lex_columns(worker_source, start, end, line)
+
+def lex_parallel(store, source, line, workers):
+    # Tokens never cross a newline except inside string literals, so every
+    # chunk is lexed on its own assuming it does not start inside a string,
+    # and with the line number it would have if no string before it spanned
+    # lines. Results are then checked in order: line numbers are shifted when
+    # an earlier string did span lines, and a chunk that ends inside an open
+    # string is lexed again from that string on, together with the chunks
+    # that follow it, until the string is closed.
+    bounds = split_lines(source, workers * 4)
+    first_lines = []
+    chunk_line = line
+    for start, end in bounds:
+        first_lines.append(chunk_line)
+        chunk_line += source.count('\n', start, end)
+
+    with ProcessPoolExecutor(workers, initializer=init_lex_worker, initargs=(source,)) as pool:
+        results = pool.map(lex_worker, [start for start, _ in bounds], [end for _, end in bounds], first_lines, chunksize=workers)
+        pos = 0
+        for idx, columns in enumerate(results):
+            if bounds[idx][1] <= pos: continue
+            types, starts, ends, lines, last_line, stop = columns
+            if line != first_lines[idx]:
+                delta = line - first_lines[idx]
+                lines = array('I', [token_line + delta for token_line in lines])
+                last_line += delta
+            store.extend(types, starts, ends, lines)
+            line = last_line
+            pos = bounds[idx][1]
+
+            next_idx = idx + 1
+            while stop != -1:
+                quote = source[stop]
+                close = source.find(quote, stop + 1) if quote == '"' or quote == "'" else -1
+                if close == -1:
+                    lex_stop_error(source, stop, line)
+                while bounds[next_idx][1] <= close: next_idx += 1
+                pos = bounds[next_idx][1]
+                types, starts, ends, lines, line, stop = lex_columns(source, stop, pos, line)
+                store.extend(types, starts, ends, lines)
+                next_idx += 1
+    return line
@@ -1,181 +1,343 @@
 from tokens import *
 
+# Structural checks run by every node constructor. Production runs turn them
+# off with set_validation(False) and may check a whole tree once instead with
+# validate_ast().
+VALIDATE = True
+
+def set_validation(enabled):
+    global VALIDATE
+    VALIDATE = enabled
+
 class Node:
-    pass
+    __slots__ = ()
+
+    def validate(self):
+        pass
+
+    def children(self):
+        # Direct child nodes, in field order
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if isinstance(value, Node):
+                yield value
+            elif isinstance(value, list):
+                yield from value
 
 class Expr(Node):
     # x + (3 * y)
-    pass
+    __slots__ = ()
 
 class Stmt(Node):
     # perform action (while, if, assign, etc)
-    pass
+    __slots__ = ()
 
 class Decl(Stmt):
-    pass
+    __slots__ = ()
 
 class Integer(Expr):
     # 123
+    __slots__ = ('value', 'line')
+
     def __init__(self, value, line):
-        assert isinstance(value, int), value
         self.value = value
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.value, int), self.value
 
 class Float(Expr):
     # 3.141592
+    __slots__ = ('value', 'line')
+
     def __init__(self, value, line):
-        assert isinstance(value, float), value
         self.value = value
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.value, float), self.value
 
 class Bool(Expr):
     # true, false
+    __slots__ = ('value', 'line')
+
     def __init__(self, value, line):
-        assert isinstance(value, bool), value
         self.value = value
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.value, bool), self.value
 
 class String(Expr):
     # true, false
+    __slots__ = ('value', 'line')
+
     def __init__(self, value, line):
-        assert isinstance(value, str), value
         self.value = value
         self.line = line
-    
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.value, str), self.value
+
 class UnOp(Expr):
     # -x
+    __slots__ = ('op', 'operand', 'line')
+
     def __init__(self, op : Token, operand : Expr, line):
-        assert isinstance(op, Token), op
-        assert isinstance(operand, Expr), operand
         self.op = op
         self.operand = operand
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.op, Token), self.op
+        assert isinstance(self.operand, Expr), self.operand
 
 class BinOp(Expr):
     # x + y
+    __slots__ = ('op', 'left', 'right', 'line')
+
     def __init__(self, op : Token, left : Expr, right : Expr, line):
-        assert isinstance(op, Token), op
-        assert isinstance(left, Expr), left
-        assert isinstance(right, Expr), right
         self.op = op
         self.left = left
         self.right = right
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.op, Token), self.op
+        assert isinstance(self.left, Expr), self.left
+        assert isinstance(self.right, Expr), self.right
 
 class LogicalOp(Expr):
+    __slots__ = ('op', 'left', 'right', 'line')
+
     def __init__(self, op : Token, left : Expr, right : Expr, line):
-        assert isinstance(op, Token), op
-        assert isinstance(left, Expr), left
-        assert isinstance(right, Expr), right
         self.op = op
         self.left = left
         self.right = right
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.op, Token), self.op
+        assert isinstance(self.left, Expr), self.left
+        assert isinstance(self.right, Expr), self.right
 
 class Grouping(Expr):
     # ( <Expr> )
+    __slots__ = ('value', 'line')
+
     def __init__(self, value, line):
-        assert isinstance(value, Expr), value
         self.value = value
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.value, Expr), self.value
 
 class Identifier(Expr):
     # x, PI, _a, start_val, etc...
+    __slots__ = ('name', 'line')
+
     def __init__(self, name, line):
-        assert isinstance(name, str), name
         self.name = name
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.name, str), self.name
 
 class Stmts(Node):
     # a list of statements
+    __slots__ = ('stmts', 'line')
+
     def __init__(self, stmts, line):
-        assert all(isinstance(stmt, Stmt) for stmt in stmts), stmts
         self.stmts = stmts
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert all(isinstance(stmt, Stmt) for stmt in self.stmts), self.stmts
+
+class LazyStmts(Stmts):
+    # Statements that are only parsed on first use, by calling build() to get
+    # the Stmts node. assigned holds the names that appear on the left of ':='
+    # in the skipped tokens.
+    __slots__ = ('build', 'parsed', 'assigned')
+
+    def __init__(self, build, line, assigned = ()):
+        self.build = build
+        self.parsed = None
+        self.assigned = assigned
+        self.line = line
+
+    @property
+    def stmts(self):
+        if self.parsed == None:
+            self.parsed = self.build()
+            self.build = None
+        return self.parsed.stmts
+
+    def is_parsed(self):
+        return self.parsed != None
+
+    def validate(self):
+        # The parsed statements are checked as a child node, an unparsed body
+        # is left alone
+        pass
 
 class PrintStmt(Stmt):
+    __slots__ = ('value', 'end', 'line')
+
     def __init__(self, value : Expr, end, line):
-        assert isinstance(value, Expr), value
         self.value = value
         self.end = end
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.value, Expr), self.value
 
 class IfStmt(Stmt):
+    __slots__ = ('condition', 'then_stmts', 'else_stmts', 'line')
+
     def __init__(self, condition : Expr, then_stmts : Stmts, else_stmts : Stmts, line):
-        assert isinstance(condition, Expr), condition
-        assert isinstance(then_stmts, Stmts), then_stmts
-        assert else_stmts is None or isinstance(else_stmts, Stmts), else_stmts
         self.condition = condition
         self.then_stmts = then_stmts
         self.else_stmts = else_stmts
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.condition, Expr), self.condition
+        assert isinstance(self.then_stmts, Stmts), self.then_stmts
+        assert self.else_stmts is None or isinstance(self.else_stmts, Stmts), self.else_stmts
 
 class WhileStmt(Stmt):
+    __slots__ = ('condition', 'do_stmts', 'line')
+
     def __init__(self, condition : Expr, do_stmts : Stmts, line):
-        assert isinstance(condition, Expr), condition
-        assert isinstance(do_stmts, Stmts), do_stmts
         self.condition = condition
         self.do_stmts = do_stmts
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.condition, Expr), self.condition
+        assert isinstance(self.do_stmts, Stmts), self.do_stmts
 
 class Assignment(Stmt):
+    __slots__ = ('left', 'right', 'line')
+
     def __init__(self, left : Expr, right : Expr, line):
-        assert isinstance(left, Expr), left
-        assert isinstance(right, Expr), right
         self.left = left
         self.right = right
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.left, Expr), self.left
+        assert isinstance(self.right, Expr), self.right
 
 class LocalAssignment(Stmt):
+    __slots__ = ('left', 'right', 'line')
+
     def __init__(self, left : Expr, right : Expr, line):
-        assert isinstance(left, Expr), left
-        assert isinstance(right, Expr), right
         self.left = left
         self.right = right
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.left, Expr), self.left
+        assert isinstance(self.right, Expr), self.right
 
 class ForStmt(Stmt):
+    __slots__ = ('assignment', 'condition_val', 'step_val', 'do_stmts', 'line')
+
     def __init__(self, assignment : Assignment, condition_val : Expr, step_val : Expr, do_stmts : Stmts, line):
-        assert isinstance(assignment, Assignment), assignment
-        assert isinstance(condition_val, Expr), condition
-        assert step_val is None or isinstance(step_val, Expr), step_val
-        assert isinstance(do_stmts, Stmts), do_stmts
         self.assignment = assignment
         self.condition_val = condition_val
         self.step_val = step_val
-        self.do_stmts = do_stmts     
-        self.line = line   
+        self.do_stmts = do_stmts
+        self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.assignment, Assignment), self.assignment
+        assert isinstance(self.condition_val, Expr), self.condition_val
+        assert self.step_val is None or isinstance(self.step_val, Expr), self.step_val
+        assert isinstance(self.do_stmts, Stmts), self.do_stmts
 
 class Param(Decl):
+    __slots__ = ('identifier', 'line')
+
     def __init__(self, identifier, line):
-        assert isinstance(identifier, Identifier), identifier
         self.identifier = identifier
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.identifier, Identifier), self.identifier
 
 class FuncDecl(Decl):
+    __slots__ = ('identifier', 'params', 'body_stmts', 'line')
+
     def __init__(self, identifier, params, body_stmts, line):
-        assert isinstance(identifier, Identifier), identifier
-        assert all(isinstance(param, Param) for param in params), params
         self.identifier = identifier
         self.params = params
         self.body_stmts = body_stmts
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.identifier, Identifier), self.identifier
+        assert all(isinstance(param, Param) for param in self.params), self.params
 
 class FuncCall(Expr):
+    __slots__ = ('identifier', 'args', 'line')
+
     def __init__(self, identifier, args, line):
-        assert isinstance(identifier, Identifier), identifier
-        assert all(isinstance(arg, Expr) for arg in args), args
         self.identifier = identifier
         self.args = args
         self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.identifier, Identifier), self.identifier
+        assert all(isinstance(arg, Expr) for arg in self.args), self.args
 
 class FuncCallStmt(Stmt):
+    __slots__ = ('func_call',)
+
     def __init__(self, func_call : FuncCall):
-        assert isinstance(func_call, FuncCall)
         self.func_call = func_call
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.func_call, FuncCall)
 
 class RetStmt(Stmt):
+    __slots__ = ('value', 'line')
+
     def __init__(self, value : Expr, line):
-        assert isinstance(value, Expr)
         self.value = value
-        self.line = line
\ No newline at end of file
+        self.line = line
+        if VALIDATE: self.validate()
+
+    def validate(self):
+        assert isinstance(self.value, Expr)
+
+def validate_ast(root):
+    # Runs the constructor checks over a whole tree, e.g. one built with
+    # validation turned off
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        node.validate()
+        pending.extend(node.children())
@@ -0,0 +1,282 @@
+from model import *
+from tokens import *
+from utils import *
+from defs import *
+
+# Optimization passes over the model AST, run between the parser and the
+# compiler. They rewrite the tree in place and only fold what the VM would
+# compute the same way at runtime: operations that fail in the VM (type
+# errors, division by zero) are left for the VM to report.
+
+literal_types = (Integer, Float, String, Bool)
+
+def literal_value(node):
+    if isinstance(node, (Integer, Float)):
+        return (TYPE_NUMBER, float(node.value))
+    elif isinstance(node, Bool):
+        return (TYPE_BOOL, node.value)
+    else:
+        return (TYPE_STRING, node.value)
+
+def make_literal(value, line):
+    type, value = value
+    if type == TYPE_NUMBER:
+        return Float(value, line)
+    elif type == TYPE_BOOL:
+        return Bool(value, line)
+    else:
+        return String(value, line)
+
+def fold_binary(op, left, right):
+    # The value of left op right as the VM computes it, or None
+    type1, value1 = left
+    type2, value2 = right
+    numbers = type1 == TYPE_NUMBER and type2 == TYPE_NUMBER
+    if op == TOK_PLUS:
+        if numbers:
+            return (TYPE_NUMBER, value1 + value2)
+        elif type1 == TYPE_STRING or type2 == TYPE_STRING:
+            return (TYPE_STRING, stringify(value1) + stringify(value2))
+    elif op == TOK_MINUS:
+        if numbers: return (TYPE_NUMBER, value1 - value2)
+    elif op == TOK_STAR:
+        if numbers: return (TYPE_NUMBER, value1 * value2)
+    elif op == TOK_SLASH:
+        if numbers and value2 != 0: return (TYPE_NUMBER, value1 / value2)
+    elif op == TOK_MOD:
+        if numbers and value2 != 0: return (TYPE_NUMBER, value1 % value2)
+    elif op == TOK_CARET:
+        if numbers:
+            try:
+                value = value1 ** value2
+            except ArithmeticError:
+                return None
+            if isinstance(value, float): return (TYPE_NUMBER, value)
+    elif op in (TOK_EQEQ, TOK_NE):
+        if type1 == type2:
+            return (TYPE_BOOL, (value1 == value2) == (op == TOK_EQEQ))
+    elif op in (TOK_LT, TOK_GT, TOK_LE, TOK_GE):
+        if type1 == type2 and type1 != TYPE_BOOL:
+            if op == TOK_LT: return (TYPE_BOOL, value1 < value2)
+            elif op == TOK_GT: return (TYPE_BOOL, value1 > value2)
+            elif op == TOK_LE: return (TYPE_BOOL, value1 <= value2)
+            else: return (TYPE_BOOL, value1 >= value2)
+    return None
+
+def fold_expr(node):
+    # Folds an expression whose operands were folded already
+    if isinstance(node, Grouping):
+        if isinstance(node.value, literal_types): return node.value
+    elif isinstance(node, UnOp):
+        op = node.op.token_type
+        if op == TOK_PLUS:
+            # Unary plus compiles to its operand alone
+            return node.operand
+        elif isinstance(node.operand, literal_types):
+            type, value = literal_value(node.operand)
+            if op == TOK_MINUS and type == TYPE_NUMBER:
+                return Float(-value, node.line)
+            elif op == TOK_NOT and type == TYPE_BOOL:
+                return Bool(not value, node.line)
+    elif isinstance(node, LogicalOp):
+        # A literal left operand decides whether the right one runs
+        if isinstance(node.left, literal_types):
+            truthy = bool(literal_value(node.left)[1])
+            if truthy == (node.op.token_type == TOK_AND):
+                return node.right
+            return node.left
+    elif isinstance(node, BinOp):
+        if isinstance(node.left, literal_types) and isinstance(node.right, literal_types):
+            value = fold_binary(node.op.token_type, literal_value(node.left), literal_value(node.right))
+            if value != None: return make_literal(value, node.line)
+    return node
+
+def is_name_slot(node, name):
+    # Identifier fields that name a variable or function instead of reading it
+    return name == 'identifier' or (name == 'left' and isinstance(node, (Assignment, LocalAssignment)))
+
+def fold_tree(root, constants = None):
+    # Folds every expression under root and replaces reads of the names in
+    # constants with their literal. Returns the folded root. The walk keeps
+    # its own stack, so deep trees fold without recursion.
+    if constants == None: constants = {}
+    folded = {}
+    stack = [(root, False)]
+    while stack:
+        node, done = stack.pop()
+        if not done:
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.children())
+            continue
+
+        for name in node.__slots__:
+            value = getattr(node, name)
+            if isinstance(value, Node):
+                new_value = folded.pop(id(value), value)
+                if isinstance(new_value, Identifier) and new_value.name in constants and not is_name_slot(node, name):
+                    literal = constants[new_value.name]
+                    new_value = type(literal)(literal.value, new_value.line)
+                if new_value is not value: setattr(node, name, new_value)
+            elif isinstance(value, list):
+                new_values = []
+                for item in value:
+                    item = folded.pop(id(item), item)
+                    if isinstance(item, Identifier) and item.name in constants:
+                        literal = constants[item.name]
+                        item = type(literal)(literal.value, item.line)
+                    new_values.append(item)
+                if any(new is not old for new, old in zip(new_values, value)): setattr(node, name, new_values)
+
+        if isinstance(node, Expr):
+            new_node = fold_expr(node)
+            if new_node is not node: folded[id(node)] = new_node
+        elif isinstance(node, LazyStmts) and not node.is_parsed():
+            # Folded once it is parsed, without propagating constants
+            node.build = lambda build = node.build: fold_tree(build())
+
+    return folded.get(id(root), root)
+
+def collect_names(root):
+    # Counts the assignments to each name and collects the names that may
+    # also refer to a local (local variables, parameters and anything
+    # assigned in a function body that was not parsed yet)
+    assigned = {}
+    shadowed = set()
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, Assignment):
+            assigned[node.left.name] = assigned.get(node.left.name, 0) + 1
+        elif isinstance(node, LocalAssignment):
+            shadowed.add(node.left.name)
+        elif isinstance(node, Param):
+            shadowed.add(node.identifier.name)
+        elif isinstance(node, LazyStmts) and not node.is_parsed():
+            shadowed.update(node.assigned)
+        pending.extend(node.children())
+    return assigned, shadowed
+
+def prune_stmts(stmts, reachable = None):
+    # Drops the statements of a block that can never run: branches under a
+    # constant condition, statements after ret, and declarations of functions
+    # that are not in reachable
+    new_stmts = []
+    for idx, stmt in enumerate(stmts):
+        if isinstance(stmt, FuncDecl) and reachable != None and stmt.identifier.name not in reachable:
+            continue
+        elif isinstance(stmt, IfStmt) and isinstance(stmt.condition, Bool):
+            if stmt.condition.value:
+                if stmt.else_stmts != None:
+                    stmt = IfStmt(stmt.condition, stmt.then_stmts, None, stmt.line)
+            elif stmt.else_stmts == None:
+                continue
+            else:
+                stmt = IfStmt(Bool(True, stmt.condition.line), stmt.else_stmts, None, stmt.line)
+        elif isinstance(stmt, WhileStmt) and isinstance(stmt.condition, Bool) and not stmt.condition.value:
+            continue
+
+        new_stmts.append(stmt)
+        if isinstance(stmt, RetStmt):
+            # A function declared after ret is still visible to later code,
+            # so such blocks are kept as they are
+            if not any(isinstance(rest, FuncDecl) for rest in stmts[idx + 1:]):
+                break
+    return new_stmts
+
+block_types = (Stmts, IfStmt, WhileStmt, ForStmt, FuncDecl)
+
+def prune_tree(root, reachable = None):
+    # Prunes every block under root and returns the pruned root. A node with
+    # a block that changed is built again instead of changed in place, as
+    # the views of an Arena can not be changed. Children are pruned before
+    # their parents, with the stack of fold_tree.
+    pruned = {}
+    stack = [(root, False)]
+    while stack:
+        node, done = stack.pop()
+        if not done:
+            if isinstance(node, LazyStmts) and not node.is_parsed(): continue
+            stack.append((node, True))
+            stack.extend((child, False) for child in node.children() if isinstance(child, block_types))
+            continue
+
+        if isinstance(node, LazyStmts):
+            # Keeps the parsed body, lazy bodies are only made of model nodes
+            node.parsed = pruned.pop(node.parsed, node.parsed)
+        elif isinstance(node, Stmts):
+            old_stmts = node.stmts
+            stmts = prune_stmts([pruned.pop(stmt, stmt) for stmt in old_stmts], reachable)
+            if len(stmts) != len(old_stmts) or any(new is not old for new, old in zip(stmts, old_stmts)):
+                pruned[node] = Stmts(stmts, node.line)
+        elif isinstance(node, IfStmt):
+            then_stmts, else_stmts = node.then_stmts, node.else_stmts
+            new_then = pruned.pop(then_stmts, then_stmts)
+            new_else = pruned.pop(else_stmts, else_stmts) if else_stmts != None else None
+            if new_then is not then_stmts or new_else is not else_stmts:
+                pruned[node] = IfStmt(node.condition, new_then, new_else, node.line)
+        elif isinstance(node, (WhileStmt, ForStmt)):
+            do_stmts = node.do_stmts
+            new_do = pruned.pop(do_stmts, do_stmts)
+            if new_do is not do_stmts and isinstance(node, WhileStmt):
+                pruned[node] = WhileStmt(node.condition, new_do, node.line)
+            elif new_do is not do_stmts:
+                pruned[node] = ForStmt(node.assignment, node.condition_val, node.step_val, new_do, node.line)
+        elif isinstance(node, FuncDecl):
+            body_stmts = node.body_stmts
+            new_body = pruned.pop(body_stmts, body_stmts)
+            if new_body is not body_stmts:
+                pruned[node] = FuncDecl(node.identifier, node.params, new_body, node.line)
+
+    return pruned.get(root, root)
+
+def reachable_functions(root):
+    # Names of the functions that can be called from the main program, or
+    # None when a call can not be matched to a declaration. Only the bodies
+    # of reachable functions are walked, so unused lazy bodies stay unparsed.
+    declared = {}
+    reachable = set()
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, FuncDecl):
+            name = node.identifier.name
+            declared.setdefault(name, []).append(node)
+            if name in reachable: pending.append(node.body_stmts)
+            continue
+        elif isinstance(node, FuncCall) and node.identifier.name not in reachable:
+            name = node.identifier.name
+            reachable.add(name)
+            pending.extend(decl.body_stmts for decl in declared.get(name, []))
+        elif isinstance(node, LazyStmts) and not node.is_parsed():
+            node.stmts  # parses the body
+        pending.extend(node.children())
+
+    if any(name not in declared for name in reachable):
+        return None
+    return reachable
+
+def eliminate_dead_code(root):
+    # Removes unreachable statements and the declarations of functions that
+    # are never called
+    root = prune_tree(root)
+    reachable = reachable_functions(root)
+    if reachable != None:
+        root = prune_tree(root, reachable)
+    return root
+
+def optimize(root):
+    # Folds constant expressions and propagates top-level globals that are
+    # assigned a literal exactly once into the statements that follow, then
+    # removes dead code
+    if not isinstance(root, Stmts):
+        return fold_tree(root)
+
+    assigned, shadowed = collect_names(root)
+    constants = {}
+    for stmt in root.stmts:
+        fold_tree(stmt, constants)
+        if isinstance(stmt, Assignment) and isinstance(stmt.right, literal_types):
+            name = stmt.left.name
+            if assigned[name] == 1 and name not in shadowed:
+                constants[name] = stmt.right
+    return eliminate_dead_code(root)
@@ -1,66 +1,363 @@
 from tokens import *
 from model import *
+import model
 from utils import *
 
+# Binding powers of the binary operators: (left bp, right bp, node type).
+# Left-associative operators bind tighter on the right, '^' is
+# right-associative and binds tighter on the left.
+binary_operators = {
+    TOK_OR    : (1, 2, 'LogicalOp'),
+    TOK_AND   : (3, 4, 'LogicalOp'),
+    TOK_NE    : (5, 6, 'BinOp'),
+    TOK_EQEQ  : (5, 6, 'BinOp'),
+    TOK_GT    : (7, 8, 'BinOp'),
+    TOK_GE    : (7, 8, 'BinOp'),
+    TOK_LT    : (7, 8, 'BinOp'),
+    TOK_LE    : (7, 8, 'BinOp'),
+    TOK_PLUS  : (9, 10, 'BinOp'),
+    TOK_MINUS : (9, 10, 'BinOp'),
+    TOK_STAR  : (11, 12, 'BinOp'),
+    TOK_SLASH : (11, 12, 'BinOp'),
+    TOK_MOD   : (13, 14, 'BinOp'),
+    TOK_CARET : (16, 15, 'BinOp')
+}
+
+unary_operators = {TOK_PLUS, TOK_MINUS, TOK_NOT}
+
+# Kinds of the frames on the expression parser stack
+FRAME_UNARY  = 0  # (FRAME_UNARY, op)
+FRAME_BINARY = 1  # (FRAME_BINARY, op, left, right bp, node type)
+FRAME_GROUP  = 2  # (FRAME_GROUP,)
+FRAME_CALL   = 3  # (FRAME_CALL, identifier, args)
+
+# Kinds of the frames on the statement parser stack, one for each open block
+BLOCK_IF    = 0  # (BLOCK_IF, condition)
+BLOCK_ELSE  = 1  # (BLOCK_ELSE, condition, then stmts)
+BLOCK_WHILE = 2  # (BLOCK_WHILE, condition)
+BLOCK_FOR   = 3  # (BLOCK_FOR, assignment, condition, step)
+BLOCK_FUNC  = 4  # (BLOCK_FUNC, identifier, params)
+
+# Statements that open a block closed by 'end'
+block_openers = {TOK_IF, TOK_WHILE, TOK_FOR, TOK_FUNC}
+
 class Parser:
-    def __init__(self, tokens):
-        self.tokens = tokens
+    def __init__(self, tokens, ast = model, lazy = False):
+        # tokens is a list of Token, a TokenStore or any token iterator,
+        # e.g. Lexer.stream(). Nodes are built by ast, the model module or an
+        # Arena.
+        #
+        # With lazy set, function bodies are skipped and only parsed when
+        # they are first used. This needs model nodes and tokens that stay
+        # around after parsing, a token iterator is always parsed eagerly.
+        self.tokens = token_source(tokens)
+        self.ast = ast
+        self.lazy = lazy and ast is model and not isinstance(self.tokens, TokenStream)
         self.curr = 0
+        self.curr_type = self.tokens.kind(0)
 
     def peek(self):
-        return self.tokens[self.curr]
+        return self.tokens.token(self.curr)
         
     def advance(self):
         token = self.peek()
         self.curr = self.curr + 1
+        self.curr_type = self.tokens.kind(self.curr)
         return token
 
+    def is_at_end(self):
+        return self.curr_type == None
+
     def check(self, expected):
-        if self.curr >= len(self.tokens): return False
-        return self.peek().token_type == expected
+        return self.curr_type == expected
 
     def expect(self, expected):
-        if self.curr >= len(self.tokens):
-            parse_error(f'Expected {expected!r}, found EOF', self.previous_token().line)
-        elif self.peek().token_type != expected:
-            parse_error(f'Expected {expected!r}, found {self.peek().token_type!r}', self.peek().line)
+        if self.curr_type == None:
+            parse_error(f'Expected {token_names[expected]!r}, found EOF', self.previous_line())
+        elif self.curr_type != expected:
+            parse_error(f'Expected {token_names[expected]!r}, found {token_names[self.curr_type]!r}', self.tokens.line(self.curr))
         else:
-            return self.advance()
+            return self.match(expected)
 
     def match(self, expected):
-        if self.curr >= len(self.tokens) or self.peek().token_type != expected: return False
+        if self.curr_type != expected: return False
         self.curr = self.curr + 1
+        self.curr_type = self.tokens.kind(self.curr)
         return True
 
     def previous_token(self):
-        return self.tokens[self.curr - 1]
+        return self.tokens.token(self.curr - 1)
+
+    def previous_lexeme(self):
+        return self.tokens.lexeme(self.curr - 1)
+
+    def previous_line(self):
+        return self.tokens.line(self.curr - 1)
+
+    def literal(self):
+        if self.match(TOK_INTEGER): return self.ast.Integer(int(self.previous_lexeme()), self.previous_line())
+        elif self.match(TOK_FLOAT): return self.ast.Float(float(self.previous_lexeme()), self.previous_line())
+        elif self.match(TOK_TRUE): return self.ast.Bool(True, self.previous_line())
+        elif self.match(TOK_FALSE): return self.ast.Bool(False, self.previous_line())
+        elif self.match(TOK_STRING): return self.ast.String(self.previous_lexeme(), self.previous_line())
+        elif self.is_at_end(): parse_error(f'Expected expression, found EOF', self.previous_line())
+        else: parse_error(f'Expected expression, found {token_names[self.curr_type]!r}', self.tokens.line(self.curr))
+
+    def expr(self):
+        # Precedence climbing with an explicit stack instead of recursion, so
+        # the nesting depth of an expression is only limited by memory. Each
+        # frame is a prefix operator, a binary operator, a '(' or a call that
+        # is waiting for its next operand.
+        stack = []
+        while True:
+            # Read one operand, opening frames for everything before it
+            operand = None
+            while operand == None:
+                if self.curr_type in unary_operators:
+                    stack.append((FRAME_UNARY, self.advance()))
+                elif self.match(TOK_LPAREN):
+                    stack.append((FRAME_GROUP,))
+                elif self.match(TOK_IDENTIFIER):
+                    identifier = self.ast.Identifier(self.previous_lexeme(), self.previous_line())
+                    if not self.match(TOK_LPAREN):
+                        operand = identifier
+                    elif self.match(TOK_RPAREN):
+                        operand = self.ast.FuncCall(identifier, [], self.previous_line())
+                    else:
+                        stack.append((FRAME_CALL, identifier, []))
+                else:
+                    operand = self.literal()
+
+            # Close frames until one needs another operand
+            while True:
+                while stack and stack[-1][0] == FRAME_UNARY:
+                    op = stack.pop()[1]
+                    operand = self.ast.UnOp(op, operand, op.line)
+
+                frame = stack[-1] if stack else None
+                min_bp = frame[3] if frame != None and frame[0] == FRAME_BINARY else 0
+                operator = binary_operators.get(self.curr_type)
+                if operator != None and operator[0] >= min_bp:
+                    stack.append((FRAME_BINARY, self.advance(), operand, operator[1], operator[2]))
+                    break
+                if frame == None:
+                    return operand
+
+                stack.pop()
+                if frame[0] == FRAME_BINARY:
+                    _, op, left, _, node_type = frame
+                    operand = getattr(self.ast, node_type)(op, left, operand, op.line)
+                elif frame[0] == FRAME_GROUP:
+                    if not self.match(TOK_RPAREN): parse_error(f'Error: ")" expected.', self.previous_line())
+                    operand = self.ast.Grouping(operand, self.previous_line())
+                else:
+                    _, identifier, args = frame
+                    args.append(operand)
+                    self.match(TOK_COMMA)
+                    if self.match(TOK_RPAREN):
+                        operand = self.ast.FuncCall(identifier, args, self.previous_line())
+                    else:
+                        stack.append(frame)
+                        break
+
+    def print_stmt(self, end):
+        if self.match(TOK_PRINT) or self.match(TOK_PRINTLN):
+            val = self.expr()
+            return self.ast.PrintStmt(val, end, self.previous_line())
+
+    def if_header(self):
+        self.expect(TOK_IF)
+        condition = self.expr()
+        self.expect(TOK_THEN)
+        return (BLOCK_IF, condition)
+
+    def while_header(self):
+        self.expect(TOK_WHILE)
+        condition = self.expr()
+        self.expect(TOK_DO)
+        return (BLOCK_WHILE, condition)
+
+    def for_header(self):
+        self.expect(TOK_FOR)
+        assignment = self.stmt()
+        self.expect(TOK_COMMA)
+        condition_val = self.expr()
+        if self.match(TOK_COMMA): step_val = self.expr()
+        else: step_val = None
+        self.expect(TOK_DO)
+        return (BLOCK_FOR, assignment, condition_val, step_val)
+
+    def func_header(self):
+        self.expect(TOK_FUNC)
+        self.expect(TOK_IDENTIFIER)
+        identifier = self.ast.Identifier(self.previous_lexeme(), self.previous_line())
+        self.expect(TOK_LPAREN)
+
+        max_params_cnt = 255
+        curr_parmas_cnt = 0
+        params = []
+        while not self.match(TOK_RPAREN):
+            self.expect(TOK_IDENTIFIER)
+
+            if curr_parmas_cnt >= max_params_cnt:
+                parse_error(f"Functions can not have arguments more than {max_params_cnt}", self.previous_line())
+
+            params.append(self.ast.Param(self.ast.Identifier(self.previous_lexeme(), self.previous_line()), self.previous_line()))
+            curr_parmas_cnt += 1
+            self.match(TOK_COMMA)
+        return (BLOCK_FUNC, identifier, params)
+
+    def lazy_func_decl(self, identifier, params):
+        # The function body is skipped and parsed when it is first used
+        start = self.curr
+        assigned = self.skip_block()
+        body_stmts = self.ast.LazyStmts(lambda: self.func_body(start), self.tokens.line(start), assigned)
+        self.expect(TOK_END)
+        return self.ast.FuncDecl(identifier, params, body_stmts, self.previous_line())
+
+    def skip_block(self):
+        # Moves to the 'end' that closes the current block without building
+        # any nodes and returns the names assigned to in the block
+        assigned = set()
+        depth = 0
+        while depth > 0 or not self.check(TOK_END):
+            if self.is_at_end():
+                parse_error(f'Expected {token_names[TOK_END]!r}, found EOF', self.previous_line())
+            elif self.curr_type in block_openers:
+                depth += 1
+            elif self.curr_type == TOK_END:
+                depth -= 1
+            elif self.curr_type == TOK_IDENTIFIER and self.tokens.kind(self.curr + 1) == TOK_ASSIGN:
+                assigned.add(self.tokens.lexeme(self.curr))
+            self.curr = self.curr + 1
+            self.curr_type = self.tokens.kind(self.curr)
+        return assigned
+
+    def func_body(self, start):
+        # Parses a function body skipped by a lazy parse
+        parser = self.__class__(self.tokens, self.ast, self.lazy)
+        parser.curr = start
+        parser.curr_type = self.tokens.kind(start)
+        body_stmts = parser.stmts()
+        parser.expect(TOK_END)
+        return body_stmts
+
+    def ret_stmt(self):
+        self.expect(TOK_RET)
+        return self.ast.RetStmt(self.expr(), self.previous_line())
+    
+    def local_assign(self):
+        self.expect(TOK_LOCAL)
+        left = self.expr()
+        self.expect(TOK_ASSIGN)
+        right = self.expr()
+        return self.ast.LocalAssignment(left, right, self.previous_line())
+
+    def stmt(self):
+        # A statement that does not open a block, blocks are parsed by stmts
+        if self.check(TOK_PRINT):
+            return self.print_stmt('')
+        elif self.check(TOK_PRINTLN):
+            return self.print_stmt('\n')
+        elif self.check(TOK_RET):
+            return self.ret_stmt()
+        elif self.check(TOK_LOCAL):
+            return self.local_assign()
+        else:
+            left = self.expr()
+            if self.match(TOK_ASSIGN):
+                right = self.expr()
+                return self.ast.Assignment(left, right, self.previous_line())
+            else:
+                return self.ast.FuncCallStmt(left)
+
+    def stmts(self):
+        # Statements up to the 'else', 'end' or EOF that closes the current
+        # block. Nested blocks are kept on an explicit stack like the operands
+        # of expr, so the nesting depth is only limited by memory. Each entry
+        # is the frame of an open block and the statements of the block
+        # around it.
+        stack = []
+        stmts = []
+        while True:
+            if not self.is_at_end() and not self.check(TOK_ELSE) and not self.check(TOK_END):
+                if self.check(TOK_IF):
+                    frame = self.if_header()
+                elif self.check(TOK_WHILE):
+                    frame = self.while_header()
+                elif self.check(TOK_FOR):
+                    frame = self.for_header()
+                elif self.check(TOK_FUNC):
+                    frame = self.func_header()
+                    if self.lazy:
+                        stmts.append(self.lazy_func_decl(frame[1], frame[2]))
+                        continue
+                else:
+                    stmts.append(self.stmt())
+                    continue
+                stack.append((frame, stmts))
+                stmts = []
+                continue
+
+            block = self.ast.Stmts(stmts, self.previous_line())
+            if not stack:
+                return block
+
+            frame, stmts = stack.pop()
+            if frame[0] == BLOCK_IF and self.match(TOK_ELSE):
+                stack.append(((BLOCK_ELSE, frame[1], block), stmts))
+                stmts = []
+                continue
+
+            self.expect(TOK_END)
+            if frame[0] == BLOCK_IF:
+                stmt = self.ast.IfStmt(frame[1], block, None, self.previous_line())
+            elif frame[0] == BLOCK_ELSE:
+                stmt = self.ast.IfStmt(frame[1], frame[2], block, self.previous_line())
+            elif frame[0] == BLOCK_WHILE:
+                stmt = self.ast.WhileStmt(frame[1], block, self.previous_line())
+            elif frame[0] == BLOCK_FOR:
+                stmt = self.ast.ForStmt(frame[1], frame[2], frame[3], block, self.previous_line())
+            else:
+                stmt = self.ast.FuncDecl(frame[1], frame[2], block, self.previous_line())
+            stmts.append(stmt)
+    
+    def program(self):
+        return self.stmts()
+
+    def parse(self):
+        return self.program()
+
+class ChainParser(Parser):
+    # Reference parser with one recursive method per precedence level, kept
+    # to check and benchmark Parser.expr against
 
     def primary(self):
-        if self.match(TOK_INTEGER): return Integer(int(self.previous_token().lexeme), self.previous_token().line)
-        elif self.match(TOK_FLOAT): return Float(float(self.previous_token().lexeme), self.previous_token().line)
-        elif self.match(TOK_TRUE): return Bool(True, self.previous_token().line)
-        elif self.match(TOK_FALSE): return Bool(False, self.previous_token().line)
-        elif self.match(TOK_STRING): return String(self.previous_token().lexeme, self.previous_token().line)
+        if self.match(TOK_INTEGER): return self.ast.Integer(int(self.previous_lexeme()), self.previous_line())
+        elif self.match(TOK_FLOAT): return self.ast.Float(float(self.previous_lexeme()), self.previous_line())
+        elif self.match(TOK_TRUE): return self.ast.Bool(True, self.previous_line())
+        elif self.match(TOK_FALSE): return self.ast.Bool(False, self.previous_line())
+        elif self.match(TOK_STRING): return self.ast.String(self.previous_lexeme(), self.previous_line())
         elif self.match(TOK_LPAREN):
             expr = self.expr()
-            if self.match(TOK_RPAREN): return Grouping(expr, self.previous_token().line)
-            else: parse_error(f'Error: ")" expected.', self.previous_token().line)
+            if self.match(TOK_RPAREN): return self.ast.Grouping(expr, self.previous_line())
+            else: parse_error(f'Error: ")" expected.', self.previous_line())
         elif self.match(TOK_IDENTIFIER): 
-            identifier = Identifier(self.previous_token().lexeme, self.previous_token().line)
+            identifier = self.ast.Identifier(self.previous_lexeme(), self.previous_line())
             if self.match(TOK_LPAREN):
                 args = []
                 while not self.match(TOK_RPAREN):
                     args.append(self.expr())
                     self.match(TOK_COMMA)
-                return FuncCall(identifier, args, self.previous_token().line)
+                return self.ast.FuncCall(identifier, args, self.previous_line())
             else:
                 return identifier
 
     def unary(self):
-        if self.match(TOK_PLUS) or self.match(TOK_MINUS) or self.match(TOK_NOT):
-            op = self.previous_token()
+        if self.curr_type in unary_operators:
+            op = self.advance()
             operand = self.unary()
-            return UnOp(op, operand, op.line)
+            return self.ast.UnOp(op, operand, op.line)
         else:
             return self.primary()
 
@@ -131,112 +428,3 @@ class Parser:
     def expr(self):
         return self.or_logical()
 
-    def print_stmt(self, end):
-        if self.match(TOK_PRINT) or self.match(TOK_PRINTLN):
-            val = self.expr()
-            return PrintStmt(val, end, self.previous_token().line)
-
-    def if_stmt(self):
-        self.expect(TOK_IF)
-        condition = self.expr()
-        self.expect(TOK_THEN)
-        then_stmts = self.stmts()
-        if self.match(TOK_ELSE):
-            else_stmts = self.stmts()
-        else:
-            else_stmts = None
-        self.expect(TOK_END)
-        return IfStmt(condition, then_stmts, else_stmts, self.previous_token().line)
-
-    def while_stmt(self):
-        self.expect(TOK_WHILE)
-        condition = self.expr()
-        self.expect(TOK_DO)
-        do_stmts = self.stmts()
-        self.expect(TOK_END)
-        return WhileStmt(condition, do_stmts, self.previous_token().line)
-
-    def for_stmt(self):
-        self.expect(TOK_FOR)
-        assignment = self.stmt()
-        self.expect(TOK_COMMA)
-        condition_val = self.expr()
-        if self.match(TOK_COMMA): step_val = self.expr()
-        else: step_val = None
-        self.expect(TOK_DO)
-        do_stmts = self.stmts()
-        self.expect(TOK_END)
-        return ForStmt(assignment, condition_val, step_val, do_stmts, self.previous_token().line)
-
-    def func_decl(self):
-        self.expect(TOK_FUNC)
-        self.expect(TOK_IDENTIFIER)
-        identifier = Identifier(self.previous_token().lexeme, self.previous_token().line)
-        self.expect(TOK_LPAREN)
-
-        max_params_cnt = 255
-        curr_parmas_cnt = 0
-        params = []
-        while not self.match(TOK_RPAREN):
-            self.expect(TOK_IDENTIFIER)
-
-            if curr_parmas_cnt >= max_params_cnt:
-                parse_error(f"Functions can not have arguments more than {max_params_cnt}", self.previous_token().line)
-
-            params.append(Param(Identifier(self.previous_token().lexeme, self.previous_token().line), self.previous_token().line))
-            curr_parmas_cnt += 1
-            self.match(TOK_COMMA)
-
-        body_stmts = self.stmts()
-        self.expect(TOK_END)
-        return FuncDecl(identifier, params, body_stmts, self.previous_token().line)
-
-    def ret_stmt(self):
-        self.expect(TOK_RET)
-        return RetStmt(self.expr(), self.previous_token().line)
-    
-    def local_assign(self):
-        self.expect(TOK_LOCAL)
-        left = self.expr()
-        self.expect(TOK_ASSIGN)
-        right = self.expr()
-        return LocalAssignment(left, right, self.previous_token().line)
-
-    def stmt(self):
-        if self.check(TOK_PRINT):
-            return self.print_stmt('')
-        elif self.check(TOK_PRINTLN):
-            return self.print_stmt('\n')
-        elif self.check(TOK_IF):
-            return self.if_stmt()
-        elif self.check(TOK_WHILE):
-            return self.while_stmt()
-        elif self.check(TOK_FOR):
-            return self.for_stmt()
-        elif self.check(TOK_FUNC):
-            return self.func_decl()
-        elif self.check(TOK_RET):
-            return self.ret_stmt()
-        elif self.check(TOK_LOCAL):
-            return self.local_assign()
-        else:
-            left = self.expr()
-            if self.match(TOK_ASSIGN):
-                right = self.expr()
-                return Assignment(left, right, self.previous_token().line)
-            else:
-                return FuncCallStmt(left)
-
-    def stmts(self):
-        stmts = []
-        while self.curr < len(self.tokens) and not self.check(TOK_ELSE) and not self.check(TOK_END):
-            stmts.append(self.stmt())
-        return Stmts(stmts, self.previous_token().line)
-    
-    def program(self):
-        return self.stmts()
-
-    def parse(self):
-        return self.program()
-
-            
\ No newline at end of file
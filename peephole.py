@@ -0,0 +1,212 @@
+from collections import Counter
+from defs import *
+from assembler import *
+
+# Peephole optimizer over the instruction list of the compiler, run before
+# the program is assembled. Each pass is a local rewrite that keeps the
+# program's behaviour:
+#
+#      unused labels     LABEL nobody jumps to (except START) is dropped
+#      jump threading    JMP/JMPZ to a JMP goes straight to its target, a JMP
+#                        to RTS or HALT becomes that instruction, JMPZ_KEEP
+#                        and JMPNZ_KEEP also skip jumps of their own kind and
+#                        a comparison's JMPZ_KEEP to a JMPZ becomes that JMPZ
+#      dead jumps        JMP to a label that directly follows it is dropped
+#      unreachable code  instructions after JMP, TAILJSR, RTS or HALT up to the next
+#                        LABEL are dropped
+#      push/pop          a PUSH or LOAD followed by POP is dropped
+#      constant jumps    PUSH true, JMPZ is dropped, PUSH false, JMPZ becomes JMP
+#      merge pops        a run of k POPs becomes ('POPN', k)
+#      superinstructions frequent sequences become one instruction (see vm.py)
+#
+# Passes run until none of them changes anything, the last two run once at
+# the end. stats counts the instructions each pass removed (jump threading
+# counts the jumps it retargeted).
+#
+# The superinstructions cover the most frequent opcode pairs measured in
+# the VM on scripts/mandel-while.pinky (bench-vm.py prints them):
+#
+#      LOAD_LOCAL, LOAD_LOCAL    12.2%    -> LOAD_LOCAL2
+#      ADD, STORE_LOCAL           7.5%    -> INC_LOCAL for i := i + k
+#      PUSH, DIV                  7.3%    -> LOAD_CONST_DIV
+#      LT/GT, JMPZ                5.0%    -> JMP_IF_NOT_LT/GT (also LE, GE)
+#      PUSH, ADD                  2.5%    -> LOAD_CONST_ADD
+#
+# The same pairs are fused with the type-specialized opcodes of cfg.py
+# (ADD_NUM, LT_NUM, ...), the compare jumps into JMP_IF_NOT_LT_NUM and so on.
+
+compare_jumps = {
+    'LT': 'JMP_IF_NOT_LT', 'LE': 'JMP_IF_NOT_LE', 'GT': 'JMP_IF_NOT_GT', 'GE': 'JMP_IF_NOT_GE',
+    'LT_NUM': 'JMP_IF_NOT_LT_NUM', 'LE_NUM': 'JMP_IF_NOT_LE_NUM', 'GT_NUM': 'JMP_IF_NOT_GT_NUM', 'GE_NUM': 'JMP_IF_NOT_GE_NUM'}
+
+const_opcodes = {'ADD': 'LOAD_CONST_ADD', 'DIV': 'LOAD_CONST_DIV', 'ADD_NUM': 'LOAD_CONST_ADD', 'DIV_NUM': 'LOAD_CONST_DIV'}
+
+keep_jumps = {'JMPZ_KEEP', 'JMPNZ_KEEP'}
+
+load_opcodes = {'PUSH', 'LOAD_LOCAL', 'LOAD_GLOBAL'}
+
+class PeepholeOptimizer:
+    def __init__(self, superinstructions = True):
+        self.superinstructions = superinstructions
+        self.stats = Counter()
+        self.passes = [
+            ('unused labels', self.remove_unused_labels),
+            ('jump threading', self.thread_jumps),
+            ('dead jumps', self.remove_dead_jumps),
+            ('unreachable code', self.remove_unreachable),
+            ('push/pop', self.remove_push_pop),
+            ('constant jumps', self.fold_constant_jumps)]
+
+    def optimize(self, instructions):
+        code = list(instructions)
+        changed = True
+        while changed:
+            changed = False
+            for name, run_pass in self.passes:
+                code, count = run_pass(code)
+                if count > 0:
+                    self.stats[name] += count
+                    changed = True
+
+        code, count = self.merge_pops(code)
+        self.stats['merge pops'] += count
+        if self.superinstructions:
+            code, count = self.fuse(code)
+            self.stats['superinstructions'] += count
+        return code
+
+    def remove_unused_labels(self, code):
+        targets = {instruction[1] for instruction in code if instruction[0] in jump_opcodes}
+        new_code = [instruction for instruction in code if instruction[0] != 'LABEL' or instruction[1] in targets or instruction[1] == 'START']
+        return new_code, len(code) - len(new_code)
+
+    def thread_jumps(self, code):
+        labels = {instruction[1]: idx for idx, instruction in enumerate(code) if instruction[0] == 'LABEL'}
+
+        def target(label):
+            # First instruction executed after jumping to label
+            idx = labels[label]
+            while idx < len(code) and code[idx][0] == 'LABEL':
+                idx += 1
+            return code[idx] if idx < len(code) else ('LABEL', label)
+
+        # Last label and target of the chains of JMPs followed so far, by
+        # every label on them, so nested blocks do not follow the same
+        # chain again for each of their exits
+        chain_ends = {}
+
+        count = 0
+        new_code = []
+        for instruction in code:
+            if instruction[0] in ('JMP', 'JMPZ') or instruction[0] in keep_jumps:
+                # A kept value takes a second jump of the same kind as well
+                followed = {'JMP', instruction[0]} if instruction[0] in keep_jumps else {'JMP'}
+                plain = len(followed) == 1
+                label = instruction[1]
+                if plain and label in chain_ends:
+                    label, next_instruction = chain_ends[label]
+                else:
+                    seen = {label}
+                    next_instruction = target(label)
+                    while next_instruction[0] in followed and next_instruction[1] not in seen:
+                        if plain and next_instruction[1] in chain_ends:
+                            label, next_instruction = chain_ends[next_instruction[1]]
+                            break
+                        label = next_instruction[1]
+                        seen.add(label)
+                        next_instruction = target(label)
+                    # A chain that runs into a loop ends at a label that
+                    # depends on where it starts
+                    if plain and next_instruction[0] != 'JMP':
+                        for start in seen:
+                            chain_ends[start] = (label, next_instruction)
+                if instruction[0] == 'JMP' and next_instruction[0] in ('RTS', 'HALT'):
+                    new_code.append(next_instruction)
+                    count += 1
+                    continue
+                elif instruction[0] == 'JMPZ_KEEP' and next_instruction[0] == 'JMPZ' and new_code and new_code[-1][0] in compare_opcodes:
+                    # A false comparison is what the JMPZ at the target
+                    # jumps on, a true one is popped by both
+                    instruction = ('JMPZ', next_instruction[1])
+                    count += 1
+                elif label != instruction[1]:
+                    instruction = (instruction[0], label)
+                    count += 1
+            new_code.append(instruction)
+        return new_code, count
+
+    def remove_dead_jumps(self, code):
+        new_code = []
+        for idx, instruction in enumerate(code):
+            if instruction[0] == 'JMP':
+                next_idx = idx + 1
+                while next_idx < len(code) and code[next_idx][0] == 'LABEL' and code[next_idx][1] != instruction[1]:
+                    next_idx += 1
+                if next_idx < len(code) and code[next_idx] == ('LABEL', instruction[1]):
+                    continue
+            new_code.append(instruction)
+        return new_code, len(code) - len(new_code)
+
+    def remove_unreachable(self, code):
+        new_code = []
+        reachable = True
+        for instruction in code:
+            if instruction[0] == 'LABEL':
+                reachable = True
+            if reachable:
+                new_code.append(instruction)
+            if instruction[0] in exit_opcodes:
+                reachable = False
+        return new_code, len(code) - len(new_code)
+
+    def remove_push_pop(self, code):
+        new_code = []
+        for instruction in code:
+            if instruction == ('POP',) and new_code and new_code[-1][0] in load_opcodes:
+                new_code.pop()
+                continue
+            new_code.append(instruction)
+        return new_code, len(code) - len(new_code)
+
+    def fold_constant_jumps(self, code):
+        new_code = []
+        for instruction in code:
+            if instruction[0] == 'JMPZ' and new_code and new_code[-1][0] == 'PUSH' and new_code[-1][1][0] == TYPE_BOOL:
+                if new_code.pop()[1][1]: continue
+                instruction = ('JMP', instruction[1])
+            new_code.append(instruction)
+        return new_code, len(code) - len(new_code)
+
+    def merge_pops(self, code):
+        new_code = []
+        for instruction in code:
+            if instruction == ('POP',) and new_code and new_code[-1][0] in ('POP', 'POPN'):
+                count = 2 if new_code[-1][0] == 'POP' else new_code[-1][1] + 1
+                new_code[-1] = ('POPN', count)
+                continue
+            new_code.append(instruction)
+        return new_code, len(code) - len(new_code)
+
+    def fuse(self, code):
+        new_code = []
+        idx = 0
+        while idx < len(code):
+            instruction = code[idx]
+            opcode = instruction[0]
+            following = [code[idx + k][0] if idx + k < len(code) else None for k in range(1, 4)]
+            if opcode == 'LOAD_LOCAL' and following[0] == 'PUSH' and following[1] in ('ADD', 'ADD_NUM') and following[2] == 'STORE_LOCAL' and code[idx + 1][1][0] == TYPE_NUMBER and code[idx + 3][1] == instruction[1]:
+                new_code.append(('INC_LOCAL', instruction[1], code[idx + 1][1][1]))
+                idx += 4
+            elif opcode == 'LOAD_LOCAL' and following[0] == 'LOAD_LOCAL':
+                new_code.append(('LOAD_LOCAL2', instruction[1], code[idx + 1][1]))
+                idx += 2
+            elif opcode == 'PUSH' and following[0] in const_opcodes:
+                new_code.append((const_opcodes[following[0]], instruction[1]))
+                idx += 2
+            elif opcode in compare_jumps and following[0] == 'JMPZ':
+                new_code.append((compare_jumps[opcode], code[idx + 1][1]))
+                idx += 2
+            else:
+                new_code.append(instruction)
+                idx += 1
+        return new_code, len(code) - len(new_code)
@@ -4,49 +4,124 @@ from tokens import *
 from lexer import *
 from parser import *
 from interpreter import *
+from optimizer import *
 from compiler import *
+from peephole import *
+from assembler import *
 from vm import *
+from regcompiler import *
+from regvm import *
+from cfg import *
+from cache import *
 
 DEBUG = True
 
-if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        raise SystemExit('Usage: python3 pinky.py <filename>')
-
-    filename = sys.argv[1]
+BACKENDS = ('stack', 'register')
 
-    with open(filename) as file:
-        source = file.read()
+def compile_source(source, level, backend):
+    # Node constructors only check the tree structure while debugging
+    set_validation(DEBUG)
 
+    if DEBUG:
         tokens = Lexer(source).tokenize()
 
-        if DEBUG:
-            print(f"{Colors.OKBLUE}------------------Lexer------------------{Colors.ENDC}")
-            for token in tokens:
-                print(token)
+        print(f"{Colors.OKBLUE}------------------Lexer------------------{Colors.ENDC}")
+        for token in tokens:
+            print(token)
+    else:
+        # Keep the tokens in a compact store so that function bodies are
+        # only parsed when they are used. This needs all tokens at hand, so
+        # the driver does not stream them with Lexer.stream().
+        tokens = Lexer(source).tokenize_compact()
 
-        ast = Parser(tokens).parse()
+    ast = Parser(tokens, lazy = not DEBUG).parse()
 
-        if DEBUG:
-            print(f"{Colors.OKBLUE}------------------Parser------------------{Colors.ENDC}")
-            pretty_print_stmts(ast)
+    if DEBUG:
+        print(f"{Colors.OKBLUE}------------------Parser------------------{Colors.ENDC}")
+        pretty_print_stmts(ast)
+
+    if level >= 1:
+        ast = optimize(ast)
+    
+    # if DEBUG:
+    #    print(f"{Colors.OKBLUE}------------------Interpreter------------------{Colors.ENDC}")
         
-        # if DEBUG:
-        #    print(f"{Colors.OKBLUE}------------------Interpreter------------------{Colors.ENDC}")
-            
-        # interpreter = Interpreter()
-        # interpreter.interpret_program(ast)
+    # interpreter = Interpreter()
+    # interpreter.interpret_program(ast)
 
-        if DEBUG:
-            print(f"{Colors.OKBLUE}------------------Compiler------------------{Colors.ENDC}")
+    if DEBUG:
+        print(f"{Colors.OKBLUE}------------------Compiler------------------{Colors.ENDC}")
 
-        compiler = Compiler()
+    if backend == 'register':
+        compiler = RegisterCompiler()
         instructions = compiler.generate_code(ast)
+        if DEBUG:
+            pretty_print_registers(instructions, compiler.templates)
+        return assemble_registers(instructions, compiler.templates)
+
+    compiler = make_compiler(level)
+    instructions = compiler.generate_code(ast)
+    manager = make_pass_manager(level)
+    instructions = manager.run(instructions)
+    if DEBUG:
         pretty_print_instructions(instructions)
+        for name, elapsed, before, after, count in manager.stats:
+            print(f'{name:>18}: {before} -> {after} instructions, {count} changed, {elapsed * 1000:.2f}ms')
 
-        if DEBUG:
-            print(f"{Colors.OKBLUE}------------------VM------------------{Colors.ENDC}")
+    program = assemble(instructions)
+
+    if DEBUG:
+        print(f"{Colors.OKBLUE}------------------Assembler------------------{Colors.ENDC}")
+        pretty_print_program(program)
+
+    return program
+
+if __name__ == '__main__':
+    # The stack VM runs the program unless --backend=register is given, and
+    # the program is compiled at -O2 unless another level is given. The
+    # compiled program is cached in script.pkc next to the script, or in the
+    # directory given with --cache-dir, unless --no-cache is given.
+    args = sys.argv[1:]
+    backend = 'stack'
+    level = 2
+    use_cache = True
+    cache_dir = None
+    while args and args[0].startswith('-'):
+        option = args.pop(0)
+        if option.startswith('--backend='):
+            backend = option[len('--backend='):]
+        elif option in ('-O0', '-O1', '-O2'):
+            level = int(option[2:])
+        elif option == '--no-cache':
+            use_cache = False
+        elif option.startswith('--cache-dir='):
+            cache_dir = option[len('--cache-dir='):]
+        else:
+            args = []
+    if len(args) != 1 or backend not in BACKENDS:
+        raise SystemExit('Usage: python3 pinky.py [-O0|-O1|-O2] [--backend=stack|register] [--no-cache] [--cache-dir=dir] <filename>')
+
+    filename = args[0]
+
+    with open(filename) as file:
+        source = file.read()
+
+    program = None
+    if use_cache:
+        path = cache_path(filename, cache_dir)
+        key = source_key(source, level, backend)
+        program = load_program(path, key)
+        if DEBUG and program != None:
+            print(f"{Colors.OKBLUE}------------------Cache------------------{Colors.ENDC}")
+            print(f'Loaded {path}')
+
+    if program == None:
+        program = compile_source(source, level, backend)
+        if use_cache:
+            store_program(path, key, program)
 
-        vm = VM()
-        vm.run(instructions)
+    if DEBUG:
+        print(f"{Colors.OKBLUE}------------------VM------------------{Colors.ENDC}")
 
+    vm = RegisterVM() if backend == 'register' else VM()
+    vm.run(program)
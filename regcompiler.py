@@ -0,0 +1,420 @@
+from model import *
+from tokens import *
+from utils import *
+from defs import *
+from compiler import *
+from assembler import *
+
+# Compiler for the register machine in regvm.py, the alternative to the stack
+# backend. Every function (and the main program) has a frame of numbered
+# registers: the locals take the registers in slot order and the temporaries
+# of an expression are allocated above them like a stack. Constants are read
+# from negative registers, counted from the end of the frame, so an operand
+# is always a register number and a literal costs no instruction.
+#
+#      ('MOVE', dst, src)                 # dst = src
+#      ('GETGLOBAL', dst, idx)            # dst = global idx
+#      ('SETGLOBAL', idx, src)            # global idx = src
+#      ('ADD', dst, a, b)                 # dst = a + b, also SUB, MUL, DIV, MOD, EXP,
+#                                         # XOR and the comparisons LT, LE, GT, GE, EQ, NE
+#      ('NEG', dst, src)                  # dst = -src
+#      ('PRINT', src)                     # Also PRINTLN
+#      ('JMP', name)
+#      ('JMPF', name, src)                # Jump if src is false, src must be a boolean
+#      ('JMPFALSY', name, src)            # Jump if src is falsy (and)
+#      ('JMPTRUTHY', name, src)           # Jump if src is truthy (or)
+#      ('JMP_IF_NOT_LT', name, a, b)      # Jump unless a < b (also LE, GT, GE, EQ and NE)
+#      ('FORPREP', var, bound, step, up, default_step)
+#                                         # Checks the operands of a for loop and sets
+#                                         # its direction up, and its step by default
+#      ('FORTEST', name, var, bound, up)  # Jump past the loop once var passed bound
+#      ('CALL', name, dst, base, argc)    # Call name with the argc registers from base
+#                                         # as its first registers, the result goes to dst
+#      ('TAILCALL', name, base, argc)     # Call in tail position, replacing the frame
+#      ('RET', src)
+#      ('HALT',)
+#
+# The code of each function body follows the HALT of the main program. The
+# register frame of a function starts as a copy of its template: None for
+# every register and the constants at the end. The templates are kept with
+# the assembled program by the pc of the function.
+
+register_jump_opcodes = {
+    'JMP', 'JMPF', 'JMPFALSY', 'JMPTRUTHY', 'FORTEST', 'CALL', 'TAILCALL',
+    'JMP_IF_NOT_LT', 'JMP_IF_NOT_LE', 'JMP_IF_NOT_GT', 'JMP_IF_NOT_GE', 'JMP_IF_NOT_EQ', 'JMP_IF_NOT_NE'}
+
+register_compare_jumps = {
+    TOK_LT   : 'JMP_IF_NOT_LT',
+    TOK_LE   : 'JMP_IF_NOT_LE',
+    TOK_GT   : 'JMP_IF_NOT_GT',
+    TOK_GE   : 'JMP_IF_NOT_GE',
+    TOK_EQEQ : 'JMP_IF_NOT_EQ',
+    TOK_NE   : 'JMP_IF_NOT_NE'
+}
+
+def unwrap(node):
+    # The expression a chain of parentheses and unary pluses computes
+    while isinstance(node, Grouping) or (isinstance(node, UnOp) and node.op.token_type == TOK_PLUS):
+        node = node.value if isinstance(node, Grouping) else node.operand
+    return node
+
+def is_boolean(node):
+    # Whether node always computes a boolean, so that a condition can jump
+    # on it without keeping the value
+    node = unwrap(node)
+    if isinstance(node, BinOp):
+        return node.op.token_type in register_compare_jumps
+    elif isinstance(node, LogicalOp):
+        return is_boolean(node.left) and is_boolean(node.right)
+    return isinstance(node, Bool)
+
+class RegisterCompiler(Compiler):
+    def __init__(self):
+        super().__init__()
+        # Temporaries in use above the locals, the number of registers the
+        # frame needs, and its constants with their registers
+        self.temps = 0
+        self.size = 0
+        self.consts = []
+        self.const_regs = {}
+        # Register templates by function label, and the code of the function
+        # bodies compiled so far
+        self.templates = {}
+        self.bodies = []
+
+    def emit(self, instruction):
+        self.code.append(instruction)
+
+    def end_block(self):
+        while self.locals and self.locals[-1].depth == self.scope_depth:
+            self.locals.pop()
+        if self.scopes and self.scopes[-1][0] == self.scope_depth:
+            self.scopes.pop()
+        self.scope_depth -= 1
+
+    def alloc(self, count = 1):
+        reg = len(self.locals) + self.temps
+        self.temps += count
+        self.size = max(self.size, reg + count)
+        return reg
+
+    def free(self, count = 1):
+        self.temps -= count
+
+    def new_local(self, name, visible = True):
+        # Binds the register above the locals, which is the first temporary
+        # while one is in use
+        symbol = Symbol(name, SYM_VAR, self.scope_depth)
+        if visible:
+            reg = self.add_local_symbol(symbol)
+        else:
+            reg = len(self.locals)
+            self.locals.append(symbol)
+        self.size = max(self.size, reg + 1)
+        self.emit(('SET_SLOT', (reg, name)))
+        return reg
+
+    def bind_local(self, name, visible = True):
+        # Turns the temporary holding a computed value into a local
+        self.free()
+        return self.new_local(name, visible)
+
+    def const(self, value):
+        reg = self.const_regs.get(value)
+        if reg == None:
+            self.consts.append(value)
+            reg = -len(self.consts)
+            self.const_regs[value] = reg
+        return reg
+
+    def literal(self, node):
+        if isinstance(node, (Integer, Float)):
+            return self.const((TYPE_NUMBER, float(node.value)))
+        elif isinstance(node, Bool):
+            return self.const((TYPE_BOOL, node.value))
+        elif isinstance(node, String):
+            return self.const((TYPE_STRING, stringify(node.value)))
+        return None
+
+    def template(self):
+        return [None] * self.size + self.consts[::-1]
+
+    def operand(self, node):
+        # The register an instruction reads the value of node from, and the
+        # work items that compute it there. Literals and locals are read
+        # where they are, anything else goes to a new temporary.
+        node = unwrap(node)
+        reg = self.literal(node)
+        if reg != None:
+            return reg, []
+        if isinstance(node, Identifier):
+            symbol, idx = self.get_var_symbol(node.name)
+            if symbol and symbol.depth != 0:
+                return idx, []
+        reg = self.alloc()
+        return reg, [lambda: self.compile_expr(node, reg)]
+
+    def operands(self, *nodes):
+        # Registers of several operands, their work items and the number of
+        # temporaries to free once the instruction reading them is emitted
+        temps = self.temps
+        regs = []
+        items = []
+        for node in nodes:
+            reg, work = self.operand(node)
+            regs.append(reg)
+            items += work
+        return regs, items, self.temps - temps
+
+    def emit_free(self, instruction, temps):
+        self.emit(instruction)
+        self.free(temps)
+
+    def compile_expr(self, node, dst):
+        # Computes the value of node into register dst
+        node = unwrap(node)
+        reg = self.literal(node)
+        if reg != None:
+            self.emit(('MOVE', dst, reg))
+        elif isinstance(node, Identifier):
+            symbol, idx = self.get_var_symbol(node.name)
+            if not symbol:
+                compile_error(f'Variable {node.name} is not defined', node.line)
+            elif symbol.depth == 0:
+                self.emit(('GETGLOBAL', dst, idx))
+            elif idx != dst:
+                self.emit(('MOVE', dst, idx))
+        elif isinstance(node, BinOp):
+            (a, b), items, temps = self.operands(node.left, node.right)
+            instruction = (binary_opcodes[node.op.token_type], dst, a, b)
+            self.schedule(*items, lambda: self.emit_free(instruction, temps))
+        elif isinstance(node, UnOp):
+            (a,), items, temps = self.operands(node.operand)
+            if node.op.token_type == TOK_MINUS:
+                instruction = ('NEG', dst, a)
+            else:
+                instruction = ('XOR', dst, a, self.const((TYPE_NUMBER, 1)))
+            self.schedule(*items, lambda: self.emit_free(instruction, temps))
+        elif isinstance(node, LogicalOp):
+            if dst < len(self.locals):
+                # The right operand may still read the local the result goes to
+                reg = self.alloc()
+                self.schedule(lambda: self.compile_expr(node, reg), lambda: self.emit_free(('MOVE', dst, reg), 1))
+                return
+            end_label = self.make_label()
+            jump = 'JMPFALSY' if node.op.token_type == TOK_AND else 'JMPTRUTHY'
+            self.schedule(
+                lambda: self.compile_expr(node.left, dst),
+                (jump, end_label, dst),
+                lambda: self.compile_expr(node.right, dst),
+                ('LABEL', end_label))
+        elif isinstance(node, FuncCall):
+            self.compile_call(node, dst)
+
+    def compile_call(self, node, dst = None, tail = False):
+        func_symbol = self.get_func_symbol(node.identifier.name)
+        if not func_symbol:
+            compile_error(f'A function with the name {node.identifier.name} was not declared', node.line)
+
+        if len(node.args) != func_symbol.arg_cnt:
+            compile_error(f'A function with the name {node.identifier.name} expected {func_symbol.arg_cnt} params', node.line)
+
+        argc = len(node.args)
+        base = self.alloc(argc)
+        items = [lambda arg = arg, reg = reg: self.compile_expr(arg, reg) for reg, arg in enumerate(node.args, base)]
+        if tail:
+            instruction = ('TAILCALL', node.identifier.name, base, argc)
+        else:
+            instruction = ('CALL', node.identifier.name, dst, base, argc)
+        self.schedule(*items, lambda: self.emit_free(instruction, argc))
+
+    def compile_condition(self, node, false_label):
+        # Jumps to false_label unless node is true. Comparisons jump on their
+        # operands, and both sides of an and whose left operand is a boolean
+        # jump to false_label directly.
+        node = unwrap(node)
+        if isinstance(node, BinOp) and node.op.token_type in register_compare_jumps:
+            (a, b), items, temps = self.operands(node.left, node.right)
+            instruction = (register_compare_jumps[node.op.token_type], false_label, a, b)
+            self.schedule(*items, lambda: self.emit_free(instruction, temps))
+        elif isinstance(node, LogicalOp) and node.op.token_type == TOK_AND and is_boolean(node.left):
+            self.schedule(
+                lambda: self.compile_condition(node.left, false_label),
+                lambda: self.compile_condition(node.right, false_label))
+        elif isinstance(node, Bool):
+            if not node.value:
+                self.emit(('JMP', false_label))
+        else:
+            (reg,), items, temps = self.operands(node)
+            self.schedule(*items, lambda: self.emit_free(('JMPF', false_label, reg), temps))
+
+    def compile_node(self, node):
+        if isinstance(node, Stmts):
+            self.schedule(*node.stmts)
+        elif isinstance(node, Assignment):
+            self.compile_assignment(node)
+        elif isinstance(node, LocalAssignment):
+            self.compile_assignment(node, local = True)
+        elif isinstance(node, PrintStmt):
+            (reg,), items, temps = self.operands(node.value)
+            opcode = 'PRINTLN' if node.end == '\n' else 'PRINT'
+            self.schedule(*items, lambda: self.emit_free((opcode, reg), temps))
+        elif isinstance(node, IfStmt):
+            else_label = self.make_label()
+            exit_label = self.make_label()
+            items = [
+                lambda: self.compile_condition(node.condition, else_label),
+                self.begin_block,
+                node.then_stmts,
+                self.end_block]
+            if node.else_stmts != None:
+                items += [
+                    ('JMP', exit_label),
+                    ('LABEL', else_label),
+                    self.begin_block,
+                    node.else_stmts,
+                    self.end_block,
+                    ('LABEL', exit_label)]
+            else:
+                items.append(('LABEL', else_label))
+            self.schedule(*items)
+        elif isinstance(node, WhileStmt):
+            cond_label = self.make_label()
+            end_label = self.make_label()
+            self.schedule(
+                ('LABEL', cond_label),
+                lambda: self.compile_condition(node.condition, end_label),
+                self.begin_block,
+                node.do_stmts,
+                self.end_block,
+                ('JMP', cond_label),
+                ('LABEL', end_label))
+        elif isinstance(node, ForStmt):
+            self.compile_for_loop(node)
+        elif isinstance(node, FuncDecl):
+            func_symbol = self.get_func_symbol(node.identifier.name)
+            if func_symbol:
+                compile_error(f'A function with the name {node.identifier.name} was already declared', node.line)
+
+            var_symbol, idx = self.get_var_symbol(node.identifier.name)
+            if var_symbol:
+                compile_error(f'A function with the name {node.identifier.name} was already defined in this scope', node.line)
+
+            self.add_func_symbol(Symbol(node.identifier.name, SYM_FUNC, self.scope_depth, len(node.params)))
+            self.compile_function(node)
+        elif isinstance(node, FuncCallStmt):
+            reg = self.alloc()
+            self.schedule(lambda: self.compile_call(node.func_call, reg), self.free)
+        elif isinstance(node, RetStmt):
+            if isinstance(unwrap(node.value), FuncCall) and self.function_depth > 0:
+                self.compile_call(unwrap(node.value), tail = True)
+            else:
+                (reg,), items, temps = self.operands(node.value)
+                self.schedule(*items, lambda: self.emit_free(('RET', reg), temps))
+
+    def compile_assignment(self, node, local = False):
+        name = node.left.name
+        # A local outside of any block is a global, as in the interpreter
+        local = local and self.scope_depth > 0
+        if local:
+            symbol, idx = self.get_scope_var_symbol(name)
+        else:
+            symbol, idx = self.get_var_symbol(name)
+
+        if symbol and symbol.depth != 0:
+            self.schedule(lambda: self.compile_expr(node.right, idx))
+        elif symbol or (not local and self.scope_depth == 0):
+            (reg,), items, temps = self.operands(node.right)
+
+            def store():
+                # A new global is only declared once its value is computed
+                slot = idx if symbol else self.add_global_symbol(Symbol(name, SYM_VAR, 0))
+                self.emit_free(('SETGLOBAL', slot, reg), temps)
+
+            self.schedule(*items, store)
+        else:
+            reg = self.alloc()
+            self.schedule(lambda: self.compile_expr(node.right, reg), lambda: self.bind_local(name))
+
+    def compile_for_loop(self, node):
+        # The bound and step are evaluated once, into hidden locals of the
+        # loop's block. The loop counts up while the variable is at most the
+        # bound if it starts there, else it counts down while it is at least
+        # the bound, by a step of 1 or -1 unless one is given.
+        test_label = self.make_label()
+        end_label = self.make_label()
+        regs = {}
+
+        def compute(name, value, visible = True):
+            # Work item computing value into a new local of the loop's block
+            def start():
+                reg = self.alloc()
+                self.schedule(lambda: self.compile_expr(value, reg), lambda: regs.setdefault(name, self.bind_local(name, visible)))
+            return start
+
+        def prepare():
+            if node.step_val == None:
+                regs['(for step)'] = self.new_local('(for step)', False)
+            regs['(for up)'] = self.new_local('(for up)', False)
+            var, bound, step, up = regs[node.assignment.left.name], regs['(for bound)'], regs['(for step)'], regs['(for up)']
+            self.schedule(
+                ('FORPREP', var, bound, step, up, node.step_val == None),
+                ('LABEL', test_label),
+                ('FORTEST', end_label, var, bound, up),
+                self.begin_block,
+                node.do_stmts,
+                self.end_block,
+                ('ADD', var, var, step),
+                ('JMP', test_label),
+                ('LABEL', end_label),
+                self.end_block)
+
+        self.begin_block()
+        work = [compute(node.assignment.left.name, node.assignment.right), compute('(for bound)', node.condition_val, False)]
+        if node.step_val != None:
+            work.append(compute('(for step)', node.step_val, False))
+        self.schedule(*work, prepare)
+
+    def compile_function(self, node):
+        # The body is compiled into code of its own with a new register
+        # frame, seeing the globals and functions declared so far
+        saved = (self.code, self.locals, self.scopes, self.scope_depth, self.temps, self.size, self.consts, self.const_regs)
+        self.code = [('LABEL', node.identifier.name)]
+        self.locals = []
+        self.scopes = []
+        self.scope_depth = 0
+        self.temps = 0
+        self.size = 0
+        self.consts = []
+        self.const_regs = {}
+        self.begin_block()
+        for parm in node.params:
+            self.new_local(parm.identifier.name)
+        self.function_depth += 1
+
+        def end_function():
+            self.emit(('RET', self.const((TYPE_NUMBER, 0.0))))
+            self.templates[node.identifier.name] = self.template()
+            self.bodies.append(self.code)
+            self.function_depth -= 1
+            self.code, self.locals, self.scopes, self.scope_depth, self.temps, self.size, self.consts, self.const_regs = saved
+
+        self.schedule(node.body_stmts, end_function)
+
+    def generate_code(self, root):
+        # Function bodies are compiled where they are declared, so lazily
+        # parsed bodies are all parsed here
+        self.emit(('LABEL', 'START'))
+        self.compile(root)
+        self.emit(('HALT',))
+        self.templates['START'] = self.template()
+        for body in self.bodies:
+            self.code += body
+        return self.code
+
+def assemble_registers(instructions, templates):
+    # Assembles the output of RegisterCompiler and keeps the register
+    # templates by the pc of their function
+    program = assemble(instructions, register_jump_opcodes)
+    program.templates = {program.labels[name]: template for name, template in templates.items()}
+    return program
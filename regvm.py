@@ -0,0 +1,272 @@
+from regcompiler import *
+from utils import *
+from defs import *
+import codecs
+
+# The register machine runs the programs of regcompiler.py. Instead of a
+# stack each function call has a list of registers, its frame, which starts
+# as a copy of the function's template: the locals and temporaries first and
+# the constants at the end, read with negative register numbers. Values are
+# tagged with their type like on the stack VM, and every instruction checks
+# them the same way (see vm.py):
+#
+#      ('ADD', 3, 1, 2)       # r3 = r1 + r2
+#      ('MOVE', 0, -1)        # r0 = the first constant
+#
+# A call copies the arguments into the first registers of the new frame and
+# keeps the frame of the caller, the pc to return to and the register that
+# receives the result on the frames list.
+
+class RegisterVM:
+    def __init__(self):
+        self.regs = []
+        self.frames = []
+        self.globals = {}
+        self.templates = {}
+        self.pc = 0
+        self.is_running = False
+
+    def run(self, program):
+        # program is assembled with assemble_registers
+        instructions = program.code
+        self.templates = program.templates
+        self.pc = program.labels['START']
+        self.regs = list(self.templates[self.pc])
+
+        self.is_running = True
+        while self.is_running:
+            opcode, *args = instructions[self.pc]
+            self.pc += 1
+            getattr(self, opcode)(*args)
+
+    def HALT(self):
+        self.is_running = False
+
+    def MOVE(self, dst, src):
+        self.regs[dst] = self.regs[src]
+
+    def GETGLOBAL(self, dst, idx):
+        self.regs[dst] = self.globals[idx]
+
+    def SETGLOBAL(self, idx, src):
+        self.globals[idx] = self.regs[src]
+
+    def ADD(self, dst, a, b):
+        regs = self.regs
+        type1, value1 = regs[a]
+        type2, value2 = regs[b]
+
+        if type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+            regs[dst] = (TYPE_NUMBER, value1 + value2)
+        elif type1 == TYPE_STRING or type2 == TYPE_STRING:
+            regs[dst] = (TYPE_STRING, stringify(value1) + stringify(value2))
+        else:
+            vm_error(f'Unsupported operator ADD between {type1} and {type2}', self.pc - 1)
+
+    def SUB(self, dst, a, b):
+        regs = self.regs
+        type1, value1 = regs[a]
+        type2, value2 = regs[b]
+
+        if type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+            regs[dst] = (TYPE_NUMBER, value1 - value2)
+        else:
+            vm_error(f'Unsupported operator SUB between {type1} and {type2}', self.pc - 1)
+
+    def MUL(self, dst, a, b):
+        regs = self.regs
+        type1, value1 = regs[a]
+        type2, value2 = regs[b]
+
+        if type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+            regs[dst] = (TYPE_NUMBER, value1 * value2)
+        else:
+            vm_error(f'Unsupported operator MUL between {type1} and {type2}', self.pc - 1)
+
+    def DIV(self, dst, a, b):
+        regs = self.regs
+        type1, value1 = regs[a]
+        type2, value2 = regs[b]
+
+        if type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+            if value2 == 0:
+                vm_error(f'Division by zero', self.pc - 1)
+            regs[dst] = (TYPE_NUMBER, value1 / value2)
+        else:
+            vm_error(f'Unsupported operator DIV between {type1} and {type2}', self.pc - 1)
+
+    def MOD(self, dst, a, b):
+        regs = self.regs
+        type1, value1 = regs[a]
+        type2, value2 = regs[b]
+
+        if type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+            if value2 == 0:
+                vm_error(f'Mod by zero', self.pc - 1)
+            regs[dst] = (TYPE_NUMBER, value1 % value2)
+        else:
+            vm_error(f'Unsupported operator MOD between {type1} and {type2}', self.pc - 1)
+
+    def EXP(self, dst, a, b):
+        regs = self.regs
+        type1, value1 = regs[a]
+        type2, value2 = regs[b]
+
+        if type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+            regs[dst] = (TYPE_NUMBER, value1 ** value2)
+        else:
+            vm_error(f'Unsupported operator EXP between {type1} and {type2}', self.pc - 1)
+
+    def XOR(self, dst, a, b):
+        regs = self.regs
+        type1, value1 = regs[a]
+        type2, value2 = regs[b]
+
+        if type1 == TYPE_BOOL and type2 == TYPE_BOOL:
+            regs[dst] = (TYPE_BOOL, value1 ^ value2)
+        elif type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
+            regs[dst] = (TYPE_NUMBER, value1 ^ value2)
+        elif (type1 == TYPE_BOOL and type2 == TYPE_NUMBER) or (type1 == TYPE_NUMBER and type2 == TYPE_BOOL):
+            regs[dst] = (TYPE_BOOL, bool(value1) ^ bool(value2))
+        else:
+            vm_error(f'Unsupported operator XOR between {type1} and {type2}', self.pc - 1)
+
+    def compare(self, opcode, a, b):
+        # The values of a and b when opcode can compare them
+        type1, value1 = self.regs[a]
+        type2, value2 = self.regs[b]
+
+        if type1 == type2 and (type1 != TYPE_BOOL or opcode in ('EQ', 'NE')):
+            return value1, value2
+        vm_error(f'Unsupported operator {opcode} between {type1} and {type2}', self.pc - 1)
+
+    def EQ(self, dst, a, b):
+        value1, value2 = self.compare('EQ', a, b)
+        self.regs[dst] = (TYPE_BOOL, value1 == value2)
+
+    def NE(self, dst, a, b):
+        value1, value2 = self.compare('NE', a, b)
+        self.regs[dst] = (TYPE_BOOL, value1 != value2)
+
+    def GE(self, dst, a, b):
+        value1, value2 = self.compare('GE', a, b)
+        self.regs[dst] = (TYPE_BOOL, value1 >= value2)
+
+    def GT(self, dst, a, b):
+        value1, value2 = self.compare('GT', a, b)
+        self.regs[dst] = (TYPE_BOOL, value1 > value2)
+
+    def LE(self, dst, a, b):
+        value1, value2 = self.compare('LE', a, b)
+        self.regs[dst] = (TYPE_BOOL, value1 <= value2)
+
+    def LT(self, dst, a, b):
+        value1, value2 = self.compare('LT', a, b)
+        self.regs[dst] = (TYPE_BOOL, value1 < value2)
+
+    def NEG(self, dst, src):
+        type, value = self.regs[src]
+        if type == TYPE_NUMBER:
+            self.regs[dst] = (type, -value)
+        else:
+            vm_error(f'Unsupported operator NEG at {type}', self.pc - 1)
+
+    def PRINT(self, src):
+        value = stringify(self.regs[src][1])
+        print(codecs.escape_decode(bytes(value, 'utf-8'))[0].decode('utf-8'), end = '')
+
+    def PRINTLN(self, src):
+        value = stringify(self.regs[src][1])
+        print(codecs.escape_decode(bytes(value, 'utf-8'))[0].decode('utf-8'), end = '\n')
+
+    def JMP(self, pc):
+        self.pc = pc
+
+    def JMPF(self, pc, src):
+        type, value = self.regs[src]
+        if type == TYPE_BOOL:
+            if not value:
+                self.pc = pc
+        else:
+            vm_error('Condition is not a boolean expression', self.pc - 1)
+
+    def JMPFALSY(self, pc, src):
+        if not self.regs[src][1]:
+            self.pc = pc
+
+    def JMPTRUTHY(self, pc, src):
+        if self.regs[src][1]:
+            self.pc = pc
+
+    def JMP_IF_NOT_LT(self, pc, a, b):
+        value1, value2 = self.compare('LT', a, b)
+        if not value1 < value2:
+            self.pc = pc
+
+    def JMP_IF_NOT_LE(self, pc, a, b):
+        value1, value2 = self.compare('LE', a, b)
+        if not value1 <= value2:
+            self.pc = pc
+
+    def JMP_IF_NOT_GT(self, pc, a, b):
+        value1, value2 = self.compare('GT', a, b)
+        if not value1 > value2:
+            self.pc = pc
+
+    def JMP_IF_NOT_GE(self, pc, a, b):
+        value1, value2 = self.compare('GE', a, b)
+        if not value1 >= value2:
+            self.pc = pc
+
+    def JMP_IF_NOT_EQ(self, pc, a, b):
+        value1, value2 = self.compare('EQ', a, b)
+        if value1 != value2:
+            self.pc = pc
+
+    def JMP_IF_NOT_NE(self, pc, a, b):
+        value1, value2 = self.compare('NE', a, b)
+        if value1 == value2:
+            self.pc = pc
+
+    def FORPREP(self, var, bound, step, up, default_step):
+        regs = self.regs
+        for reg, name in ((var, 'Start'), (bound, 'Bound'), (step, 'Step')):
+            if reg == step and default_step:
+                continue
+            if regs[reg][0] != TYPE_NUMBER:
+                vm_error(f'{name} of the for loop is not a number', self.pc - 1)
+        ascending = regs[var][1] <= regs[bound][1]
+        regs[up] = (TYPE_BOOL, ascending)
+        if default_step:
+            regs[step] = (TYPE_NUMBER, 1.0 if ascending else -1.0)
+
+    def FORTEST(self, pc, var, bound, up):
+        regs = self.regs
+        type, value = regs[var]
+        if type != TYPE_NUMBER:
+            vm_error('Variable of the for loop is not a number', self.pc - 1)
+        if regs[up][1]:
+            if value > regs[bound][1]:
+                self.pc = pc
+        elif value < regs[bound][1]:
+            self.pc = pc
+
+    def CALL(self, pc, dst, base, argc):
+        regs = list(self.templates[pc])
+        regs[:argc] = self.regs[base:base + argc]
+        self.frames.append((self.regs, self.pc, dst))
+        self.regs = regs
+        self.pc = pc
+
+    def TAILCALL(self, pc, base, argc):
+        # Replaces the frame of the calling function, which returns to its
+        # own caller
+        regs = list(self.templates[pc])
+        regs[:argc] = self.regs[base:base + argc]
+        self.regs = regs
+        self.pc = pc
+
+    def RET(self, src):
+        value = self.regs[src]
+        self.regs, self.pc, dst = self.frames.pop()
+        self.regs[dst] = value
@@ -0,0 +1,108 @@
+import unittest
+import sys
+import io
+import os
+import tempfile
+import contextlib
+from lexer import *
+from parser import *
+from compiler import *
+from assembler import *
+from vm import *
+from regcompiler import *
+from regvm import *
+from cache import *
+
+SOURCE = '''
+  func sq(x) ret x * x end
+  i := 0
+  while i < 4 do
+    print sq(i)
+    i := i + 1
+  end
+  println "done"
+'''
+
+def run(vm, program):
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    vm.run(program)
+  return output.getvalue()
+
+class TestCache(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.directory.name, 'script.pkc')
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def test_stack_roundtrip(self):
+    program = assemble(Compiler().generate_code(Parser(Lexer(SOURCE).tokenize()).parse()))
+    key = source_key(SOURCE, 2, 'stack')
+    self.assertTrue(store_program(self.path, key, program))
+    loaded = load_program(self.path, key)
+    self.assertEqual(loaded.code, program.code)
+    self.assertEqual(loaded.labels, program.labels)
+    self.assertEqual(loaded.slots, program.slots)
+    self.assertEqual(run(VM(), loaded), '0149done\n')
+
+  def test_register_roundtrip(self):
+    compiler = RegisterCompiler()
+    program = assemble_registers(compiler.generate_code(Parser(Lexer(SOURCE).tokenize()).parse()), compiler.templates)
+    key = source_key(SOURCE, 2, 'register')
+    self.assertTrue(store_program(self.path, key, program))
+    loaded = load_program(self.path, key)
+    self.assertEqual(loaded.templates, program.templates)
+    self.assertEqual(run(RegisterVM(), loaded), run(RegisterVM(), program))
+
+  def test_stale_or_foreign_files(self):
+    program = assemble(Compiler().generate_code(Parser(Lexer(SOURCE).tokenize()).parse()))
+    key = source_key(SOURCE, 2, 'stack')
+    self.assertNotEqual(key, source_key(SOURCE + ' ', 2, 'stack'))
+    self.assertNotEqual(key, source_key(SOURCE, 1, 'stack'))
+    self.assertEqual(load_program(self.path, key), None)
+    store_program(self.path, key, program)
+    self.assertEqual(load_program(self.path, source_key(SOURCE, 1, 'stack')), None)
+    with open(self.path, 'rb') as file:
+      data = file.read()
+    for contents in [data[:len(data) // 2], b'PKC' + bytes([PKC_FORMAT + 1]) + data[4:], b'#!pinky']:
+      with open(self.path, 'wb') as file:
+        file.write(contents)
+      self.assertEqual(load_program(self.path, key), None)
+
+  def test_writes_replace_whole_files(self):
+    program = assemble(Compiler().generate_code(Parser(Lexer(SOURCE).tokenize()).parse()))
+    for level in range(3):
+      self.assertTrue(store_program(self.path, source_key(SOURCE, level), program))
+    self.assertEqual(os.listdir(self.directory.name), ['script.pkc'])
+    self.assertNotEqual(load_program(self.path, source_key(SOURCE, 2)), None)
+
+  @unittest.skipIf(os.name != 'posix', 'file modes are POSIX')
+  def test_files_follow_the_umask(self):
+    program = assemble(Compiler().generate_code(Parser(Lexer(SOURCE).tokenize()).parse()))
+    umask = os.umask(0o022)
+    try:
+      self.assertTrue(store_program(self.path, source_key(SOURCE), program))
+    finally:
+      os.umask(umask)
+    self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+  def test_cache_path(self):
+    self.assertEqual(cache_path('scripts/calls.pinky'), os.path.join('scripts', 'calls.pkc'))
+    first = cache_path('a/calls.pinky', 'cache')
+    second = cache_path('b/calls.pinky', 'cache')
+    self.assertNotEqual(first, second)
+    self.assertEqual(os.path.dirname(first), 'cache')
+    self.assertTrue(os.path.basename(first).startswith('calls-'))
+
+  def test_version_covers_the_vms(self):
+    # Every module of the repository the compilers and VMs import is hashed
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in list(sys.modules.values()):
+      path = getattr(module, '__file__', None)
+      if path and os.path.dirname(os.path.abspath(path)) == directory and module.__name__ not in ('__main__', 'cache'):
+        self.assertIn(os.path.basename(path), COMPILER_SOURCES)
+
+if __name__ == "__main__":
+  unittest.main()
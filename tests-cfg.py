@@ -0,0 +1,210 @@
+import unittest
+import io
+import contextlib
+from lexer import *
+from parser import *
+from compiler import *
+from assembler import *
+from vm import *
+from cfg import *
+
+def compile_source(source, inline_limit=0):
+  return Compiler(inline_limit=inline_limit).generate_code(Parser(Lexer(source).tokenize()).parse())
+
+def run(instructions):
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    VM().run(instructions)
+  return output.getvalue()
+
+class TestCFG(unittest.TestCase):
+  def test_blocks_and_edges(self):
+    code = [
+      ('LABEL', 'START'),
+      ('PUSH', (TYPE_BOOL, True)),
+      ('JMPZ', 'L1'),
+      ('PUSH', (TYPE_NUMBER, 1.0)),
+      ('PRINTLN',),
+      ('LABEL', 'L1'),
+      ('LABEL', 'L2'),
+      ('HALT',)]
+    cfg = build_cfg(code)
+    self.assertEqual(len(cfg.blocks), 3)
+    first, then, end = cfg.blocks
+    self.assertEqual(first.succs, [end, then])
+    self.assertEqual(then.succs, [end])
+    self.assertEqual(end.labels, ['L1', 'L2'])
+    self.assertEqual(end.preds, [first, then])
+    self.assertEqual(linearize(cfg), code)
+
+  def test_def_use(self):
+    code = compile_source('x := 1\ny := x + 2\nfunc f(a) local b := a ret b end\nprintln f(y)')
+    cfg = build_cfg(code)
+    self.assertTrue(compute_depths(cfg))
+    compute_def_use(cfg)
+    start = cfg.blocks[0]
+    self.assertEqual(start.global_defs, {0, 1})
+    self.assertEqual(start.global_uses, set())
+    body = next(block for block in cfg.blocks if 'f' in block.labels)
+    self.assertEqual(body.depth, 1)
+    self.assertEqual(body.uses, {0})
+    self.assertIn(1, body.defs)
+
+  def test_unreachable_blocks(self):
+    source = 'func sq(x) ret x * x end\nprintln sq(3)'
+    code = compile_source(source, inline_limit=INLINE_LIMIT)
+    cfg = build_cfg(code)
+    self.assertGreater(remove_unreachable_blocks(cfg), 0)
+    code = linearize(cfg)
+    self.assertNotIn(('LABEL', 'sq'), code)
+    self.assertEqual(run(code), '9\n')
+
+  def test_dead_stores(self):
+    source = '''
+      func f(a)
+        local x := a * 2
+        local y := x + 1
+        x := 5
+        ret y
+      end
+      i := 0
+      while i < 3 do
+        local t := i
+        t := t + 10
+        println f(i)
+        i := i + 1
+      end
+    '''
+    code = compile_source(source)
+    cfg = build_cfg(code)
+    self.assertEqual(remove_dead_stores(cfg), 2)
+    self.assertEqual(run(linearize(cfg)), run(code))
+
+  def test_dead_globals(self):
+    cfg = build_cfg(compile_source('x := 1\ny := 2\nprintln y'))
+    self.assertEqual(remove_dead_globals(cfg), 1)
+    self.assertEqual(run(linearize(cfg)), '2\n')
+
+  def test_inlined_results_stay_live(self):
+    source = '''
+      func add(a, b) ret a + b end
+      func f(n)
+        local total := 0
+        total := add(n, 1) * add(n, 2)
+        ret total
+      end
+      println f(3)
+    '''
+    code = compile_source(source, inline_limit=INLINE_LIMIT)
+    self.assertEqual(run(make_pass_manager(2).run(code)), '20\n')
+
+class TestTypeSpecialization(unittest.TestCase):
+  def specialize(self, source):
+    code = compile_source(source)
+    cfg = build_cfg(code)
+    specialize_types(cfg)
+    specialized = linearize(cfg)
+    self.assertEqual(run(specialized), run(code))
+    return [instruction[0] for instruction in specialized]
+
+  def test_numbers(self):
+    opcodes = self.specialize('''
+      n := 10
+      i := 0
+      total := 0
+      while i < n do
+        local sq := i * i
+        total := total + sq / 2 - i % 3
+        i := i + 1
+      end
+      println total
+    ''')
+    for opcode in ['LT_NUM', 'MUL_NUM', 'DIV_NUM', 'SUB_NUM', 'MOD_NUM', 'ADD_NUM']:
+      self.assertIn(opcode, opcodes)
+    for opcode in ['LT', 'MUL', 'DIV', 'SUB', 'MOD', 'ADD']:
+      self.assertNotIn(opcode, opcodes)
+
+  def test_strings(self):
+    opcodes = self.specialize('s := "a"\ns := s + 1\nprintln s + true')
+    self.assertEqual(opcodes.count('CONCAT_STR'), 2)
+
+  def test_unknown_types_stay_generic(self):
+    opcodes = self.specialize('''
+      func f(a) ret a + 1 end
+      x := 1
+      if f(1) > 1 then x := "one" end
+      println x + 1
+      println f(2) * 2
+    ''')
+    self.assertNotIn('ADD_NUM', opcodes)
+    self.assertNotIn('CONCAT_STR', opcodes)
+    self.assertIn('MUL', opcodes)
+    self.assertIn('GT', opcodes)
+
+  def test_loops_join_types(self):
+    opcodes = self.specialize('''
+      x := 0
+      i := 0
+      while i < 3 do
+        println x + 1
+        x := "s"
+        i := i + 1
+      end
+    ''')
+    self.assertIn('ADD', opcodes)
+    self.assertIn('LT_NUM', opcodes)
+
+  def test_for_loop_variables_are_numbers(self):
+    opcodes = self.specialize('''
+      n := 4
+      for i := 1, n do
+        println i * 2 + 1
+      end
+    ''')
+    self.assertIn('MUL_NUM', opcodes)
+    self.assertIn('ADD_NUM', opcodes)
+
+  def test_fused_with_peephole(self):
+    code = make_pass_manager(2).run(compile_source('i := 0\nwhile i < 10 do i := i + 1 end\nprintln i'))
+    self.assertIn('JMP_IF_NOT_LT_NUM', [instruction[0] for instruction in code])
+    self.assertEqual(run(code), '10\n')
+
+class TestPassManager(unittest.TestCase):
+  def test_levels(self):
+    with open('scripts/calls.pinky') as file:
+      source = file.read()
+    code = compile_source(source, inline_limit=INLINE_LIMIT)
+    expected = run(code)
+    sizes = []
+    for level in OPT_LEVELS:
+      manager = make_pass_manager(level)
+      optimized = manager.run(code)
+      self.assertEqual(run(optimized), expected)
+      sizes.append(len(assemble(optimized).code))
+      for name, elapsed, before, after, count in manager.stats:
+        self.assertGreaterEqual(elapsed, 0)
+        self.assertGreaterEqual(before, after)
+      names = [name for name, *_ in manager.stats]
+      self.assertEqual(names, [name for name, _ in manager.passes])
+    self.assertEqual(names, ['unreachable blocks', 'dead globals', 'dead stores', 'specialize types', 'peephole'])
+    self.assertGreater(sizes[0], sizes[1])
+    self.assertGreaterEqual(sizes[1], sizes[2])
+
+  def test_hoisting_levels(self):
+    source = '''
+      a := 3
+      i := 0
+      while i < 4 do
+        println a * 2
+        i := i + 1
+      end
+    '''
+    ast = Parser(Lexer(source).tokenize()).parse()
+    for level in OPT_LEVELS:
+      code = make_compiler(level).generate_code(ast)
+      hoisted = [instruction for instruction in code if instruction[0] == 'SET_SLOT' and instruction[1][1] == '(invariant)']
+      self.assertEqual(len(hoisted), 0 if level == 0 else 1)
+      self.assertEqual(run(make_pass_manager(level).run(code)), '6\n' * 4)
+
+if __name__ == "__main__":
+  unittest.main()
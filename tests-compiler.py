@@ -0,0 +1,648 @@
+import unittest
+import io
+import contextlib
+from lexer import *
+from parser import *
+from compiler import *
+from assembler import *
+from vm import *
+
+def run_source(source, inline_limit=0, hoist_invariants=False):
+  ast = Parser(Lexer(source).tokenize()).parse()
+  instructions = Compiler(inline_limit=inline_limit, hoist_invariants=hoist_invariants).generate_code(ast)
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    VM().run(instructions)
+  return output.getvalue()
+
+class TestCompiler(unittest.TestCase):
+  def test_statements(self):
+    source = '''
+      x := 1
+      s := "a" + 'b' + x
+      if x > 0 and ~(x == 2) or false then
+        local y := -x ^ 2 % 3
+        println y
+      else
+        println "no"
+      end
+      i := 0
+      while i < 3 do
+        local k := i * 2
+        if k >= 2 then println k end
+        i := i + 1
+      end
+      for j := 1, 5, 2 do
+        print j
+      end
+      println ""
+      println s
+    '''
+    self.assertEqual(run_source(source), '1\n2\n4\n135\nab1\n')
+
+  def test_functions(self):
+    source = '''
+      func f(a, b)
+        local c := a + b
+        if c > 3 then
+          ret c
+        end
+        ret 0 - c
+      end
+      func g()
+        println f(1, 2) + f(2, 3)
+      end
+      g()
+    '''
+    self.assertEqual(run_source(source), '2\n')
+
+  def test_myscript(self):
+    with open('scripts/myscript.pinky') as file:
+      output = run_source(file.read())
+    self.assertEqual(output.splitlines()[:4], ['-> 1', '-> 10', '-> 3', '-> 13'])
+    self.assertEqual(output.splitlines()[-2:], ['-> 5', '-> 0'])
+
+class TestScopes(unittest.TestCase):
+  def test_shadowing(self):
+    source = '''
+      x := 1
+      if true then
+        local x := 2
+        if true then
+          local x := 3
+          println x
+          x := 4
+          println x
+        end
+        println x
+        y := 5
+      end
+      if true then
+        y := 6
+        println y
+      end
+      println x
+    '''
+    self.assertEqual(run_source(source), '3\n4\n2\n6\n1\n')
+
+  def test_undefined_after_block(self):
+    with contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(SystemExit):
+        run_source('if true then y := 1 end\nprintln y')
+
+  def test_top_level_local(self):
+    source = 'local x := 1\nfunc f() ret x + 1 end\nprintln f()\nlocal x := 5\nprintln x'
+    self.assertEqual(run_source(source), '2\n5\n')
+
+  def test_many_variables(self):
+    count = 20000
+    lines = ['v0 := 0'] + [f'v{i} := v{i - 1} + 1' for i in range(1, count)] + [f'println v{count - 1}']
+    self.assertEqual(run_source('\n'.join(lines)), f'{count - 1}\n')
+
+class TestLazyFunctions(unittest.TestCase):
+  def run_lazy(self, source):
+    ast = Parser(Lexer(source).tokenize_compact(), lazy=True).parse()
+    instructions = Compiler().generate_code(ast)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      VM().run(instructions)
+    return output.getvalue()
+
+  def test_matches_eager(self):
+    source = '''
+      n := 10
+      func fib(n)
+        if n < 2 then ret n end
+        ret fib(n - 1) + fib(n - 2)
+      end
+      func twice(x) ret x * 2 end
+      println twice(fib(n))
+      func later() println n end
+      later()
+    '''
+    self.assertEqual(self.run_lazy(source), '110\n10\n')
+    self.assertEqual(self.run_lazy(source), run_source(source))
+
+  def test_unused_bodies_are_not_compiled(self):
+    source = '''
+      func unused() ret missing end
+      println 1
+    '''
+    self.assertEqual(self.run_lazy(source), '1\n')
+    with contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(SystemExit):
+        run_source(source)
+
+  def test_globals_declared_after_function(self):
+    source = '''
+      func f() println y end
+      y := 1
+      f()
+    '''
+    with contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(SystemExit):
+        self.run_lazy(source)
+
+  def test_myscript(self):
+    with open('scripts/myscript.pinky') as file:
+      source = file.read()
+    self.assertEqual(self.run_lazy(source), run_source(source))
+
+class TestInlining(unittest.TestCase):
+  def compile_source(self, source, inline_limit=INLINE_LIMIT):
+    ast = Parser(Lexer(source).tokenize()).parse()
+    return Compiler(inline_limit=inline_limit).generate_code(ast)
+
+  def assertInlined(self, source, expected, inline_limit=INLINE_LIMIT):
+    self.assertEqual(run_source(source), expected)
+    self.assertEqual(run_source(source, inline_limit), expected)
+
+  def test_replaces_calls(self):
+    source = '''
+      func sq(x) ret x * x end
+      func fact(n)
+        if n < 2 then ret 1 end
+        ret n * fact(n - 1)
+      end
+      println sq(3) + fact(sq(2))
+    '''
+    code = self.compile_source(source)
+    self.assertNotIn(('JSR', 'sq'), code)
+    self.assertIn(('JSR', 'fact'), code)
+    self.assertIn(('JSR', 'sq'), self.compile_source(source, inline_limit=0))
+    self.assertIn(('JSR', 'sq'), self.compile_source(source, inline_limit=2))
+    self.assertInlined(source, '33\n')
+
+  def test_ret_from_nested_blocks(self):
+    source = '''
+      func sign(x)
+        if x < 0 then
+          local m := -1
+          ret m
+        else
+          if x == 0 then ret 0 end
+        end
+        local p := 1
+        while true do
+          local q := p
+          ret q
+        end
+      end
+      func nothing(x) local y := x end
+      i := -2
+      while i <= 2 do
+        local before := 10
+        println before + sign(i) * 2 + nothing(i) + before
+        i := i + 1
+      end
+    '''
+    self.assertIn(('JSR', 'sign'), self.compile_source(source))
+    self.assertNotIn(('JSR', 'sign'), self.compile_source(source, inline_limit=100))
+    self.assertInlined(source, '18\n18\n20\n22\n22\n', inline_limit=100)
+
+  def test_inside_functions(self):
+    source = '''
+      func add(a, b) local c := a + b ret c end
+      func sum(n)
+        local total := 0
+        for i := 1, 10 do
+          total := add(total, add(i, n))
+        end
+        ret total
+      end
+      println sum(1) + add(1, 2)
+    '''
+    self.assertInlined(source, '68\n')
+
+  def test_names_resolve_as_in_the_function(self):
+    source = '''
+      g := 1
+      func get() ret g end
+      func set() y := 5 ret y end
+      y := 2
+      if true then
+        local g := 100
+        local y := 200
+        println get() + set() + y
+      end
+      println y
+    '''
+    self.assertInlined(source, '206\n2\n')
+
+class TestShortCircuit(unittest.TestCase):
+  def test_skips_right_operand(self):
+    source = '''
+      calls := 0
+      func check(x)
+        calls := calls + 1
+        ret x
+      end
+      if false and check(true) then println "no" end
+      if true or check(false) then println "or" end
+      if true and check(true) then println "and" end
+      println calls
+    '''
+    self.assertEqual(run_source(source), 'or\nand\n1\n')
+
+  def test_values(self):
+    source = '''
+      zero := 0
+      println 1 and 2
+      println zero and 1 / zero
+      println "" or "default"
+      println "set" or 1 / zero
+      println false or true and 7
+    '''
+    self.assertEqual(run_source(source), '2\n0\ndefault\nset\n7\n')
+
+  def test_emits_conditional_jumps(self):
+    code = Compiler().generate_code(Parser(Lexer('x := 1\nprintln x > 0 and x < 2 or x').tokenize()).parse())
+    self.assertIn('JMPZ_KEEP', [instruction[0] for instruction in code])
+    self.assertIn('JMPNZ_KEEP', [instruction[0] for instruction in code])
+    self.assertNotIn(('AND',), code)
+    self.assertNotIn(('OR',), code)
+
+  def test_guarded_invariants_stay_in_the_loop(self):
+    source = '''
+      d := 0
+      i := 0
+      while i < 3 do
+        if i > 5 and 1 / d > 0 then println "no" end
+        i := i + 1
+      end
+      println i
+    '''
+    self.assertEqual(run_source(source), '3\n')
+
+class TestTailCalls(unittest.TestCase):
+  def compile_source(self, source):
+    return Compiler().generate_code(Parser(Lexer(source).tokenize()).parse())
+
+  def test_emits_tail_calls(self):
+    code = self.compile_source('''
+      func f(n)
+        if n == 0 then ret 0 end
+        if n == 1 then ret 1 + f(0) end
+        ret f(n - 1)
+      end
+      println f(3)
+    ''')
+    self.assertEqual(code.count(('TAILJSR', 'f')), 1)
+    self.assertEqual(code.count(('JSR', 'f')), 2)
+
+  def test_bounded_stack(self):
+    source = '''
+      func loop(n, acc)
+        if n == 0 then ret acc end
+        local next := n - 1
+        ret loop(next, acc + n)
+      end
+      println loop(100000, 0)
+    '''
+    vm = VM()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      vm.run(self.compile_source(source))
+    self.assertEqual(output.getvalue(), '5000050000\n')
+    self.assertLess(len(vm.stack), 10)
+
+  def test_tail_call_to_other_function(self):
+    source = '''
+      func countdown(n)
+        if n == 0 then ret "done" end
+        ret countdown(n - 1)
+      end
+      func start(n)
+        local twice := n * 2
+        ret countdown(twice)
+      end
+      println start(5000)
+      println "after " + start(1)
+    '''
+    self.assertEqual(run_source(source), 'done\nafter done\n')
+
+  def test_calls_with_different_arity(self):
+    source = '''
+      func add(a, b, c) ret a + b + c end
+      func one(x) ret add(x, x, x) end
+      func zero() ret one(2) end
+      println zero() + one(1)
+    '''
+    self.assertEqual(run_source(source), '9\n')
+    self.assertEqual(run_source(source, INLINE_LIMIT), '9\n')
+
+class TestForLoops(unittest.TestCase):
+  def test_counted_loop_opcodes(self):
+    code = Compiler().generate_code(Parser(Lexer('for i := 1, 10 do println i end').tokenize()).parse())
+    opcodes = [instruction[0] for instruction in code]
+    self.assertEqual(opcodes.count('FOR_PREP'), 1)
+    self.assertEqual(opcodes.count('FOR_LOOP'), 1)
+    self.assertNotIn('LE', opcodes)
+    slots = [instruction[1][1] for instruction in code if instruction[0] == 'SET_SLOT']
+    self.assertEqual(slots, ['i', '(for bound)', '(for step)', '(for up)'])
+
+  def test_directions(self):
+    source = '''
+      top := 3
+      bottom := -3
+      step := 2
+      for y := top, bottom, -step do print y end
+      println ""
+      for y := bottom, top, step do print y end
+      println ""
+      for y := top, top - 2 do print y end
+      println ""
+      for y := 0.5, 2 do print y end
+      println ""
+      for y := 1, 1 do print y end
+      println ""
+    '''
+    self.assertEqual(run_source(source), '31-1-3\n-3-113\n321\n0.51.5\n1\n')
+
+  def test_bound_and_step_evaluated_once(self):
+    source = '''
+      n := 3
+      k := 1
+      func f(a)
+        local total := 0
+        for i := a, n, k do
+          n := n + 1
+          k := k + 1
+          total := total + i
+        end
+        ret total
+      end
+      println f(1)
+    '''
+    self.assertEqual(run_source(source), '6\n')
+
+  def test_variable_assigned_in_body(self):
+    source = '''
+      for i := 1, 10 do
+        print i
+        i := i * 2
+      end
+      println ""
+    '''
+    self.assertEqual(run_source(source), '137\n')
+
+  def test_locals_of_the_body(self):
+    source = '''
+      for i := 1, 3 do
+        y := i * 2
+        for j := y, y + 1 do
+          x := j + y
+          print x
+        end
+      end
+      println ""
+    '''
+    self.assertEqual(run_source(source), '45891213\n')
+
+  def test_errors(self):
+    for source in ['for i := 1, "a" do end', 'for i := 1, 3, true do end', 'for i := 1, 3 do i := "a" end']:
+      with contextlib.redirect_stdout(io.StringIO()):
+        with self.assertRaises(SystemExit):
+          run_source(source)
+
+class TestLoopInvariants(unittest.TestCase):
+  def hoisted(self, source):
+    code = Compiler(hoist_invariants=True).generate_code(Parser(Lexer(source).tokenize()).parse())
+    return sum(1 for instruction in code if instruction[0] == 'SET_SLOT' and instruction[1][1] == '(invariant)')
+
+  def test_hoists_invariant_expressions(self):
+    source = '''
+      a := 3
+      b := 4
+      s := "x"
+      total := 0
+      i := 0
+      while i < a * b do
+        total := total + i * (b - a) + (a * b) / 2
+        println s + "-" + a
+        i := i + 1
+      end
+      for j := 1, 3 do
+        println j * (a + b)
+      end
+      println total
+    '''
+    self.assertEqual(self.hoisted(source), 5)
+    self.assertEqual(run_source(source, hoist_invariants=True), 'x-3\n' * 12 + '7\n14\n21\n138\n')
+
+  def test_keeps_assigned_names(self):
+    source = '''
+      n := 0
+      func bump() n := n + 1 end
+      i := 0
+      while i < 10 - n do
+        bump()
+        local k := n * 2
+        i := i + 1
+      end
+      println i
+    '''
+    self.assertEqual(self.hoisted(source), 0)
+    self.assertEqual(run_source(source, hoist_invariants=True), '5\n')
+
+  def test_loops_that_do_not_run(self):
+    source = '''
+      d := 0
+      i := 0
+      while i < 0 do
+        println 1 / d
+      end
+      while i < 3 do
+        if d ~= 0 then println 1 / d end
+        i := i + 1
+      end
+      func f(x)
+        while true do
+          if d == 0 then ret x end
+          println x / d
+        end
+      end
+      println f(7)
+    '''
+    self.assertEqual(run_source(source, hoist_invariants=True), '7\n')
+
+  def run_failing(self, source):
+    code = Compiler(hoist_invariants=True).generate_code(Parser(Lexer(source).tokenize()).parse())
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      with self.assertRaises(SystemExit):
+        VM().run(code)
+    return output.getvalue()
+
+  def test_failing_invariants_stay_in_the_loop(self):
+    source = '''
+      a := 1
+      b := 0
+      i := 0
+      while i < 2 do
+        println "before"
+        x := a / b
+        i := i + 1
+      end
+    '''
+    self.assertEqual(self.hoisted(source), 0)
+    self.assertTrue(self.run_failing(source).startswith('before\n'))
+    source = '''
+      a := 1
+      s := "s"
+      for i := 1, 3 do
+        println "before"
+        local l := a + true <= s
+      end
+    '''
+    self.assertEqual(self.hoisted(source), 0)
+    self.assertTrue(self.run_failing(source).startswith('before\n'))
+
+  def test_failing_invariants_keep_the_order_of_errors(self):
+    source = '''
+      a := 1
+      b := 0
+      s := "s"
+      i := 0
+      while i < 2 do
+        x := (s - i) + a / b
+        i := i + 1
+      end
+    '''
+    output = self.run_failing(source)
+    self.assertIn('SUB', output)
+    self.assertNotIn('zero', output)
+
+  def test_hoists_by_type(self):
+    source = '''
+      a := 3
+      b := 4
+      s := "x"
+      func f(p)
+        local t := 0
+        for i := 1, 3 do
+          t := t + (a * b) / 2 + p * a + -a
+          println s + p
+        end
+        ret t
+      end
+      println f(2)
+    '''
+    # (a * b) / 2, -a and s + p, not p * a with p of any type
+    self.assertEqual(self.hoisted(source), 3)
+    self.assertEqual(run_source(source, hoist_invariants=True), 'x2\n' * 3 + '27\n')
+
+  def test_nested_loops(self):
+    source = '''
+      w := 3
+      total := 0
+      y := 0
+      while y < w do
+        x := 0
+        while x < w do
+          total := total + (y * w + w / 2) * (w - 1)
+          x := x + 1
+        end
+        y := y + 1
+      end
+      println total
+    '''
+    self.assertEqual(self.hoisted(source), 1)
+    self.assertEqual(run_source(source, hoist_invariants=True), '81\n')
+
+class TestAssembler(unittest.TestCase):
+  def test_resolves_labels(self):
+    instructions = [
+      ('LABEL', 'START'),
+      ('PUSH', (TYPE_NUMBER, 1.0)),
+      ('SET_SLOT', (0, 'x')),
+      ('LABEL', 'LOOP'),
+      ('LOAD_LOCAL', 0),
+      ('JMPZ', 'END'),
+      ('JMP', 'LOOP'),
+      ('LABEL', 'END'),
+      ('HALT',)]
+    program = assemble(instructions)
+    self.assertEqual(program.code, [
+      ('PUSH_CONST', 0),
+      ('LOAD_LOCAL', 0),
+      ('JMPZ', 4),
+      ('JMP', 1),
+      ('HALT',)])
+    self.assertEqual(program.labels, {'START': 0, 'LOOP': 1, 'END': 4})
+    self.assertEqual(program.slots, {1: [(0, 'x')]})
+    self.assertEqual(program.label_names()[4], ['END'])
+    self.assertEqual(program.consts, [(TYPE_NUMBER, 1.0)])
+
+  def test_constant_pool(self):
+    ast = Parser(Lexer('x := 2\ny := "a"\nprintln x * 2 + 2.0\nprintln y + "a"\nprintln ~true\nprintln ~false').tokenize()).parse()
+    instructions = Compiler().generate_code(ast)
+    pushed = [instruction[1] for instruction in instructions if instruction[0] == 'PUSH']
+    # 2, "a", 2, 2.0, "a", ...
+    self.assertIs(pushed[0], pushed[2])
+    self.assertIs(pushed[0], pushed[3])
+    self.assertIs(pushed[1], pushed[4])
+    program = assemble(instructions)
+    self.assertNotIn('PUSH', [instruction[0] for instruction in program.code])
+    self.assertEqual(len(program.consts), len(set(program.consts)))
+    self.assertEqual(program.consts[:2], [(TYPE_NUMBER, 2.0), (TYPE_STRING, 'a')])
+    # The 1 of not is an int and stays apart from the literal 1.0 and true
+    self.assertIn((TYPE_NUMBER, 1), program.consts)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      VM().run(program)
+    self.assertEqual(output.getvalue(), '6\naa\nfalse\ntrue\n')
+
+  def test_undefined_label(self):
+    with contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(SystemExit):
+        assemble([('JMP', 'NOWHERE')])
+
+  def test_no_pseudo_instructions(self):
+    with open('scripts/myscript.pinky') as file:
+      ast = Parser(Lexer(file.read()).tokenize()).parse()
+    program = assemble(Compiler().generate_code(ast))
+    self.assertFalse(any(instruction[0] in pseudo_opcodes for instruction in program.code))
+    for instruction in program.code:
+      if instruction[0] in jump_opcodes:
+        self.assertIsInstance(instruction[1], int)
+
+  def test_runs_assembled_program(self):
+    ast = Parser(Lexer('func f(a) ret a * 2 end\nprintln f(21)').tokenize()).parse()
+    program = assemble(Compiler().generate_code(ast))
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      VM().run(program)
+    self.assertEqual(output.getvalue(), '42\n')
+
+class TestDeepNesting(unittest.TestCase):
+  depth = 100000
+
+  def test_long_chain(self):
+    source = 'println 0' + ' + 1' * self.depth
+    self.assertEqual(run_source(source), f'{self.depth}\n')
+
+  def test_nested_parentheses(self):
+    source = 'println ' + '(' * self.depth + '1' + ')' * self.depth
+    self.assertEqual(run_source(source), '1\n')
+
+  def test_nested_right_operands(self):
+    source = 'println ' + '(1 + ' * self.depth + '0' + ')' * self.depth
+    self.assertEqual(run_source(source), f'{self.depth}\n')
+
+  def test_nested_calls_and_unary(self):
+    source = 'func id(x) ret x end\nprintln ' + 'id(-' * self.depth + '1' + ')' * self.depth
+    self.assertEqual(run_source(source), '1\n')
+
+  def test_nested_ifs(self):
+    source = 'x := 1\n' + 'if x == 1 then ' * self.depth + 'println x' + ' end' * self.depth
+    self.assertEqual(run_source(source), '1\n')
+    source = 'x := 1\n' + 'if x == 2 then println 0 else ' * self.depth + 'println x' + ' end' * self.depth
+    self.assertEqual(run_source(source), '1\n')
+
+  def test_nested_loops(self):
+    source = 'i := 0\n' + 'while i < 1 do ' * self.depth + 'println i i := 1' + ' end' * self.depth
+    self.assertEqual(run_source(source, hoist_invariants=True), '0\n')
+
+if __name__ == "__main__":
+  unittest.main()
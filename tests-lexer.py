@@ -0,0 +1,128 @@
+import unittest
+import io
+import mmap
+import tempfile
+import lexer
+from tokens import *
+from lexer import *
+
+def token_tuples(tokens):
+  return [(token.token_type, token.lexeme, token.line) for token in tokens]
+
+class TestLexerEngines(unittest.TestCase):
+  def assertSameTokens(self, source):
+    expected = token_tuples(Lexer(source, LEXER_SCAN).tokenize())
+    result = token_tuples(Lexer(source, LEXER_REGEX).tokenize())
+    self.assertEqual(result, expected)
+
+  def test_operators(self):
+    self.assertSameTokens('( ) { } [ ] , . + - * / ^ % : ; ? ~ > < = >= <= ~= == := >> <<')
+
+  def test_adjacent_operators(self):
+    self.assertSameTokens('x:=-y>=~z<<<=>>>:==')
+
+  def test_numbers(self):
+    self.assertSameTokens('1 23 4.5 6. 7.8.9 10')
+
+  def test_keywords_and_identifiers(self):
+    self.assertSameTokens('if then else true false and or while do for func null end print println ret local')
+    self.assertSameTokens('_x x1 iffy end_ println2 _')
+
+  def test_strings(self):
+    self.assertSameTokens('"double" \'single\' "it\'s" \'say "hi"\' "" \'\'')
+
+  def test_multiline_string_keeps_line(self):
+    self.assertSameTokens('a := "one\ntwo"\nb := 1')
+
+  def test_comments(self):
+    self.assertSameTokens('x := 1 -- comment := "\ny := 2 --\n-- last line without newline')
+
+  def test_whitespace(self):
+    self.assertSameTokens('\r\n\tx\t:=\r\n  1\n\n\n')
+    self.assertSameTokens('')
+
+  def test_scripts(self):
+    for filename in ['scripts/myscript.pinky', 'scripts/mandel.pinky']:
+      with open(filename) as file:
+        self.assertSameTokens(file.read())
+
+  def test_default_engine(self):
+    tokens = Lexer('x := 1').tokenize()
+    self.assertEqual(token_tuples(tokens), [(TOK_IDENTIFIER, 'x', 1), (TOK_ASSIGN, ':=', 1), (TOK_INTEGER, '1', 1)])
+
+class TestTokenStore(unittest.TestCase):
+  def test_store_matches_tokens(self):
+    with open('scripts/mandel.pinky') as file:
+      source = file.read()
+    expected = token_tuples(Lexer(source).tokenize())
+    store = Lexer(source).tokenize_compact()
+    self.assertEqual(token_tuples(store), expected)
+    self.assertEqual([store.kind(i) for i in range(len(store))], [token[0] for token in expected])
+    self.assertEqual(store.kind(len(store)), None)
+
+  def test_lazy_lexemes(self):
+    store = Lexer('msg := "hi" -- x\nprintln msg').tokenize_compact()
+    self.assertEqual([store.lexeme(i) for i in range(len(store))], ['msg', ':=', 'hi', 'println', 'msg'])
+    self.assertEqual([store.line(i) for i in range(len(store))], [1, 1, 1, 2, 2])
+
+  def test_token_names(self):
+    self.assertEqual(repr(Token(TOK_ASSIGN, ':=', 3)), "(TOK_ASSIGN, ':=', 3)")
+
+class TestParallelLexer(unittest.TestCase):
+  def assertSameTokens(self, source, workers):
+    expected = token_tuples(Lexer(source).tokenize())
+    result = token_tuples(Lexer(source).tokenize_compact(workers))
+    self.assertEqual(result, expected)
+
+  def test_scripts(self):
+    with open('scripts/mandel.pinky') as file:
+      source = file.read() * 8
+    self.assertSameTokens(source, 2)
+
+  def test_strings_across_chunks(self):
+    # Strings spanning many lines move every later line number and cross
+    # several chunk boundaries
+    source = ''.join(f'x{i} := "a\nb -- \n\'c\n" + \'\n\n"\' -- "\n' for i in range(40))
+    self.assertSameTokens(source, 3)
+    source = 'x := "' + '\n' * 200 + '"\ny := 1\n' * 3
+    self.assertSameTokens(source, 4)
+
+  def test_unterminated_string(self):
+    with self.assertRaises(SystemExit):
+      Lexer('x := 1\n' * 100 + 'y := "never closed\n' + 'z := 2\n' * 100).tokenize_compact(2)
+
+class TestLexerStream(unittest.TestCase):
+  source = 'x := "first\nsecond"\n-- comment "\ny := \'a\' + x\nprintln y\n'
+
+  def setUp(self):
+    self.chunk_size = lexer.CHUNK_SIZE
+    lexer.CHUNK_SIZE = 4
+
+  def tearDown(self):
+    lexer.CHUNK_SIZE = self.chunk_size
+
+  def test_text_file(self):
+    expected = token_tuples(Lexer(self.source).tokenize())
+    result = token_tuples(Lexer(io.StringIO(self.source)).stream())
+    self.assertEqual(result, expected)
+
+  def test_binary_file(self):
+    expected = token_tuples(Lexer(self.source).tokenize())
+    result = token_tuples(Lexer(io.BytesIO(self.source.encode('utf-8'))).stream())
+    self.assertEqual(result, expected)
+
+  def test_mmap(self):
+    expected = token_tuples(Lexer(self.source).tokenize())
+    with tempfile.TemporaryFile() as file:
+      file.write(self.source.encode('utf-8'))
+      file.flush()
+      with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        result = token_tuples(Lexer(mapped).tokenize())
+    self.assertEqual(result, expected)
+
+  def test_stream_is_lazy(self):
+    stream = Lexer(io.StringIO(self.source)).stream()
+    self.assertEqual(token_tuples([next(stream)]), [(TOK_IDENTIFIER, 'x', 1)])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,221 @@
+import unittest
+import io
+import contextlib
+from lexer import *
+from parser import *
+from optimizer import *
+from compiler import *
+from arena import *
+from vm import *
+
+def compile_source(source, optimized = True):
+  ast = Parser(Lexer(source).tokenize()).parse()
+  if optimized: ast = optimize(ast)
+  return Compiler().generate_code(ast)
+
+def run_source(source, optimized = True):
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    VM().run(compile_source(source, optimized))
+  return output.getvalue()
+
+class TestConstantFolding(unittest.TestCase):
+  def assertFolds(self, source, value):
+    code = compile_source(f'println {source}')
+    self.assertEqual(code, [('LABEL', 'START'), ('PUSH', value), ('PRINTLN',), ('HALT',)])
+
+  def test_arithmetic(self):
+    self.assertFolds('2 * 3 + 1', (TYPE_NUMBER, 7.0))
+    self.assertFolds('-(4 - 6) ^ 2 % 3', (TYPE_NUMBER, 1.0))
+    self.assertFolds('7 / 2', (TYPE_NUMBER, 3.5))
+    self.assertFolds('-5', (TYPE_NUMBER, -5.0))
+    self.assertFolds('+5', (TYPE_NUMBER, 5.0))
+
+  def test_comparisons_and_logic(self):
+    self.assertFolds('1 < 2 and "a" == "a"', (TYPE_BOOL, True))
+    self.assertFolds('~(3 >= 4) or false', (TYPE_BOOL, True))
+    self.assertFolds('true ~= false', (TYPE_BOOL, True))
+    self.assertFolds('1 and 2', (TYPE_NUMBER, 2.0))
+    self.assertFolds('0 or "x"', (TYPE_STRING, 'x'))
+    self.assertFolds('"" and 1 / 0', (TYPE_STRING, ''))
+
+  def test_strings(self):
+    self.assertFolds('"a" + 1 + "b" + true', (TYPE_STRING, 'a1btrue'))
+    self.assertFolds("'x' + 2.5 * 2", (TYPE_STRING, 'x5'))
+
+  def test_errors_are_left_to_the_vm(self):
+    for source in ['1 / 0', '1 % 0', '1 + true', '~1', '"a" - 1', '1 < "a"']:
+      code = compile_source(f'println {source}')
+      self.assertGreater(len(code), 4, source)
+    with contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(SystemExit):
+        run_source('println 1 / (2 - 2)')
+
+  def test_deep_expression(self):
+    depth = 100000
+    code = compile_source('println ' + '(1 + ' * depth + '0' + ')' * depth)
+    self.assertEqual(code[1], ('PUSH', (TYPE_NUMBER, float(depth))))
+
+class TestConstantPropagation(unittest.TestCase):
+  def test_literal_globals(self):
+    source = '''
+      maxIter := 200
+      step := -7
+      name := "pinky"
+      limit := maxIter * 2
+      i := 0
+      while i < limit do i := i - step end
+      println name + i
+    '''
+    code = compile_source(source)
+    self.assertNotIn(('LOAD_GLOBAL', 0), code)
+    self.assertNotIn(('LOAD_GLOBAL', 3), code)
+    self.assertIn(('PUSH', (TYPE_NUMBER, 400.0)), code)
+    self.assertEqual(run_source(source), 'pinky406\n')
+
+  def test_reassigned_globals(self):
+    source = '''
+      x := 1
+      func bump() x := x + 1 end
+      bump()
+      println x
+    '''
+    self.assertIn(('LOAD_GLOBAL', 0), compile_source(source))
+    self.assertEqual(run_source(source), '2\n')
+
+  def test_shadowed_names(self):
+    source = '''
+      x := 1
+      y := 2
+      func f(x) ret x end
+      func g() local y := 5 ret y end
+      println f(3) + g() + x + y
+    '''
+    self.assertEqual(run_source(source), '11\n')
+
+  def test_uses_before_assignment(self):
+    with contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(SystemExit):
+        compile_source('println x\nx := 1')
+
+  def test_lazy_bodies(self):
+    source = '''
+      x := 1
+      func f() x := 2 ret 1 + 2 end
+      func g() ret x end
+      println g()
+      println f() + x
+    '''
+    ast = optimize(Parser(Lexer(source).tokenize(), lazy = True).parse())
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      VM().run(Compiler().generate_code(ast))
+    self.assertEqual(output.getvalue(), '1\n5\n')
+    self.assertIsInstance(ast.stmts[1].body_stmts.stmts[1].value, Float)
+
+  def test_sample_scripts(self):
+    for filename in ['scripts/myscript.pinky', 'scripts/mandel-while.pinky']:
+      with open(filename) as file:
+        source = file.read().replace('xStep      :=    7', 'xStep := 70')
+      self.assertEqual(run_source(source), run_source(source, optimized = False), filename)
+
+class TestDeadCode(unittest.TestCase):
+  def test_constant_conditions(self):
+    source = '''
+      debug := false
+      if debug then println "debug" end
+      if ~debug then println "a" else println "b" end
+      if debug then println "c" else println "d" end
+      while debug do println "e" end
+    '''
+    ast = optimize(Parser(Lexer(source).tokenize()).parse())
+    self.assertEqual(len(ast.stmts), 3)
+    self.assertIsNone(ast.stmts[1].else_stmts)
+    self.assertEqual(run_source(source), 'a\nd\n')
+
+  def test_after_ret(self):
+    source = '''
+      func f(x)
+        if x > 1 then
+          ret 1
+          println "never"
+        end
+        ret 2
+        println "never"
+        x := 3
+      end
+      println f(2) + f(0)
+    '''
+    ast = optimize(Parser(Lexer(source).tokenize()).parse())
+    body = ast.stmts[0].body_stmts.stmts
+    self.assertEqual(len(body), 2)
+    self.assertEqual(len(body[0].then_stmts.stmts), 1)
+    self.assertEqual(run_source(source), '3\n')
+
+  def test_unused_functions(self):
+    source = '''
+      func unused() ret used() end
+      func used() ret 1 end
+      func helper() ret 2 end
+      func main() ret used() + helper() end
+      func rec(n) ret rec(n - 1) end
+      if false then rec(1) end
+      println main()
+    '''
+    ast = optimize(Parser(Lexer(source).tokenize(), lazy = True).parse())
+    names = [stmt.identifier.name for stmt in ast.stmts if isinstance(stmt, FuncDecl)]
+    self.assertEqual(names, ['used', 'helper', 'main'])
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      VM().run(Compiler().generate_code(ast))
+    self.assertEqual(output.getvalue(), '3\n')
+
+  def test_unused_lazy_bodies_stay_unparsed(self):
+    source = 'func lib() ret 1 end\nfunc main() ret 2 end\nprintln main()'
+    ast = Parser(Lexer(source).tokenize(), lazy = True).parse()
+    lib = ast.stmts[0]
+    ast = optimize(ast)
+    self.assertFalse(lib.body_stmts.is_parsed())
+    self.assertNotIn(lib, ast.stmts)
+
+  def test_arena(self):
+    source = '''
+      debug := false
+      func unused() ret 1 end
+      func f(x)
+        if debug then println "debug" else println x end
+        while x > 0 do
+          ret x
+          println "never"
+        end
+        ret 0
+      end
+      if true then println f(2) else println "no" end
+    '''
+    arena = Arena()
+    root = arena.node(Parser(Lexer(source).tokenize(), arena).parse())
+    ast = optimize(root)
+    self.assertEqual(len(ast.stmts), 3)
+    self.assertEqual(len(root.stmts), 4)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      VM().run(Compiler().generate_code(ast))
+    self.assertEqual(output.getvalue(), run_source(source))
+    self.assertEqual(output.getvalue(), '2\n2\n')
+
+  def test_nested_functions(self):
+    source = '''
+      func outer()
+        func inner() ret 5 end
+        ret 0
+      end
+      outer()
+      println inner()
+    '''
+    self.assertEqual(run_source(source), '5\n')
+    # inner is only declared inside the uncalled outer
+    source = source.replace('      outer()\n', '')
+    self.assertEqual(run_source(source), run_source(source, optimized = False))
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,200 @@
+import unittest
+import io
+import contextlib
+from tokens import *
+from lexer import *
+from parser import *
+from compiler import *
+from arena import *
+from interpreter import *
+
+def compile_tokens(tokens):
+  ast = Parser(tokens).parse()
+  return Compiler().generate_code(ast)
+
+def dump_ast(ast):
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    pretty_print_stmts(ast)
+  return output.getvalue()
+
+class TestExpressionParser(unittest.TestCase):
+  def assertSameAst(self, source):
+    expected = dump_ast(ChainParser(Lexer(source).tokenize()).parse())
+    result = dump_ast(Parser(Lexer(source).tokenize()).parse())
+    self.assertEqual(result, expected)
+
+  def test_precedence(self):
+    self.assertSameAst('x := 1 + 2 * 3 - 4 / 5 % 6 ^ 7 ^ 8')
+    self.assertSameAst('x := a or b and c == d ~= e < f <= g > h >= i + j')
+    self.assertSameAst('x := a ^ b % c * d - e == f and g or h')
+
+  def test_associativity(self):
+    self.assertSameAst('x := a - b - c + d')
+    self.assertSameAst('x := a / b * c % d % e')
+    self.assertSameAst('x := a ^ b ^ c ^ d')
+    self.assertSameAst('x := a < b < c or d or e and f and g')
+
+  def test_unary_and_grouping(self):
+    self.assertSameAst('x := -a ^ -b * ~(c or -d) - +e')
+    self.assertSameAst('x := f(a + b, g(c * d), (e - h)) ^ 2')
+
+  def test_scripts(self):
+    for filename in ['scripts/myscript.pinky', 'scripts/mandel.pinky']:
+      with open(filename) as file:
+        self.assertSameAst(file.read())
+
+class TestValidation(unittest.TestCase):
+  def tearDown(self):
+    set_validation(True)
+
+  def test_nodes_have_no_dict(self):
+    ast = Parser(Lexer('x := -(1 + 2)\nprintln f(x)').tokenize()).parse()
+    pending = [ast]
+    while pending:
+      node = pending.pop()
+      self.assertFalse(hasattr(node, '__dict__'), type(node).__name__)
+      pending.extend(node.children())
+
+  def test_production_mode_builds_same_tree(self):
+    with open('scripts/myscript.pinky') as file:
+      source = file.read()
+    expected = dump_ast(Parser(Lexer(source).tokenize()).parse())
+    set_validation(False)
+    ast = Parser(Lexer(source).tokenize()).parse()
+    self.assertEqual(dump_ast(ast), expected)
+    validate_ast(ast)
+
+  def test_validate_ast(self):
+    set_validation(False)
+    ast = Parser(Lexer('1 + 2').tokenize()).parse()
+    with self.assertRaises(AssertionError):
+      validate_ast(ast)
+    set_validation(True)
+    with self.assertRaises(AssertionError):
+      Parser(Lexer('1 + 2').tokenize()).parse()
+
+class TestArena(unittest.TestCase):
+  def parse_both(self, filename):
+    with open(filename) as file:
+      source = file.read()
+    ast = Parser(Lexer(source).tokenize()).parse()
+    arena = Arena()
+    root = Parser(Lexer(source).tokenize(), arena).parse()
+    return ast, arena, root
+
+  def test_views_match_objects(self):
+    for filename in ['scripts/myscript.pinky', 'scripts/mandel.pinky']:
+      ast, arena, root = self.parse_both(filename)
+      self.assertEqual(dump_ast(arena.node(root)), dump_ast(ast))
+      validate_ast(arena.node(root))
+
+  def test_compile_from_arena(self):
+    ast, arena, root = self.parse_both('scripts/myscript.pinky')
+    self.assertEqual(Compiler().generate_code(arena.node(root)), Compiler().generate_code(ast))
+
+  def test_interpret_from_arena(self):
+    ast, arena, root = self.parse_both('scripts/myscript.pinky')
+    outputs = []
+    for tree in [ast, arena.node(root)]:
+      output = io.StringIO()
+      with contextlib.redirect_stdout(output):
+        Interpreter().interpret_program(tree)
+      outputs.append(output.getvalue())
+    self.assertEqual(outputs[1], outputs[0])
+
+  def test_serialize(self):
+    ast, arena, root = self.parse_both('scripts/mandel.pinky')
+    loaded = Arena.from_bytes(arena.to_bytes())
+    self.assertEqual(dump_ast(loaded.node(root)), dump_ast(ast))
+
+  def test_literals_are_shared(self):
+    arena = Arena()
+    Parser(Lexer('x := 1\ny := x + 1 + 1.0').tokenize(), arena).parse()
+    self.assertEqual(sorted(map(repr, arena.literals)), ["'x'", "'y'", '1', '1.0'])
+
+class TestParserTokenSources(unittest.TestCase):
+  def test_stream_matches_list(self):
+    with open('scripts/myscript.pinky') as file:
+      source = file.read()
+    expected = compile_tokens(Lexer(source).tokenize())
+    result = compile_tokens(Lexer(io.StringIO(source)).stream())
+    self.assertEqual(result, expected)
+
+  def test_store_matches_list(self):
+    with open('scripts/myscript.pinky') as file:
+      source = file.read()
+    expected = compile_tokens(Lexer(source).tokenize())
+    result = compile_tokens(Lexer(source).tokenize_compact())
+    self.assertEqual(result, expected)
+
+  def test_stream_window_is_bounded(self):
+    source = 'x := 0\n' + 'x := x + 1\n' * 1000
+    stream = TokenStream(Lexer(source).stream())
+    Parser(stream).parse()
+    self.assertLessEqual(len(stream.window), TokenStream.max_window + 1)
+
+class TestLazyParsing(unittest.TestCase):
+  source = """
+    func unused(a)
+      if a > 0 then
+        while a > 0 do a := a - 1 end
+      else
+        for i := 1, 3 do println i end
+      end
+      ret a
+    end
+    func used(a, b)
+      func inner(x) ret x * 2 end
+      ret inner(a) + b
+    end
+    println used(1, 2)
+  """
+
+  def test_bodies_are_skipped(self):
+    ast = Parser(Lexer(self.source).tokenize_compact(), lazy=True).parse()
+    unused, used = ast.stmts[0], ast.stmts[1]
+    self.assertIsInstance(unused.body_stmts, LazyStmts)
+    self.assertFalse(unused.body_stmts.is_parsed())
+    self.assertEqual(len(used.body_stmts.stmts), 2)
+    self.assertTrue(used.body_stmts.is_parsed())
+    self.assertFalse(unused.body_stmts.is_parsed())
+
+  def test_same_tree_as_eager(self):
+    tokens = Lexer(self.source).tokenize()
+    eager = dump_ast(Parser(tokens).parse())
+    self.assertEqual(dump_ast(Parser(tokens, lazy=True).parse()), eager)
+
+  def test_compiler_only_parses_called_functions(self):
+    ast = Parser(Lexer(self.source).tokenize(), lazy=True).parse()
+    code = Compiler().generate_code(ast)
+    self.assertFalse(ast.stmts[0].body_stmts.is_parsed())
+    self.assertNotIn(('LABEL', 'unused'), code)
+    self.assertIn(('LABEL', 'used'), code)
+
+  def test_interpreter_only_parses_called_functions(self):
+    ast = Parser(Lexer(self.source).tokenize(), lazy=True).parse()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      Interpreter().interpret_program(ast)
+    self.assertEqual(output.getvalue(), '4\n')
+    self.assertFalse(ast.stmts[0].body_stmts.is_parsed())
+
+  def test_errors_surface_on_first_use(self):
+    source = 'func f() x := end\nprintln 1'
+    ast = Parser(Lexer(source).tokenize(), lazy=True).parse()
+    with contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(SystemExit):
+        ast.stmts[0].body_stmts.stmts
+
+  def test_unclosed_body(self):
+    with contextlib.redirect_stdout(io.StringIO()):
+      with self.assertRaises(SystemExit):
+        Parser(Lexer('func f() if x then end').tokenize(), lazy=True).parse()
+
+  def test_stream_is_parsed_eagerly(self):
+    ast = Parser(Lexer(io.StringIO(self.source)).stream(), lazy=True).parse()
+    self.assertNotIsInstance(ast.stmts[0].body_stmts, LazyStmts)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,161 @@
+import unittest
+import io
+import contextlib
+from lexer import *
+from parser import *
+from compiler import *
+from peephole import *
+from vm import *
+
+def compile_source(source):
+  ast = Parser(Lexer(source).tokenize()).parse()
+  return Compiler().generate_code(ast)
+
+def run_code(code):
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    VM().run(code)
+  return output.getvalue()
+
+class TestPeephole(unittest.TestCase):
+  def test_jump_threading(self):
+    code = [
+      ('LABEL', 'START'),
+      ('LOAD_GLOBAL', 0),
+      ('JMPZ', 'A'),
+      ('JMP', 'B'),
+      ('LABEL', 'A'),
+      ('JMP', 'C'),
+      ('LABEL', 'B'),
+      ('LABEL', 'C'),
+      ('HALT',)]
+    optimizer = PeepholeOptimizer()
+    self.assertEqual(optimizer.optimize(code), [
+      ('LABEL', 'START'),
+      ('LOAD_GLOBAL', 0),
+      ('JMPZ', 'C'),
+      ('HALT',),
+      ('LABEL', 'C'),
+      ('HALT',)])
+    self.assertEqual(optimizer.stats['jump threading'], 3)
+
+  def test_jump_cycle(self):
+    code = [('LABEL', 'START'), ('LABEL', 'A'), ('JMP', 'B'), ('LABEL', 'B'), ('JMP', 'A')]
+    self.assertEqual(PeepholeOptimizer().optimize(code)[:3], [('LABEL', 'START'), ('LABEL', 'A'), ('JMP', 'A')])
+
+  def test_empty_else(self):
+    code = PeepholeOptimizer().optimize(compile_source('x := 1\nif x > 0 then println x end'))
+    self.assertFalse(any(instruction[0] == 'JMP' for instruction in code))
+
+  def test_short_circuit_conditions(self):
+    source = '''
+      a := 1
+      b := 2
+      if a < b and b < 3 and a > 0 then println "and" end
+      if a > b or b == 2 then println "or" end
+      println a and b
+    '''
+    code = compile_source(source)
+    optimized = PeepholeOptimizer(superinstructions=False).optimize(code)
+    self.assertEqual(sum(1 for instruction in optimized if instruction[0] == 'JMPZ_KEEP'), 1)
+    self.assertEqual(sum(1 for instruction in optimized if instruction[0] == 'JMPNZ_KEEP'), 1)
+    self.assertEqual(run_code(optimized), run_code(code))
+    self.assertEqual(run_code(code), 'and\nor\n2\n')
+
+  def test_constant_jumps(self):
+    code = [('LABEL', 'START'), ('PUSH', (TYPE_BOOL, True)), ('JMPZ', 'A'), ('PUSH', (TYPE_BOOL, False)), ('JMPZ', 'B'), ('LABEL', 'A'), ('PRINTLN',), ('LABEL', 'B'), ('HALT',)]
+    self.assertEqual(PeepholeOptimizer().optimize(code), [('LABEL', 'START'), ('HALT',)])
+
+  def test_pops(self):
+    optimizer = PeepholeOptimizer()
+    code = optimizer.optimize(compile_source('''
+      i := 0
+      while i < 2 do
+        local a := 1
+        local b := 2
+        local c := 3
+        i := i + 1
+      end
+      func f() ret 1 end
+      f()
+    '''))
+    self.assertIn(('POPN', 3), code)
+    self.assertEqual(optimizer.stats['merge pops'], 2)
+    self.assertEqual(code.count(('POP',)), 1)
+
+  def test_push_pop(self):
+    code = [('LABEL', 'START'), ('PUSH', (TYPE_NUMBER, 1.0)), ('POP',), ('LOAD_GLOBAL', 0), ('POP',), ('HALT',)]
+    optimizer = PeepholeOptimizer()
+    self.assertEqual(optimizer.optimize(code), [('LABEL', 'START'), ('HALT',)])
+    self.assertEqual(optimizer.stats['push/pop'], 4)
+
+  def test_unused_functions(self):
+    code = PeepholeOptimizer().optimize(compile_source('func f() println 1 end\nprintln 2'))
+    self.assertNotIn(('LABEL', 'f'), code)
+    self.assertNotIn(('PUSH', (TYPE_NUMBER, 1.0)), code)
+    self.assertEqual(run_code(code), '2\n')
+
+  def test_same_output(self):
+    sources = []
+    with open('scripts/myscript.pinky') as file:
+      sources.append(file.read())
+    sources.append('''
+      func fib(n)
+        if n < 2 then ret n else ret fib(n - 1) + fib(n - 2) end
+      end
+      for i := 1, 10 do
+        local a := fib(i)
+        local b := a * 2
+        if a > 10 then print b end
+      end
+      println ""
+    ''')
+    for source in sources:
+      code = compile_source(source)
+      optimized = PeepholeOptimizer().optimize(code)
+      self.assertLess(len(optimized), len(code))
+      self.assertEqual(run_code(optimized), run_code(code))
+
+class TestSuperinstructions(unittest.TestCase):
+  def test_fusion(self):
+    code = PeepholeOptimizer().optimize(compile_source('''
+      func f(a, b)
+        local i := 0
+        while i < a do
+          i := i + 1
+        end
+        ret a / 2 + b + 1
+      end
+      println f(3, 4)
+    '''))
+    opcodes = [instruction[0] for instruction in code]
+    self.assertIn(('INC_LOCAL', 2, 1.0), code)
+    self.assertIn(('LOAD_LOCAL2', 2, 0), code)
+    self.assertIn('JMP_IF_NOT_LT', opcodes)
+    self.assertIn(('LOAD_CONST_DIV', (TYPE_NUMBER, 2.0)), code)
+    self.assertIn(('LOAD_CONST_ADD', (TYPE_NUMBER, 1.0)), code)
+    self.assertEqual(run_code(code), '6.5\n')
+
+  def test_generic_operands(self):
+    source = '''
+      func f(s)
+        s := s + 1
+        ret s + "!"
+      end
+      println f("a")
+      x := "b"
+      if x < "c" then println x + 2 end
+      if x >= "c" then println 0 end
+    '''
+    code = PeepholeOptimizer().optimize(compile_source(source))
+    self.assertEqual(run_code(code), 'a1!\nb2\n')
+
+  def test_errors(self):
+    for source in ['x := 1\nprintln x / 0', 'x := true\nif x < 1 then println x end', 'func f(b) b := b + 1 end\nf(true)']:
+      code = PeepholeOptimizer().optimize(compile_source(source))
+      with contextlib.redirect_stdout(io.StringIO()):
+        with self.assertRaises(SystemExit):
+          VM().run(code)
+
+if __name__ == "__main__":
+  unittest.main()
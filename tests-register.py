@@ -0,0 +1,124 @@
+import unittest
+import io
+import contextlib
+from lexer import *
+from parser import *
+from optimizer import *
+from compiler import *
+from assembler import *
+from vm import *
+from regcompiler import *
+from regvm import *
+
+def run_register(source):
+  ast = Parser(Lexer(source).tokenize()).parse()
+  compiler = RegisterCompiler()
+  instructions = compiler.generate_code(ast)
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    RegisterVM().run(assemble_registers(instructions, compiler.templates))
+  return output.getvalue()
+
+def run_stack(source):
+  ast = Parser(Lexer(source).tokenize()).parse()
+  output = io.StringIO()
+  with contextlib.redirect_stdout(output):
+    VM().run(Compiler().generate_code(ast))
+  return output.getvalue()
+
+class TestRegisterCompiler(unittest.TestCase):
+  def test_three_address_code(self):
+    ast = Parser(Lexer('func f(a, b) ret a * b + 2 end\nprintln f(3, 4)').tokenize()).parse()
+    compiler = RegisterCompiler()
+    code = [instruction for instruction in compiler.generate_code(ast) if instruction[0] not in pseudo_opcodes]
+    self.assertIn(('MUL', 3, 0, 1), code)
+    self.assertIn(('ADD', 2, 3, -1), code)
+    self.assertIn(('RET', 2), code)
+    self.assertEqual(compiler.templates['f'][-1], (TYPE_NUMBER, 2.0))
+
+  def test_conditions_jump_on_operands(self):
+    ast = Parser(Lexer('x := 1\nwhile x < 10 and x ~= 5 do x := x + 1 end\nprintln x').tokenize()).parse()
+    code = RegisterCompiler().generate_code(ast)
+    opcodes = [instruction[0] for instruction in code]
+    self.assertIn('JMP_IF_NOT_LT', opcodes)
+    self.assertIn('JMP_IF_NOT_NE', opcodes)
+    self.assertNotIn('JMPF', opcodes)
+
+class TestRegisterVM(unittest.TestCase):
+  def test_same_output_as_stack_vm(self):
+    source = '''
+      x := 1
+      s := "a" + 'b' + x
+      if x > 0 and ~(x == 2) or false then
+        local y := -x ^ 2 % 3
+        println y
+      else
+        println "no"
+      end
+      i := 0
+      while i < 3 do
+        local k := i * 2
+        if k >= 2 then println k end
+        i := i + 1
+      end
+      for j := 1, 5, 2 do
+        print j
+      end
+      println ""
+      println s
+      println (x > 2 or "left") + (x and 3)
+      func f(a, b)
+        local c := a + b
+        b := a
+        if c > 3 then
+          ret c * b
+        end
+        ret 0 - c
+      end
+      println f(1, 2) + f(f(2, 2), 1)
+    '''
+    self.assertEqual(run_register(source), run_stack(source))
+
+  def test_scripts(self):
+    for filename in ['scripts/myscript.pinky', 'scripts/calls.pinky', 'scripts/guards.pinky']:
+      with open(filename) as file:
+        source = file.read()
+      self.assertEqual(run_register(source), run_stack(source), filename)
+
+  def test_for_loops(self):
+    source = '''
+      n := 3
+      for i := n, 1 do print i end
+      for i := 1, n * 2, 2 do print i end
+      for i := 10, 0, -5 do print i end
+      println ""
+    '''
+    self.assertEqual(run_register(source), '3211351050\n')
+
+  def test_recursion_and_tail_calls(self):
+    source = '''
+      func fib(n)
+        if n < 2 then ret n end
+        ret fib(n - 1) + fib(n - 2)
+      end
+      func count(n, total)
+        if n == 0 then ret total end
+        ret count(n - 1, total + n)
+      end
+      println fib(15)
+      println count(100000, 0)
+    '''
+    self.assertEqual(run_register(source), '610\n5000050000\n')
+
+  def test_top_level_local(self):
+    source = 'local x := 1\nfunc f() ret x + 1 end\nprintln f()\nlocal x := 5\nprintln x'
+    self.assertEqual(run_register(source), '2\n5\n')
+
+  def test_errors(self):
+    for source in ['println 1 / 0', 'if 1 then println 1 end', 'println -"a"']:
+      with contextlib.redirect_stdout(io.StringIO()):
+        with self.assertRaises(SystemExit):
+          run_register(source)
+
+if __name__ == "__main__":
+  unittest.main()
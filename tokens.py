@@ -1,59 +1,66 @@
+from array import array
+
 ###############################################################################
 # Constants for different token types
+#
+# Token types are small integers so that they can be stored in typed arrays
+# and compared cheaply; token_names maps them back to their names.
 ###############################################################################
 # Single-char tokens
-TOK_LPAREN     = 'TOK_LPAREN'     #  (
-TOK_RPAREN     = 'TOK_RPAREN'     #  )
-TOK_LCURLY     = 'TOK_LCURLY'     #  {
-TOK_RCURLY     = 'TOK_RCURLY'     #  }
-TOK_LSQUAR     = 'TOK_LSQUAR'     #  [
-TOK_RSQUAR     = 'TOK_RSQUAR'     #  ]
-TOK_COMMA      = 'TOK_COMMA'      #  ,
-TOK_DOT        = 'TOK_DOT'        #  .
-TOK_PLUS       = 'TOK_PLUS'       #  +
-TOK_MINUS      = 'TOK_MINUS'      #  -
-TOK_STAR       = 'TOK_STAR'       #  *
-TOK_SLASH      = 'TOK_SLASH'      #  /
-TOK_CARET      = 'TOK_CARET'      #  ^
-TOK_MOD        = 'TOK_MOD'        #  %
-TOK_COLON      = 'TOK_COLON'      #  :
-TOK_SEMICOLON  = 'TOK_SEMICOLON'  #  ;
-TOK_QUESTION   = 'TOK_QUESTION'   #  ?
-TOK_NOT        = 'TOK_NOT'        #  ~
-TOK_GT         = 'TOK_GT'         #  >
-TOK_LT         = 'TOK_LT'         #  <
-TOK_EQ         = 'TOK_EQ'         #  =
+TOK_LPAREN     = 0    #  (
+TOK_RPAREN     = 1    #  )
+TOK_LCURLY     = 2    #  {
+TOK_RCURLY     = 3    #  }
+TOK_LSQUAR     = 4    #  [
+TOK_RSQUAR     = 5    #  ]
+TOK_COMMA      = 6    #  ,
+TOK_DOT        = 7    #  .
+TOK_PLUS       = 8    #  +
+TOK_MINUS      = 9    #  -
+TOK_STAR       = 10   #  *
+TOK_SLASH      = 11   #  /
+TOK_CARET      = 12   #  ^
+TOK_MOD        = 13   #  %
+TOK_COLON      = 14   #  :
+TOK_SEMICOLON  = 15   #  ;
+TOK_QUESTION   = 16   #  ?
+TOK_NOT        = 17   #  ~
+TOK_GT         = 18   #  >
+TOK_LT         = 19   #  <
+TOK_EQ         = 20   #  =
 # Two-char tokens
-TOK_GE         = 'TOK_GE'         #  >=
-TOK_LE         = 'TOK_LE'         #  <=
-TOK_NE         = 'TOK_NE'         #  ~=
-TOK_EQEQ       = 'TOK_EQEQ'       #  ==
-TOK_ASSIGN     = 'TOK_ASSIGN'     #  :=
-TOK_GTGT       = 'TOK_GTGT'       #  >>
-TOK_LTLT       = 'TOK_LTLT'       #  <<
+TOK_GE         = 21   #  >=
+TOK_LE         = 22   #  <=
+TOK_NE         = 23   #  ~=
+TOK_EQEQ       = 24   #  ==
+TOK_ASSIGN     = 25   #  :=
+TOK_GTGT       = 26   #  >>
+TOK_LTLT       = 27   #  <<
 # Literals
-TOK_IDENTIFIER = 'TOK_IDENTIFIER'
-TOK_STRING     = 'TOK_STRING'
-TOK_INTEGER    = 'TOK_INTEGER'
-TOK_FLOAT      = 'TOK_FLOAT'
+TOK_IDENTIFIER = 28
+TOK_STRING     = 29
+TOK_INTEGER    = 30
+TOK_FLOAT      = 31
 # Keywords
-TOK_IF         = 'TOK_IF'
-TOK_THEN       = 'TOK_THEN'
-TOK_ELSE       = 'TOK_ELSE'
-TOK_TRUE       = 'TOK_TRUE'
-TOK_FALSE      = 'TOK_FALSE'
-TOK_AND        = 'TOK_AND'
-TOK_OR         = 'TOK_OR'
-TOK_WHILE      = 'TOK_WHILE'
-TOK_DO         = 'TOK_DO'
-TOK_FOR        = 'TOK_FOR'
-TOK_FUNC       = 'TOK_FUNC'
-TOK_NULL       = 'TOK_NULL'
-TOK_END        = 'TOK_END'
-TOK_PRINT      = 'TOK_PRINT'
-TOK_PRINTLN    = 'TOK_PRINTLN'
-TOK_RET        = 'TOK_RET'
-TOK_LOCAL      = 'TOK_LOCAL'      
+TOK_IF         = 32
+TOK_THEN       = 33
+TOK_ELSE       = 34
+TOK_TRUE       = 35
+TOK_FALSE      = 36
+TOK_AND        = 37
+TOK_OR         = 38
+TOK_WHILE      = 39
+TOK_DO         = 40
+TOK_FOR        = 41
+TOK_FUNC       = 42
+TOK_NULL       = 43
+TOK_END        = 44
+TOK_PRINT      = 45
+TOK_PRINTLN    = 46
+TOK_RET        = 47
+TOK_LOCAL      = 48
+
+token_names = {value: name for name, value in list(globals().items()) if name.startswith('TOK_')}
 
 ###############################################################################
 # Dictionary mapping keywords and their token types
@@ -78,7 +85,43 @@ keywords = {
   'local'   : TOK_LOCAL
 }
 
+###############################################################################
+# Dictionary mapping operators and punctuation and their token types
+###############################################################################
+symbols = {
+  '('  : TOK_LPAREN,
+  ')'  : TOK_RPAREN,
+  '{'  : TOK_LCURLY,
+  '}'  : TOK_RCURLY,
+  '['  : TOK_LSQUAR,
+  ']'  : TOK_RSQUAR,
+  ','  : TOK_COMMA,
+  '.'  : TOK_DOT,
+  '+'  : TOK_PLUS,
+  '-'  : TOK_MINUS,
+  '*'  : TOK_STAR,
+  '/'  : TOK_SLASH,
+  '^'  : TOK_CARET,
+  '%'  : TOK_MOD,
+  ':'  : TOK_COLON,
+  ';'  : TOK_SEMICOLON,
+  '?'  : TOK_QUESTION,
+  '~'  : TOK_NOT,
+  '>'  : TOK_GT,
+  '<'  : TOK_LT,
+  '='  : TOK_EQ,
+  '>=' : TOK_GE,
+  '<=' : TOK_LE,
+  '~=' : TOK_NE,
+  '==' : TOK_EQEQ,
+  ':=' : TOK_ASSIGN,
+  '>>' : TOK_GTGT,
+  '<<' : TOK_LTLT
+}
+
 class Token:
+  __slots__ = ('token_type', 'lexeme', 'line')
+
   def __init__(self, token_type, lexeme, line):
     self.token_type = token_type
     self.lexeme = lexeme
@@ -86,4 +129,121 @@ class Token:
     pass
 
   def __repr__(self):
-    return f'({self.token_type}, {self.lexeme!r}, {self.line})'
+    return f'({token_names[self.token_type]}, {self.lexeme!r}, {self.line})'
+
+###############################################################################
+# Token sources consumed by the parser
+#
+# kind(idx) returns the token type at position idx, or None past the end.
+# lexeme(idx) and line(idx) read single fields, and token(idx) builds or
+# returns the whole Token.
+###############################################################################
+class TokenList:
+  def __init__(self, tokens):
+    self.tokens = tokens
+    pass
+
+  def kind(self, idx):
+    if idx < len(self.tokens): return self.tokens[idx].token_type
+    return None
+
+  def lexeme(self, idx):
+    return self.tokens[idx].lexeme
+
+  def line(self, idx):
+    return self.tokens[idx].line
+
+  def token(self, idx):
+    return self.tokens[idx]
+
+class TokenStream:
+  # Pulls tokens lazily from an iterator (e.g. Lexer.stream()) and only keeps
+  # a small window around the parser position, so memory stays constant.
+  # Tokens that left the window are gone, so a parse over a stream is never
+  # lazy (see Parser).
+  max_window = 32
+
+  def __init__(self, tokens):
+    self.iterator = iter(tokens)
+    self.window = []
+    self.offset = 0
+    pass
+
+  def fill(self, idx):
+    window = self.window
+    while self.offset + len(window) <= idx:
+      token = next(self.iterator, None)
+      if token == None: return False
+      window.append(token)
+    return True
+
+  def kind(self, idx):
+    if not self.fill(idx): return None
+    # The parser never looks further back than the previous token
+    if len(self.window) > self.max_window:
+      drop = idx - 1 - self.offset
+      del self.window[:drop]
+      self.offset += drop
+    return self.window[idx - self.offset].token_type
+
+  def lexeme(self, idx):
+    return self.token(idx).lexeme
+
+  def line(self, idx):
+    return self.token(idx).line
+
+  def token(self, idx):
+    if idx < self.offset or not self.fill(idx):
+      raise IndexError(f'Token {idx} is no longer buffered')
+    return self.window[idx - self.offset]
+
+class TokenStore:
+  # Compact token list: one typed array per field instead of one object per
+  # token. Lexemes are sliced from the source only when asked for.
+  def __init__(self, source):
+    self.source = source
+    self.types = array('B')
+    self.starts = array('I')
+    self.ends = array('I')
+    self.lines = array('I')
+    pass
+
+  def append(self, token_type, start, end, line):
+    self.types.append(token_type)
+    self.starts.append(start)
+    self.ends.append(end)
+    self.lines.append(line)
+
+  def extend(self, types, starts, ends, lines):
+    self.types.extend(types)
+    self.starts.extend(starts)
+    self.ends.extend(ends)
+    self.lines.extend(lines)
+
+  def __len__(self):
+    return len(self.types)
+
+  def __getitem__(self, idx):
+    return self.token(idx)
+
+  def __iter__(self):
+    for idx in range(len(self.types)):
+      yield self.token(idx)
+
+  def kind(self, idx):
+    if idx < len(self.types): return self.types[idx]
+    return None
+
+  def lexeme(self, idx):
+    return self.source[self.starts[idx]:self.ends[idx]]
+
+  def line(self, idx):
+    return self.lines[idx]
+
+  def token(self, idx):
+    return Token(self.types[idx], self.lexeme(idx), self.lines[idx])
+
+def token_source(tokens):
+  if isinstance(tokens, list): return TokenList(tokens)
+  if isinstance(tokens, (TokenList, TokenStream, TokenStore)): return tokens
+  return TokenStream(tokens)
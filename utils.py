@@ -1,4 +1,5 @@
 from model import *
+from defs import *
 
 def print_stmt(stmt, indent = 0):
     if isinstance(stmt, PrintStmt):
@@ -100,18 +101,76 @@ def pretty_print_instructions(instructions):
             print(f'{i:08} {instructions[i][1]}:')
         elif instructions[i][0].startswith('JMP'):
             print(f'{i:08}  {instructions[i][0]} {instructions[i][1]}')
-        elif instructions[i][0].startswith('LOAD') or instructions[i][0].startswith('STORE'):
+        elif instructions[i][0] in ('LOAD_LOCAL2', 'INC_LOCAL'):
+            print(f'{i:08}  {instructions[i][0]} {instructions[i][1]}, {stringify(instructions[i][2])}')
+        elif instructions[i][0].startswith('LOAD_CONST'):
+            print(f'{i:08}  {instructions[i][0]} {stringify(instructions[i][1][1])}')
+        elif instructions[i][0].startswith('LOAD') or instructions[i][0].startswith('STORE') or instructions[i][0] == 'POPN':
             print(f'{i:08}  {instructions[i][0]} {instructions[i][1]}')
         elif instructions[i][0] == 'SET_SLOT':
             print(f'{i:08}  {instructions[i][0]} {instructions[i][1][0]} ({instructions[i][1][1]})')
-        elif instructions[i][0] == 'JSR':
+        elif instructions[i][0] in ('JSR', 'TAILJSR'):
             print(f'{i:08}  {instructions[i][0]} {instructions[i][1]}')
+        elif instructions[i][0] in ('FOR_PREP', 'FOR_LOOP'):
+            print(f'{i:08}  {instructions[i][0]} {instructions[i][1]}, {instructions[i][2]}')
         elif len(instructions[i]) > 1: 
             print(f'{i:08}  {instructions[i][0]} {stringify(instructions[i][1][1])}')
         else:
             print(f'{i:08}  {instructions[i][0]}')
         i += 1
 
+def pretty_print_program(program):
+    names = program.label_names()
+    for pc, instruction in enumerate(program.code):
+        for name in names.get(pc, []):
+            print(f'{pc:08} {name}:')
+        for idx, name in program.slots.get(pc, []):
+            print(f'{pc:08}  ; slot {idx} ({name})')
+        if instruction[0].startswith('JMP') or instruction[0] in ('JSR', 'TAILJSR'):
+            print(f'{pc:08}  {instruction[0]} {instruction[1]} ({", ".join(names[instruction[1]])})')
+        elif instruction[0] in ('FOR_PREP', 'FOR_LOOP'):
+            print(f'{pc:08}  {instruction[0]} {instruction[1]} ({", ".join(names[instruction[1]])}), {instruction[2]}')
+        elif instruction[0] in ('LOAD_LOCAL2', 'INC_LOCAL'):
+            print(f'{pc:08}  {instruction[0]} {instruction[1]}, {stringify(instruction[2])}')
+        elif instruction[0] == 'PUSH_CONST':
+            print(f'{pc:08}  {instruction[0]} {instruction[1]} ({stringify(program.consts[instruction[1]][1])})')
+        elif instruction[0].startswith('LOAD_CONST'):
+            print(f'{pc:08}  {instruction[0]} {stringify(instruction[1][1])}')
+        elif instruction[0].startswith('LOAD') or instruction[0].startswith('STORE') or instruction[0] == 'POPN':
+            print(f'{pc:08}  {instruction[0]} {instruction[1]}')
+        elif len(instruction) > 1:
+            print(f'{pc:08}  {instruction[0]} {stringify(instruction[1][1])}')
+        else:
+            print(f'{pc:08}  {instruction[0]}')
+
+def register_operands(instruction):
+    # Operands of a register machine instruction: registers as r0, r1, ...,
+    # constants as k0, k1, ... and globals as g0, g1, ...
+    opcode, *args = instruction
+    operands = []
+    for idx, arg in enumerate(args):
+        if isinstance(arg, bool) or isinstance(arg, str):
+            operands.append(stringify(arg))
+        elif opcode in ('CALL', 'TAILCALL') and idx == len(args) - 1:
+            operands.append(str(arg))
+        elif (opcode == 'GETGLOBAL' and idx == 1) or (opcode == 'SETGLOBAL' and idx == 0):
+            operands.append(f'g{arg}')
+        else:
+            operands.append(f'r{arg}' if arg >= 0 else f'k{-arg - 1}')
+    return ', '.join(operands)
+
+def pretty_print_registers(instructions, templates):
+    for i, instruction in enumerate(instructions):
+        if instruction[0] == 'LABEL':
+            print(f'{i:08} {instruction[1]}:')
+            consts = templates.get(instruction[1], [])
+            for k, (type, value) in enumerate(reversed([value for value in consts if value != None])):
+                print(f'{i:08}  ; k{k} = {value!r}' if type == TYPE_STRING else f'{i:08}  ; k{k} = {stringify(value)}')
+        elif instruction[0] == 'SET_SLOT':
+            print(f'{i:08}  ; r{instruction[1][0]} ({instruction[1][1]})')
+        else:
+            print(f'{i:08}  {instruction[0]} {register_operands(instruction)}'.rstrip())
+
 def stringify(value):
     if isinstance(value, bool) and value is True:
         return "true"
@@ -142,6 +201,11 @@ def compile_error(msg, lineno):
     import sys
     sys.exit(1)
     
+def assemble_error(msg, idx):
+    print(f'{Colors.FAIL}[Instruction {idx}] {msg}{Colors.ENDC}')
+    import sys
+    sys.exit(1)
+
 def vm_error(msg, pc):
     print(f'{Colors.FAIL}[PC {pc}] {msg}{Colors.ENDC}')
     import sys
@@ -1,4 +1,5 @@
 from compiler import *
+from assembler import *
 from utils import *
 from defs import *
 import codecs
@@ -8,7 +9,9 @@ import codecs
 # Instructions to push and pop from the stack:
 #
 #      ('PUSH', value)       # Push a value to the stack
+#      ('PUSH_CONST', idx)   # Push the value at idx in the constant pool of the program
 #      ('POP',)              # Pop a value from the stack
+#      ('POPN', k)           # Pop k values from the stack
 #
 # Stack values are tagged with their type using a tuple:
 #
@@ -57,12 +60,48 @@ import codecs
 #      ('LABEL', name)       # Declares a label
 #      ('JMP', name)         # Unconditionally jump to label name
 #      ('JMPZ', name)        # Jump to label name if top of stack is zero (or false)
+#      ('JMPZ_KEEP', name)   # Jump to label name keeping the top of stack if it is falsy, else pop it (and)
+#      ('JMPNZ_KEEP', name)  # Jump to label name keeping the top of stack if it is truthy, else pop it (or)
 #      ('JSR', name)         # Jump to subroutine/function and keep track of the returning PC
+#      ('TAILJSR', name)     # Call in tail position, reusing the frame of the calling function
 #      ('RTS',)              # Return from subroutine/function
+#
+# Instructions of for loops, whose variable is the local idx followed by
+# hidden locals for the bound, the step and the direction of the loop:
+#
+#      ('FOR_PREP', name, idx, default_step)
+#                            # Check the start, bound and step are numbers, set the direction
+#                            # (and the step to 1 or -1 by default), jump to name unless the
+#                            # body runs once
+#      ('FOR_LOOP', name, idx)
+#                            # Add the step to the variable and jump to name (the body) while
+#                            # it did not pass the bound
+#
+# Superinstructions, fused by the peephole optimizer from the most frequent
+# instruction sequences:
+#
+#      ('LOAD_LOCAL2', a, b)       # LOAD_LOCAL a, LOAD_LOCAL b
+#      ('INC_LOCAL', idx, k)       # LOAD_LOCAL idx, PUSH number k, ADD, STORE_LOCAL idx
+#      ('LOAD_CONST_ADD', value)   # PUSH value, ADD
+#      ('LOAD_CONST_DIV', value)   # PUSH value, DIV
+#      ('JMP_IF_NOT_LT', name)     # LT, JMPZ name (also LE, GT and GE)
+#
+# Type-specialized instructions, which the compiler emits where it proved the
+# operand types (see cfg.py). They skip the type checks:
+#
+#      ('ADD_NUM',)                # ADD of two numbers (also SUB, MUL, DIV and MOD)
+#      ('LT_NUM',)                 # LT of two numbers (also LE, GT, GE, EQ and NE)
+#      ('CONCAT_STR',)             # ADD with a string operand
+#      ('JMP_IF_NOT_LT_NUM', name) # LT_NUM, JMPZ name (also LE, GT and GE)
+#
+# Labels and SET_SLOT only exist in the compiler output. The program is
+# assembled before it runs, which drops them and turns the label operands of
+# JMP, JMPZ and JSR into the PC to continue at, and PUSH into PUSH_CONST (see
+# assembler.py).
 
 class Frame:
-    def __init__(self, name, ret_pc, fp):
-        self.name = name
+    def __init__(self, entry_pc, ret_pc, fp):
+        self.entry_pc = entry_pc
         self.ret_pc = ret_pc
         self.fp = fp
 
@@ -70,22 +109,20 @@ class VM:
     def __init__(self):
         self.stack = []
         self.frames = []
-        self.labels = {}
         self.globals = {}
         self.pc = 0
         self.sp = 0
         self.is_running = False
 
-    def create_label_talbe(self, instructions):
-        for idx, instruction in enumerate(instructions):
-            if instruction[0] == 'LABEL':
-                self.labels[instruction[1]] = idx
+    def run(self, program):
+        # program is an assembled Program or the instruction list of the
+        # compiler, which is assembled first
+        if not isinstance(program, Program):
+            program = assemble(program)
+        instructions = program.code
+        self.consts = program.consts
 
-    def run(self, instructions):
         self.is_running = True
-
-        self.create_label_talbe(instructions)
-
         while self.is_running:
             opcode, *args = instructions[self.pc]
             self.pc += 1
@@ -98,11 +135,20 @@ class VM:
         if len(self.stack) <= self.sp: self.stack.append(value)
         else: self.stack[self.sp] = value
         self.sp += 1
+
+    def PUSH_CONST(self, idx):
+        value = self.consts[idx]
+        if len(self.stack) <= self.sp: self.stack.append(value)
+        else: self.stack[self.sp] = value
+        self.sp += 1
     
     def POP(self):
         self.sp -= 1
         return self.stack[self.sp]
     
+    def POPN(self, count):
+        self.sp -= count
+
     def ADD(self):
         type2, value2 = self.POP()
         type1, value1 = self.POP()
@@ -138,7 +184,7 @@ class VM:
 
         if type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
             if value2 == 0:
-                vm_error(f'Division by zero')
+                vm_error(f'Division by zero', self.pc - 1)
             self.PUSH((TYPE_NUMBER, value1 / value2))
         else:
             vm_error(f'Unsupported operator DIV between {type1} and {type2}', self.pc - 1)
@@ -149,7 +195,7 @@ class VM:
 
         if type1 == TYPE_NUMBER and type2 == TYPE_NUMBER:
             if value2 == 0:
-                vm_error(f'Mod by zero')
+                vm_error(f'Mod by zero', self.pc - 1)
             self.PUSH((TYPE_NUMBER, value1 % value2))
         else:
             vm_error(f'Unsupported operator MOD between {type1} and {type2}', self.pc - 1)
@@ -269,20 +315,29 @@ class VM:
         else:
             vm_error(f'Unsupported operator NEG at {type}', self.pc - 1)
 
-    def LABEL(self, _):
-        pass
-
-    def JMP(self, name):
-        self.pc = self.labels[name]
+    def JMP(self, pc):
+        self.pc = pc
 
-    def JMPZ(self, name):
+    def JMPZ(self, pc):
         type, value = self.POP()
         if type == TYPE_BOOL:
             if not value:
-                self.JMP(name)
+                self.pc = pc
         else:
             vm_error('Condition is not a boolean expression', self.pc - 1)
     
+    def JMPZ_KEEP(self, pc):
+        if self.stack[self.sp - 1][1]:
+            self.sp -= 1
+        else:
+            self.pc = pc
+
+    def JMPNZ_KEEP(self, pc):
+        if self.stack[self.sp - 1][1]:
+            self.pc = pc
+        else:
+            self.sp -= 1
+
     def STORE_GLOBAL(self, idx):
         self.globals[idx] = self.POP()
 
@@ -295,20 +350,200 @@ class VM:
 
         self.stack[idx] = self.POP()
 
-    def SET_SLOT(self, _):
-        pass
-
     def LOAD_LOCAL(self, idx):
         if len(self.frames) > 0:
             idx += self.frames[-1].fp
 
         self.PUSH(self.stack[idx])
     
-    def JSR(self, name):
+    def LOAD_LOCAL2(self, idx1, idx2):
+        if len(self.frames) > 0:
+            fp = self.frames[-1].fp
+            idx1 += fp
+            idx2 += fp
+
+        self.PUSH(self.stack[idx1])
+        self.PUSH(self.stack[idx2])
+
+    def INC_LOCAL(self, idx, step):
+        if len(self.frames) > 0:
+            idx += self.frames[-1].fp
+
+        type, value = self.stack[idx]
+        if type == TYPE_NUMBER:
+            self.stack[idx] = (TYPE_NUMBER, value + step)
+        else:
+            self.PUSH((type, value))
+            self.PUSH((TYPE_NUMBER, step))
+            self.ADD()
+            self.stack[idx] = self.POP()
+
+    def LOAD_CONST_ADD(self, value):
+        type1, value1 = self.stack[self.sp - 1]
+        if type1 == TYPE_NUMBER and value[0] == TYPE_NUMBER:
+            self.stack[self.sp - 1] = (TYPE_NUMBER, value1 + value[1])
+        else:
+            self.PUSH(value)
+            self.ADD()
+
+    def LOAD_CONST_DIV(self, value):
+        type1, value1 = self.stack[self.sp - 1]
+        if type1 == TYPE_NUMBER and value[0] == TYPE_NUMBER and value[1] != 0:
+            self.stack[self.sp - 1] = (TYPE_NUMBER, value1 / value[1])
+        else:
+            self.PUSH(value)
+            self.DIV()
+
+    def FOR_PREP(self, pc, idx, default_step):
+        # Counts up while the variable is at most the bound if it starts
+        # there, else counts down while it is at least the bound
+        if len(self.frames) > 0:
+            idx += self.frames[-1].fp
+
+        stack = self.stack
+        for offset, name in ((0, 'Start'), (1, 'Bound'), (2, 'Step')):
+            if offset == 2 and default_step:
+                continue
+            if stack[idx + offset][0] != TYPE_NUMBER:
+                vm_error(f'{name} of the for loop is not a number', self.pc - 1)
+
+        value, bound = stack[idx][1], stack[idx + 1][1]
+        up = value <= bound
+        stack[idx + 3] = (TYPE_BOOL, up)
+        if default_step:
+            stack[idx + 2] = (TYPE_NUMBER, 1.0 if up else -1.0)
+        if not (up or value >= bound):
+            self.pc = pc
+
+    def FOR_LOOP(self, pc, idx):
+        if len(self.frames) > 0:
+            idx += self.frames[-1].fp
+
+        stack = self.stack
+        type, value = stack[idx]
+        if type != TYPE_NUMBER:
+            vm_error('Variable of the for loop is not a number', self.pc - 1)
+        value += stack[idx + 2][1]
+        stack[idx] = (TYPE_NUMBER, value)
+        if stack[idx + 3][1]:
+            if value <= stack[idx + 1][1]:
+                self.pc = pc
+        elif value >= stack[idx + 1][1]:
+            self.pc = pc
+
+    def JMP_IF_NOT_LT(self, pc):
+        self.LT()
+        self.sp -= 1
+        if not self.stack[self.sp][1]:
+            self.pc = pc
+
+    def JMP_IF_NOT_LE(self, pc):
+        self.LE()
+        self.sp -= 1
+        if not self.stack[self.sp][1]:
+            self.pc = pc
+
+    def JMP_IF_NOT_GT(self, pc):
+        self.GT()
+        self.sp -= 1
+        if not self.stack[self.sp][1]:
+            self.pc = pc
+
+    def JMP_IF_NOT_GE(self, pc):
+        self.GE()
+        self.sp -= 1
+        if not self.stack[self.sp][1]:
+            self.pc = pc
+
+    def ADD_NUM(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_NUMBER, self.stack[self.sp - 1][1] + self.stack[self.sp][1])
+
+    def SUB_NUM(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_NUMBER, self.stack[self.sp - 1][1] - self.stack[self.sp][1])
+
+    def MUL_NUM(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_NUMBER, self.stack[self.sp - 1][1] * self.stack[self.sp][1])
+
+    def DIV_NUM(self):
+        self.sp -= 1
+        value2 = self.stack[self.sp][1]
+        if value2 == 0:
+            vm_error(f'Division by zero', self.pc - 1)
+        self.stack[self.sp - 1] = (TYPE_NUMBER, self.stack[self.sp - 1][1] / value2)
+
+    def MOD_NUM(self):
+        self.sp -= 1
+        value2 = self.stack[self.sp][1]
+        if value2 == 0:
+            vm_error(f'Mod by zero', self.pc - 1)
+        self.stack[self.sp - 1] = (TYPE_NUMBER, self.stack[self.sp - 1][1] % value2)
+
+    def CONCAT_STR(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_STRING, stringify(self.stack[self.sp - 1][1]) + stringify(self.stack[self.sp][1]))
+
+    def EQ_NUM(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_BOOL, self.stack[self.sp - 1][1] == self.stack[self.sp][1])
+
+    def NE_NUM(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_BOOL, self.stack[self.sp - 1][1] != self.stack[self.sp][1])
+
+    def GE_NUM(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_BOOL, self.stack[self.sp - 1][1] >= self.stack[self.sp][1])
+
+    def GT_NUM(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_BOOL, self.stack[self.sp - 1][1] > self.stack[self.sp][1])
+
+    def LE_NUM(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_BOOL, self.stack[self.sp - 1][1] <= self.stack[self.sp][1])
+
+    def LT_NUM(self):
+        self.sp -= 1
+        self.stack[self.sp - 1] = (TYPE_BOOL, self.stack[self.sp - 1][1] < self.stack[self.sp][1])
+
+    def JMP_IF_NOT_LT_NUM(self, pc):
+        self.sp -= 2
+        if not self.stack[self.sp][1] < self.stack[self.sp + 1][1]:
+            self.pc = pc
+
+    def JMP_IF_NOT_LE_NUM(self, pc):
+        self.sp -= 2
+        if not self.stack[self.sp][1] <= self.stack[self.sp + 1][1]:
+            self.pc = pc
+
+    def JMP_IF_NOT_GT_NUM(self, pc):
+        self.sp -= 2
+        if not self.stack[self.sp][1] > self.stack[self.sp + 1][1]:
+            self.pc = pc
+
+    def JMP_IF_NOT_GE_NUM(self, pc):
+        self.sp -= 2
+        if not self.stack[self.sp][1] >= self.stack[self.sp + 1][1]:
+            self.pc = pc
+
+    def JSR(self, pc):
         _, arg_cnt = self.POP()
-        new_frame = Frame(name, self.pc, self.sp - arg_cnt)
+        new_frame = Frame(pc, self.pc, self.sp - arg_cnt)
         self.frames.append(new_frame)
-        self.pc = self.labels[name]
+        self.pc = pc
+
+    def TAILJSR(self, pc):
+        # Replaces the current frame's locals with the arguments and jumps to
+        # the callee, which returns straight to the caller's caller
+        _, arg_cnt = self.POP()
+        frame = self.frames[-1]
+        self.stack[frame.fp:frame.fp + arg_cnt] = self.stack[self.sp - arg_cnt:self.sp]
+        self.sp = frame.fp + arg_cnt
+        frame.entry_pc = pc
+        self.pc = pc
 
     def RTS(self):
         last_frame = self.frames.pop()